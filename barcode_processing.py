@@ -0,0 +1,2349 @@
+import math
+import os
+import sys
+import mmap
+import re
+import shutil
+import tempfile
+import logging
+import io
+import pickle
+import collections
+import contextlib
+import glob
+import time
+import json
+import csv
+import zipfile
+import zlib
+import datetime
+import hashlib
+import statistics
+import threading
+import xml.sax.saxutils
+import xml.etree.ElementTree
+import barcode
+import openpyxl
+import openpyxl.utils
+from openpyxl.drawing.image import Image as OpenPyXlImage
+from openpyxl.writer.excel import ExcelWriter
+from openpyxl.reader.excel import ExcelReader
+from openpyxl.drawing.spreadsheet_drawing import SpreadsheetDrawing
+from openpyxl.packaging.relationship import get_rels_path, get_dependents
+from openpyxl.packaging.custom import StringProperty
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils.units import pixels_to_EMU, EMU_to_pixels
+from openpyxl.styles import Font
+from PIL import Image as pil_Image
+from PIL import ImageOps as pil_ImageOps
+from PIL import ImageDraw as pil_ImageDraw
+from PIL import ImageFont as pil_ImageFont
+from PIL import ImageColor as pil_ImageColor
+from barcode.writer import BaseWriter, SVGWriter, mm2px, pt2mm
+from barcode_settings import appname, default_settings, check_settings
+try:
+    import resource
+except ImportError:
+    # windows doesn't have it, peak memory isn't reported there
+    resource = None
+
+# this module holds the workbook processing code, it doesn't touch tkinter so that it can be run headless.
+# the settings it is given are described in barcode_settings
+
+logger = logging.getLogger(appname)
+
+
+def print_if_debug(string):
+    # debug output goes through the application logger, main.py decides where (and if) that ends up
+    logger.debug(string)
+
+
+def create_barcode_directory(keep_barcodes_in_cwd, launch_cwd):
+    print_if_debug("creating temp directory")
+    if not keep_barcodes_in_cwd:
+        tempdir = tempfile.mkdtemp()
+    else:
+        temp_dir_in_cwd = os.path.join(launch_cwd, 'barcode images')
+        os.mkdir(temp_dir_in_cwd)
+        tempdir = temp_dir_in_cwd
+    print_if_debug("temp directory created as: " + tempdir)
+    return tempdir
+
+
+def remove_barcode_directory(tempdir):
+    print_if_debug("removing temp folder " + tempdir)
+    shutil.rmtree(tempdir)
+    print_if_debug("success")
+
+
+class BarcodeRenderCache():
+    # this is a least recently used cache of finished barcode images, keyed on everything that changes the image.
+    # entries are (png bytes, width, height), and the cache is limited by the total size of the stored images.
+    # it can be saved to and loaded from a file, so that repeat runs skip rendering codes that were seen before.
+    # one cache can be shared between threads
+    cache_file_version = 2
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            try:
+                entry = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, png_bytes, width, height):
+        if len(png_bytes) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= len(self.entries.pop(key)[0])
+            self.entries[key] = (png_bytes, width, height)
+            self.total_bytes += len(png_bytes)
+            while self.total_bytes > self.max_bytes:
+                _, (evicted_png_bytes, _, _) = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted_png_bytes)
+
+    def load(self, cache_file_path):
+        # a missing or unreadable cache file just means starting with an empty cache
+        try:
+            with open(cache_file_path, 'rb') as cache_file:
+                cache_file_contents = pickle.load(cache_file)
+        except FileNotFoundError:
+            return
+        except Exception as cache_load_error:
+            print_if_debug("could not load render cache " + cache_file_path + ": " + str(cache_load_error))
+            return
+        if not isinstance(cache_file_contents, dict) or \
+                cache_file_contents.get('version') != self.cache_file_version:
+            print_if_debug("ignoring render cache " + cache_file_path + " from a different version")
+            return
+        for key, (png_bytes, width, height) in cache_file_contents['entries']:
+            self.put(key, png_bytes, width, height)
+        print_if_debug("loaded " + str(len(self)) + " cached barcodes from " + cache_file_path)
+
+    def save(self, cache_file_path):
+        # write to a temporary file first, so that an interrupted save doesn't leave a broken cache behind
+        temp_cache_file_path = cache_file_path + '.tmp'
+        with self.lock:
+            cache_entries = list(self.entries.items())
+        with open(temp_cache_file_path, 'wb') as cache_file:
+            pickle.dump({'version': self.cache_file_version, 'entries': cache_entries}, cache_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_cache_file_path, cache_file_path)
+        print_if_debug("saved " + str(len(self)) + " cached barcodes to " + cache_file_path)
+
+
+def peak_memory_bytes():
+    # returns the most memory this process has had resident at once since it started, not counting render
+    # processes, or None where that can't be found out
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macos gives it in bytes, everywhere else in kilobytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+class ProcessTimer():
+    # adds up the time spent in each stage of processing a workbook, along with counters for anything worth
+    # tracking alongside it. stages are timed with "with process_timer.stage('name'):", and can be entered
+    # many times, their times add up. queue depths between stages are sampled with queue_depth, and summarised as
+    # their largest and average depth. the summary has the peak memory of the process in as well, where it is known
+    def __init__(self):
+        self.stage_seconds = collections.OrderedDict()
+        self.stage_calls = collections.Counter()
+        self.counters = collections.OrderedDict()
+        # {queue name: [samples, total depth, largest depth]}
+        self.queue_depths = collections.OrderedDict()
+        self.peak_memory = None
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, stage_name):
+        stage_start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage_name] = self.stage_seconds.get(stage_name, 0.0) + \
+                time.perf_counter() - stage_start_time
+            self.stage_calls[stage_name] += 1
+
+    def count(self, counter_name, amount=1):
+        self.counters[counter_name] = self.counters.get(counter_name, 0) + amount
+
+    def queue_depth(self, queue_name, depth, samples=1):
+        queue_samples = self.queue_depths.setdefault(queue_name, [0, 0, 0])
+        queue_samples[0] += samples
+        queue_samples[1] += depth * samples
+        queue_samples[2] = max(queue_samples[2], depth)
+
+    def record_peak_memory(self, peak_memory):
+        if peak_memory is not None:
+            self.peak_memory = max(self.peak_memory or 0, peak_memory)
+
+    def summary(self):
+        # returns everything collected as plain values, so it can be written out as json
+        total_seconds = time.perf_counter() - self.start_time
+        self.record_peak_memory(peak_memory_bytes())
+        timing_summary = {'seconds': round(total_seconds, 4), 'stages': collections.OrderedDict(),
+                          'counters': dict(self.counters)}
+        for stage_name, stage_seconds in self.stage_seconds.items():
+            timing_summary['stages'][stage_name] = {'seconds': round(stage_seconds, 4),
+                                                    'calls': self.stage_calls[stage_name]}
+        if self.queue_depths:
+            timing_summary['queues'] = collections.OrderedDict()
+            for queue_name, (queue_samples, total_depth, largest_depth) in self.queue_depths.items():
+                timing_summary['queues'][queue_name] = {'samples': queue_samples, 'max': largest_depth,
+                                                        'mean': round(total_depth / queue_samples, 1)}
+        if self.peak_memory is not None:
+            timing_summary['peak_memory_bytes'] = self.peak_memory
+        if total_seconds > 0:
+            timing_summary['rows_per_second'] = round(self.counters.get('rows', 0) / total_seconds, 1)
+        return timing_summary
+
+
+def merge_timing_summaries(timing_summaries, total_seconds):
+    # adds up the ProcessTimer summaries of several runs, such as the workbooks of a batch.
+    # total_seconds is how long they took altogether, which is what rows per second is worked out from.
+    # the peak memory is the most any one process got to, this one included
+    merged_timer = ProcessTimer()
+    for timing_summary in timing_summaries:
+        for stage_name, stage_summary in timing_summary.get('stages', {}).items():
+            merged_timer.stage_seconds[stage_name] = merged_timer.stage_seconds.get(stage_name, 0.0) + \
+                stage_summary['seconds']
+            merged_timer.stage_calls[stage_name] += stage_summary['calls']
+        for counter_name, counter_value in timing_summary.get('counters', {}).items():
+            merged_timer.count(counter_name, counter_value)
+        for queue_name, queue_summary in timing_summary.get('queues', {}).items():
+            # the average depth is added back in for as many samples as it was taken from
+            merged_timer.queue_depth(queue_name, queue_summary['mean'], queue_summary['samples'])
+            merged_timer.queue_depths[queue_name][2] = max(merged_timer.queue_depths[queue_name][2],
+                                                           queue_summary['max'])
+        merged_timer.record_peak_memory(timing_summary.get('peak_memory_bytes'))
+    merged_timer.start_time = time.perf_counter() - total_seconds
+    return merged_timer.summary()
+
+
+def render_cache_key(input_string, settings):
+    return (input_string, settings['barcode_type'], settings['barcode_dpi'], settings['barcode_module_height'],
+            settings['barcode_border'], settings['barcode_font_size'], settings['barcode_png_mode'],
+            settings['barcode_png_compression'])
+
+
+def barcode_writer_options(settings):
+    return {
+        # select output image size via dpi. internally, pybarcode lays the barcode out in mm, then draws it as an
+        # image. dpi is the conversion from image size in mm, to what the image writer thinks is inches.
+        'dpi': settings['barcode_dpi'],
+        # module height is the barcode bar height in mm
+        'module_height': float(settings['barcode_module_height']),
+        # text distance is the distance between the bottom of the barcode, and the top of the text in mm
+        'text_distance': 1,
+        # font size is the text size in pt
+        'font_size': settings['barcode_font_size'],
+        # quiet zone is the distance from the ends of the barcode to the ends of the image in mm
+        'quiet_zone': 2,
+    }
+
+
+class BarcodeLayoutWriter(BaseWriter):
+    # this goes through python-barcode's layout of a barcode the way its image writer does, but draws nothing. what is
+    # kept is the image size, and the options python-barcode settled on for the barcode type, which
+    # render_barcode_image draws with
+    def __init__(self):
+        BaseWriter.__init__(self, self._init, self._paint_module, None, self._finish)
+        self.dpi = 300
+        self.size = None
+
+    def _init(self, code):
+        width, height = self.calculate_size(len(code[0]), 1)
+        self.size = (int(mm2px(width, self.dpi)), int(mm2px(height, self.dpi)))
+
+    def _paint_module(self, xpos, ypos, width, color):
+        pass
+
+    def _finish(self):
+        return self.size
+
+
+# every value of a barcode type with the same length has the same number of modules, so the layout only has to be
+# worked out once for each length and set of settings
+barcode_layout_cache = {}
+
+
+def get_barcode_layout(input_string, settings):
+    # the layout only depends on the length of the value, not the value itself, and the border is added around it
+    layout_key = (len(input_string), settings['barcode_type'], settings['barcode_dpi'],
+                  settings['barcode_module_height'], settings['barcode_font_size'])
+    barcode_layout = barcode_layout_cache.get(layout_key)
+    if barcode_layout is None:
+        barcode_layout = BarcodeLayoutWriter()
+        ean = barcode.get(settings['barcode_type'], input_string, writer=barcode_layout)
+        # these go in as defaults rather than render options, so that barcode types with their own
+        # module width and quiet zone (code39) still get to use them
+        ean.default_writer_options = dict(ean.default_writer_options, **barcode_writer_options(settings))
+        ean.render()
+        barcode_layout_cache[layout_key] = barcode_layout
+    return barcode_layout
+
+
+def get_barcode_geometry(input_string, settings):
+    # returns the width and height in pixels the image generate_barcode makes for input_string will have, without
+    # drawing it
+    width, height = get_barcode_layout(input_string, settings).size
+    return width + settings['barcode_border'] * 2, height + settings['barcode_border'] * 2
+
+
+# fonts are loaded once for each thread, a freetype font can't be drawn with from two threads at once
+barcode_fonts = threading.local()
+
+
+def get_barcode_font(font_path, font_size):
+    loaded_fonts = getattr(barcode_fonts, 'loaded_fonts', None)
+    if loaded_fonts is None:
+        loaded_fonts = barcode_fonts.loaded_fonts = {}
+    font = loaded_fonts.get((font_path, font_size))
+    if font is None:
+        font = loaded_fonts[(font_path, font_size)] = pil_ImageFont.truetype(font_path, font_size)
+    return font
+
+
+# the supported barcode types have no guard bars, so their module patterns are only bars (1) and spaces (0)
+barcode_module_run_pattern = re.compile('1+|0+')
+
+
+def render_barcode_image(input_string, settings):
+    # draws a barcode as a greyscale image with its border, with the same pixels python-barcode's image writer gives.
+    # the bars all cover the same rows, so one row of them is worked out from the module pattern and repeated, and
+    # only the text is left to pillow to draw. positions are worked out with the same arithmetic the image writer
+    # uses, as a pixel either way can change where a bar starts
+    barcode_layout = get_barcode_layout(input_string, settings)
+    dpi = barcode_layout.dpi
+    width, height = barcode_layout.size
+    background = pil_ImageColor.getcolor(barcode_layout.background, 'L')
+    foreground = pil_ImageColor.getcolor(barcode_layout.foreground, 'L')
+    ean = barcode.get(settings['barcode_type'], input_string)
+    bar_row = bytearray([background]) * width
+    xpos = barcode_layout.quiet_zone
+    for module_run in barcode_module_run_pattern.finditer(ean.build()[0]):
+        run_width = barcode_layout.module_width * (module_run.end() - module_run.start())
+        if module_run.group()[0] == '1':
+            # a bar covers the pixels from its left edge to the one before its right edge, and at least one pixel
+            # when it is narrower than that, as code39 bars are at 120 dpi. the spaces aren't drawn, so they can't
+            # cover up a bar that shares a pixel with them
+            bar_left = int(mm2px(xpos, dpi))
+            bar_right = min(max(bar_left, int(mm2px(xpos + run_width, dpi) - 1)) + 1, width)
+            bar_row[bar_left:bar_right] = bytes([foreground]) * (bar_right - bar_left)
+        xpos += run_width
+    bars_top = int(mm2px(barcode_layout.margin_top, dpi))
+    bars_bottom = min(int(mm2px(barcode_layout.margin_top + barcode_layout.module_height, dpi)) + 1, height)
+    blank_row = bytes([background]) * width
+    barcode_image = pil_Image.frombytes('L', (width, height), blank_row * bars_top +
+                                        bytes(bar_row) * (bars_bottom - bars_top) +
+                                        blank_row * (height - bars_bottom))
+    text = ean.get_fullcode()
+    font_size = int(mm2px(pt2mm(barcode_layout.font_size), dpi))
+    if text and font_size > 0:
+        # the text is centred under the bars, a text distance below them
+        text_xpos = barcode_layout.quiet_zone + (xpos - barcode_layout.quiet_zone) / 2.0
+        text_ypos = barcode_layout.margin_top + barcode_layout.module_height + barcode_layout.text_distance
+        pil_ImageDraw.Draw(barcode_image).text(
+            (mm2px(text_xpos, dpi), mm2px(text_ypos, dpi)), text,
+            font=get_barcode_font(barcode_layout.font_path, font_size), fill=foreground, anchor='md')
+    if settings['barcode_border']:
+        # text can run past the sides of a short barcode, so the border goes on after it is drawn, to cut it off
+        # where the image writer would
+        barcode_image = pil_ImageOps.expand(barcode_image, border=settings['barcode_border'], fill=background)
+    return barcode_image
+
+
+def untimed_stage(stage_name):
+    # stands in for ProcessTimer.stage when nothing is being timed
+    return contextlib.nullcontext()
+
+
+def generate_barcode(input_string, settings, render_cache=None, process_timer=None):
+    # returns the finished barcode as png bytes, along with its width and height in pixels.
+    # input_string should already have been through interpret_barcode_string, so that equal codes share a cache entry
+    timed_stage = untimed_stage if process_timer is None else process_timer.stage
+    if render_cache is not None:
+        cache_key = render_cache_key(input_string, settings)
+        cached_barcode = render_cache.get(cache_key)
+        if cached_barcode is not None:
+            print_if_debug("using cached barcode image for " + input_string)
+            return cached_barcode
+    with timed_stage('barcode render'):
+        print_if_debug("generating barcode image")
+        barcode_image = render_barcode_image(input_string, settings)
+    width, height = barcode_image.size
+    with timed_stage('png encode'):
+        # rgb is what python-barcode's image writer made. the barcode is drawn in grayscale, so that is saved as it
+        # is, and bilevel cuts it to black and white without dithering, which would speckle the bars
+        png_mode = settings['barcode_png_mode']
+        if png_mode == 'rgb':
+            barcode_image = barcode_image.convert('RGB')
+        elif png_mode == 'bilevel':
+            barcode_image = barcode_image.convert('1', dither=pil_Image.Dither.NONE)
+        with io.BytesIO() as png_buffer:
+            barcode_image.save(png_buffer, format='PNG', compress_level=settings['barcode_png_compression'])
+            png_bytes = png_buffer.getvalue()
+    print_if_debug("success, barcode image is " + str(len(png_bytes)) + " bytes")
+    if render_cache is not None:
+        render_cache.put(cache_key, png_bytes, width, height)
+    return png_bytes, width, height
+
+
+def generate_barcode_svg(input_string, settings, render_cache=None):
+    # returns the barcode as svg bytes. an svg is laid out in mm, so dpi doesn't change it, and the border,
+    # which is in pixels, isn't added. svg entries in the render cache are kept apart from png ones by their key
+    if render_cache is not None:
+        cache_key = render_cache_key(input_string, settings) + ('svg',)
+        cached_barcode = render_cache.get(cache_key)
+        if cached_barcode is not None:
+            return cached_barcode[0]
+    svg_writer = SVGWriter()
+    # this leaves out the indentation python-barcode would otherwise pretty print the svg with
+    svg_writer.compress = True
+    ean = barcode.get(settings['barcode_type'], input_string, writer=svg_writer)
+    ean.default_writer_options = dict(ean.default_writer_options, **barcode_writer_options(settings))
+    svg_bytes = ean.render()
+    if render_cache is not None:
+        render_cache.put(cache_key, svg_bytes, 0, 0)
+    return svg_bytes
+
+
+def convert_barcode_png(png_bytes, settings, export_format):
+    # png is passed through as it is, pdf wraps the png in a page of the same size at the barcode dpi
+    if export_format == 'png':
+        return png_bytes
+    with pil_Image.open(io.BytesIO(png_bytes)) as barcode_image, io.BytesIO() as pdf_buffer:
+        barcode_image.save(pdf_buffer, format='PDF', resolution=settings['barcode_dpi'])
+        return pdf_buffer.getvalue()
+
+
+def generate_barcode_file(input_string, settings, export_format, render_cache=None):
+    # returns the contents of a file of the barcode in one of barcode_export_formats
+    if export_format == 'svg':
+        return generate_barcode_svg(input_string, settings, render_cache)
+    png_bytes, _, _ = generate_barcode(input_string, settings, render_cache)
+    return convert_barcode_png(png_bytes, settings, export_format)
+
+
+def save_barcode_file(png_bytes, tempdir):
+    # writes a copy of a barcode image into tempdir, for when the barcode files are being kept around
+    with tempfile.NamedTemporaryFile(dir=tempdir, suffix='.png', delete=False) as barcode_file:
+        barcode_file.write(png_bytes)
+    print_if_debug("barcode image saved as: " + barcode_file.name)
+    return barcode_file.name
+
+
+class BarcodeImage(OpenPyXlImage):
+    # this is an openpyxl image that keeps its png data in memory.
+    # the stock image class reopens its source when the workbook is saved, and closes it afterwards,
+    # so it can't be handed an in-memory stream if the workbook gets saved more than once.
+    # no file handles are held per image either, so the workbook only needs saving once, at the end.
+    # images given the same media_path share one file in the saved workbook, see BarcodeExcelWriter.
+    # barcode_value is the value the image encodes, it is written as the picture's description, where updating
+    # the workbook later finds it. png_bytes can be None for an image whose media_path is in image_store
+    def __init__(self, png_bytes, width, height, media_path=None, barcode_value=None, image_store=None):
+        self.ref = None
+        self.png_bytes = png_bytes
+        self.image_store = image_store
+        self.width = width
+        self.height = height
+        self.format = 'png'
+        self.media_path = media_path
+        self.barcode_value = barcode_value
+
+    def _data(self):
+        if self.png_bytes is None:
+            return self.image_store.read(self.media_path)
+        return self.png_bytes
+
+    @property
+    def path(self):
+        if self.media_path is None:
+            return super().path
+        return self.media_path
+
+
+def read_image_data(img):
+    # openpyxl keeps the images of a loaded workbook in memory streams, and closes the stream once the image has been
+    # written, so a loaded workbook with images in couldn't be saved twice. this reads them without closing anything
+    if isinstance(img.ref, io.BytesIO) and img.format in ('gif', 'jpeg', 'png'):
+        return img.ref.getvalue()
+    return img._data()
+
+
+class BarcodeSpreadsheetDrawing(SpreadsheetDrawing):
+    # openpyxl describes every picture it writes as "Picture", this describes barcode images with their value.
+    # openpyxl's serialisable classes only write the elements and attributes a class lists itself
+    __attrs__ = SpreadsheetDrawing.__attrs__
+    __nested__ = SpreadsheetDrawing.__nested__
+    __elements__ = SpreadsheetDrawing.__elements__
+
+    def _picture_frame(self, idx):
+        picture_frame = super()._picture_frame(idx)
+        # idx counts the charts first, then the images, from 1
+        barcode_value = getattr(self.images[idx - len(self.charts) - 1], 'barcode_value', None)
+        if barcode_value is not None:
+            picture_frame.nvPicPr.cNvPr.descr = barcode_value
+        return picture_frame
+
+
+# how much of a workbook's barcode media is held in memory before the rest goes to a temporary file, by default
+default_image_memory_budget = 256 * 1024 * 1024
+
+
+class BarcodeImageStore():
+    # holds the media files of a workbook until it is saved. files are appended to one in memory buffer until it
+    # holds memory_budget bytes, after that they go on the end of a single unnamed temporary file, which is memory
+    # mapped to read them back. only where each file is kept is held per file, so memory use stays about the same
+    # however many barcodes there are
+    def __init__(self, memory_budget=default_image_memory_budget):
+        self.memory_budget = memory_budget
+        self.memory_buffer = bytearray()
+        self.spill_file = None
+        self.spill_map = None
+        self.spilled_bytes = 0
+        # {media path: (whether it is in the spill file, offset, length)}, in the order they were added
+        self.media_positions = collections.OrderedDict()
+
+    def __contains__(self, media_path):
+        return media_path in self.media_positions
+
+    @property
+    def memory_bytes(self):
+        return len(self.memory_buffer)
+
+    @property
+    def total_bytes(self):
+        return len(self.memory_buffer) + self.spilled_bytes
+
+    def add(self, media_path, png_bytes):
+        if len(self.memory_buffer) + len(png_bytes) <= self.memory_budget:
+            self.media_positions[media_path] = (False, len(self.memory_buffer), len(png_bytes))
+            self.memory_buffer += png_bytes
+            return
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+        if self.spill_map is not None:
+            # windows won't grow a file that is mapped, it is mapped again when it is next read
+            self.spill_map.close()
+            self.spill_map = None
+        self.spill_file.write(png_bytes)
+        self.media_positions[media_path] = (True, self.spilled_bytes, len(png_bytes))
+        self.spilled_bytes += len(png_bytes)
+
+    def read(self, media_path):
+        spilled, media_offset, media_length = self.media_positions[media_path]
+        if not spilled:
+            return bytes(self.memory_buffer[media_offset:media_offset + media_length])
+        if self.spill_map is None:
+            self.spill_file.flush()
+            self.spill_map = mmap.mmap(self.spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.spill_map[media_offset:media_offset + media_length]
+
+    def items(self):
+        # yields (media path, png bytes) in the order they were added
+        for media_path in self.media_positions:
+            yield media_path, self.read(media_path)
+
+    def close(self):
+        if self.spill_map is not None:
+            self.spill_map.close()
+            self.spill_map = None
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+
+streamed_drawing_start = (
+    '<wsDr xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+    'xmlns="http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing">')
+# this is the anchor openpyxl writes for an image placed on a cell, described as BarcodeSpreadsheetDrawing does
+streamed_drawing_anchor = (
+    '<oneCellAnchor><from><col>{column}</col><colOff>0</colOff><row>{row}</row><rowOff>0</rowOff></from>'
+    '<ext cx="{width}" cy="{height}" /><pic><nvPicPr><cNvPr id="{image_id}" name="Image {image_id}" '
+    'descr={description} /><cNvPicPr /></nvPicPr><blipFill><a:blip cstate="print" r:embed="{relationship_id}" />'
+    '<a:stretch><a:fillRect /></a:stretch></blipFill><spPr><a:prstGeom prst="rect" /></spPr></pic><clientData />'
+    '</oneCellAnchor>')
+streamed_drawing_end = '</wsDr>'
+streamed_drawing_relationship = (
+    '<Relationship Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" '
+    'Target="{media_path}" Id="{relationship_id}" />')
+
+
+class StreamedBarcodeDrawing():
+    # the drawing of a streamed worksheet. openpyxl keeps an object for every image until the workbook is saved,
+    # this writes each image's anchor out to a temporary file as it is added instead, and copies the file into
+    # the workbook when it is saved. images of the same media file share one relationship
+    mime_type = SpreadsheetDrawing.mime_type
+
+    def __init__(self):
+        self.anchor_file = tempfile.TemporaryFile()
+        self.media_relationships = collections.OrderedDict()
+        self.image_count = 0
+        self._id = None
+
+    def __bool__(self):
+        return self.image_count > 0
+
+    @property
+    def path(self):
+        return '/xl/drawings/drawing{0}.xml'.format(self._id)
+
+    def add_image(self, media_path, width, height, row_number, column_index, barcode_value=None):
+        if media_path not in self.media_relationships:
+            self.media_relationships[media_path] = 'rId' + str(len(self.media_relationships) + 1)
+        self.image_count += 1
+        # pictures are described as openpyxl does, unless they have a barcode value
+        description = 'Picture' if barcode_value is None else barcode_value
+        self.anchor_file.write(streamed_drawing_anchor.format(
+            column=column_index - 1, row=row_number - 1, width=pixels_to_EMU(width), height=pixels_to_EMU(height),
+            image_id=self.image_count, relationship_id=self.media_relationships[media_path],
+            description=xml.sax.saxutils.quoteattr(description)).encode('utf8'))
+
+    def write(self, archive):
+        self.anchor_file.seek(0)
+        with archive.open(self.path[1:], 'w', force_zip64=True) as drawing_part:
+            drawing_part.write(streamed_drawing_start.encode('utf8'))
+            shutil.copyfileobj(self.anchor_file, drawing_part)
+            drawing_part.write(streamed_drawing_end.encode('utf8'))
+        archive.writestr(get_rels_path(self.path)[1:], (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' +
+            ''.join(streamed_drawing_relationship.format(media_path=media_path, relationship_id=relationship_id)
+                    for media_path, relationship_id in self.media_relationships.items()) +
+            '</Relationships>').encode('utf8'))
+
+    def close(self):
+        self.anchor_file.close()
+
+
+class BarcodeExcelWriter(ExcelWriter):
+    # openpyxl writes a media file for every image, even when several images point at the same path.
+    # this only writes each path once, so every row showing the same barcode shares one file.
+    # it also writes the streamed drawings and image stores of workbooks made by do_process_workbook_streaming
+    def __init__(self, workbook, archive):
+        super().__init__(workbook, archive)
+        # drawings made here for sheets of barcodes, closed once the workbook is written
+        self.barcode_drawings = []
+
+    def save(self):
+        try:
+            super().save()
+        finally:
+            for barcode_drawing in self.barcode_drawings:
+                barcode_drawing.close()
+
+    def write_worksheet(self, ws):
+        super().write_worksheet(ws)
+        streamed_drawing = getattr(ws, 'streamed_barcode_drawing', None)
+        if streamed_drawing:
+            ws._drawing = streamed_drawing
+        elif ws._images and not ws._charts and all(
+                isinstance(img, BarcodeImage) and img.media_path is not None and isinstance(img.anchor, str)
+                for img in ws._images):
+            # a sheet with nothing but barcodes on has its drawing written out as a streamed sheet's is, which is
+            # much quicker than having openpyxl build and serialise its objects for every image
+            ws._drawing = StreamedBarcodeDrawing()
+            self.barcode_drawings.append(ws._drawing)
+            for img in ws._images:
+                row_number, column_index = openpyxl.utils.cell.coordinate_to_tuple(img.anchor)
+                ws._drawing.add_image(img.path, img.width, img.height, row_number, column_index, img.barcode_value)
+            # their media files are written with the rest
+            self._images.extend(ws._images)
+        else:
+            ws._drawing = BarcodeSpreadsheetDrawing()
+            ws._drawing.charts = ws._charts
+            ws._drawing.images = ws._images
+
+    def _write_drawing(self, drawing):
+        if not isinstance(drawing, StreamedBarcodeDrawing):
+            return super()._write_drawing(drawing)
+        self._drawings.append(drawing)
+        drawing._id = len(self._drawings)
+        drawing.write(self._archive)
+        self.manifest.append(drawing)
+
+    def _write_images(self):
+        written_media_paths = set()
+        for img in self._images:
+            if img.path not in written_media_paths:
+                written_media_paths.add(img.path)
+                self._archive.writestr(img.path[1:], read_image_data(img))
+        image_store = getattr(self.workbook, 'barcode_image_store', None)
+        if image_store is not None:
+            for media_path, png_bytes in image_store.items():
+                self._archive.writestr(media_path[1:], png_bytes)
+
+
+def is_workbook_path(workbook_location):
+    return isinstance(workbook_location, (str, os.PathLike))
+
+
+def open_workbook(workbook_source, read_only=False):
+    # workbook_source can be a path, a binary file object, or an openpyxl workbook, which is handed back as it is
+    if isinstance(workbook_source, openpyxl.Workbook):
+        return workbook_source
+    if not is_workbook_path(workbook_source):
+        workbook_source.seek(0)
+    return openpyxl.load_workbook(workbook_source, read_only=read_only)
+
+
+class BarcodeDrawingArchive(zipfile.ZipFile):
+    # a workbook archive that hands back the parts in replaced_parts in place of what the archive holds
+    def __init__(self, file):
+        super().__init__(file)
+        self.replaced_parts = {}
+
+    def read(self, name, pwd=None):
+        if name in self.replaced_parts:
+            return self.replaced_parts[name]
+        return super().read(name, pwd)
+
+
+drawing_namespaces = {
+    'xdr': 'http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing',
+    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+    'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+}
+
+
+class BarcodeWorkbookReader(ExcelReader):
+    # loads a workbook for do_update_workbook. openpyxl makes an object of its own for every image it loads, and
+    # looks each one's relationship up from the start of the list, which takes longer than rendering them again
+    # once there are thousands. the images in the output column of the barcode sheets are taken out of the drawings
+    # openpyxl is given, and kept in barcode_images as BarcodeImages, described as they were
+    def __init__(self, workbook_source, barcode_sheet_names, output_column):
+        super().__init__(workbook_source)
+        # the archive is reopened as one that the trimmed drawings can be handed out from
+        self.archive.close()
+        self.archive = BarcodeDrawingArchive(workbook_source)
+        self.barcode_sheet_names = barcode_sheet_names
+        self.output_column = output_column
+        # {sheet name: [BarcodeImage]}, filled in while the worksheets are read
+        self.barcode_images = {}
+        self.media_png_bytes = {}
+
+    def take_barcode_anchors(self, drawing_path):
+        # takes the output column's picture anchors out of a drawing, returns the BarcodeImages they showed
+        drawing_tree = xml.etree.ElementTree.fromstring(self.archive.read(drawing_path))
+        drawing_rels_path = get_rels_path(drawing_path)
+        media_targets = {}
+        if drawing_rels_path in self.valid_files:
+            media_targets = {rel.Id: rel.target for rel in get_dependents(self.archive, drawing_rels_path)}
+        output_column_index = openpyxl.utils.column_index_from_string(self.output_column)
+        barcode_images = []
+        for anchor in drawing_tree.findall('xdr:oneCellAnchor', drawing_namespaces) + \
+                drawing_tree.findall('xdr:twoCellAnchor', drawing_namespaces):
+            blip = anchor.find('xdr:pic/xdr:blipFill/a:blip', drawing_namespaces)
+            if blip is None or int(anchor.findtext('xdr:from/xdr:col', '-1', drawing_namespaces)) != \
+                    output_column_index - 1:
+                continue
+            media_path = media_targets.get(blip.get('{' + drawing_namespaces['r'] + '}embed'))
+            if media_path is None:
+                continue
+            if media_path not in self.media_png_bytes:
+                self.media_png_bytes[media_path] = self.archive.read(media_path)
+            png_bytes = self.media_png_bytes[media_path]
+            # the size is the one the image is shown at, which is what it would be given again
+            extent = anchor.find('xdr:ext', drawing_namespaces)
+            if extent is None:
+                width, height = pil_Image.open(io.BytesIO(png_bytes)).size
+            else:
+                width, height = EMU_to_pixels(int(extent.get('cx'))), EMU_to_pixels(int(extent.get('cy')))
+            picture_properties = anchor.find('xdr:pic/xdr:nvPicPr/xdr:cNvPr', drawing_namespaces)
+            img = BarcodeImage(png_bytes, width, height, barcode_value=picture_properties.get('descr'))
+            row_index = int(anchor.findtext('xdr:from/xdr:row', None, drawing_namespaces))
+            img.anchor = self.output_column + str(row_index + 1)
+            barcode_images.append(img)
+            drawing_tree.remove(anchor)
+        if barcode_images:
+            self.archive.replaced_parts[drawing_path] = xml.etree.ElementTree.tostring(drawing_tree)
+        return barcode_images
+
+    def read_worksheets(self):
+        for sheet, rel in self.parser.find_sheets():
+            sheet_rels_path = get_rels_path(rel.target)
+            if sheet.name not in self.barcode_sheet_names or sheet_rels_path not in self.valid_files:
+                continue
+            self.barcode_images[sheet.name] = []
+            for drawing_rel in get_dependents(self.archive, sheet_rels_path).find(SpreadsheetDrawing._rel_type):
+                self.barcode_images[sheet.name].extend(self.take_barcode_anchors(drawing_rel.target))
+        super().read_worksheets()
+
+
+def open_workbook_for_update(workbook_source, barcode_sheet_names, output_column):
+    # opens a workbook like open_workbook with BarcodeWorkbookReader. returns the workbook, and the images taken out
+    # of each of barcode_sheet_names, {sheet name: [BarcodeImage]}. an openpyxl workbook is handed back as it is,
+    # with its images left where they are
+    if isinstance(workbook_source, openpyxl.Workbook):
+        return workbook_source, {}
+    if not is_workbook_path(workbook_source):
+        workbook_source.seek(0)
+    workbook_reader = BarcodeWorkbookReader(workbook_source, barcode_sheet_names, output_column)
+    workbook_reader.read()
+    return workbook_reader.wb, workbook_reader.barcode_images
+
+
+def save_workbook(wb, workbook_path):
+    # this is wb.save(), using BarcodeExcelWriter. workbook_path can also be a binary file object, which is
+    # overwritten from the start
+    if not is_workbook_path(workbook_path):
+        workbook_path.seek(0)
+        workbook_path.truncate()
+    archive = zipfile.ZipFile(workbook_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    wb.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    BarcodeExcelWriter(wb, archive).save()
+
+
+def get_barcode_font_text(input_string, barcode_type):
+    # returns the cell text that a code 39 barcode font draws as the barcode for input_string.
+    # the check character is included, so that the bars match the image barcodes.
+    # code 39 is the only type whose fonts draw plain text, the others need per font encoding
+    if barcode_type != 'code39':
+        raise ValueError("Barcode fonts can only be used with code39 barcodes")
+    return '*' + barcode.get(barcode_type, input_string).get_fullcode() + '*'
+
+
+# padding rules for the numeric barcode types, as (pad to the left when shorter than, left pad length,
+# longest value accepted, right pad length). without padding, values have to be exactly the longest length
+numeric_barcode_padding = {
+    'ean8': (6, 6, 7, 7),
+    'ean13': (11, 11, 12, 12),
+    'UPC': (10, 11, 11, 12),
+}
+integer_barcode_types = ('ean8', 'ean13')
+integer_pattern = re.compile('[0-9]+')
+code39_invalid_characters_pattern = re.compile(r'[^A-Z0-9./*$%+\- ]+')
+
+# error codes from the barcode value checks, and the message each one stands for
+barcode_value_error_messages = {
+    'empty': "Input is empty",
+    'not_integer': "Input contents are not an integer",
+    'too_long': "Input contents are more than {length} characters",
+    'wrong_length': "Input contents are not {length} characters",
+    'render_failed': "Barcode could not be rendered",
+}
+
+
+def barcode_value_error_message(error_code, barcode_type):
+    length = numeric_barcode_padding.get(barcode_type, (None, None, None, None))[2]
+    return barcode_value_error_messages[error_code].format(length=length)
+
+
+def get_barcode_value_normalizer(barcode_type, pad_ean):
+    # returns a function that turns one value into (normalized value, None), or (None, error code) if the
+    # value can't be used. all the choices that depend on the settings are made here, once, instead of per value
+    if barcode_type == "code39":
+        def normalize_code39_value(upc_barcode_string):
+            if upc_barcode_string == '':
+                return None, 'empty'
+            return code39_invalid_characters_pattern.sub(' ', upc_barcode_string.upper()), None
+        return normalize_code39_value
+
+    left_pad_below, left_pad_length, longest_length, right_pad_length = numeric_barcode_padding[barcode_type]
+    check_integer = barcode_type in integer_barcode_types
+
+    def normalize_numeric_value(upc_barcode_string):
+        if upc_barcode_string == '':
+            return None, 'empty'
+        if check_integer and integer_pattern.fullmatch(upc_barcode_string) is None:
+            return None, 'not_integer'
+        if pad_ean is True:
+            if len(upc_barcode_string) < left_pad_below:
+                upc_barcode_string = upc_barcode_string.rjust(left_pad_length, '0')
+            if len(upc_barcode_string) > longest_length:
+                return None, 'too_long'
+            return upc_barcode_string.ljust(right_pad_length, '0'), None
+        if len(upc_barcode_string) != longest_length:
+            return None, 'wrong_length'
+        return upc_barcode_string, None
+    return normalize_numeric_value
+
+
+def interpret_barcode_string(upc_barcode_string, barcode_type, pad_ean):
+    normalized_barcode_string, error_code = get_barcode_value_normalizer(barcode_type, pad_ean)(upc_barcode_string)
+    if error_code is not None:
+        raise ValueError(barcode_value_error_message(error_code, barcode_type))
+    return normalized_barcode_string
+
+
+def normalize_barcode_column(cell_values, barcode_type, pad_ean):
+    # checks a whole column of raw cell values in one pass.
+    # returns a list of normalized values and a list of error codes, each with None for rows that are in the other
+    normalize_value = get_barcode_value_normalizer(barcode_type, pad_ean)
+    normalized_values = []
+    error_codes = []
+    for cell_value in cell_values:
+        normalized_value, error_code = normalize_value('' if cell_value is None else str(cell_value))
+        normalized_values.append(normalized_value)
+        error_codes.append(error_code)
+    return normalized_values, error_codes
+
+
+def summarize_barcode_errors(error_codes):
+    # counts the rows with each error code, rows without errors aren't counted
+    return dict(collections.Counter(error_code for error_code in error_codes if error_code is not None))
+
+
+def describe_barcode_errors(error_counts, barcode_type):
+    return ", ".join(barcode_value_error_message(error_code, barcode_type) + ": " + str(error_count)
+                     for error_code, error_count in error_counts.items())
+
+
+def new_error_row(sheet_name, row_number, cell_value, error_code, barcode_type):
+    return {'sheet': sheet_name, 'row': row_number, 'value': cell_value, 'error': error_code,
+            'message': barcode_value_error_message(error_code, barcode_type)}
+
+
+error_report_fields = ['sheet', 'row', 'value', 'error', 'message']
+
+
+def write_error_report(report_path, error_rows, error_counts):
+    # writes out the rows that would be skipped, each with its sheet, row number, cell value, error code and error
+    # message. the report is json if the file name ends in .json, with the count of each error code alongside the
+    # rows, and csv otherwise
+    if report_path.lower().endswith('.json'):
+        with open(report_path, 'w', encoding='utf8') as report_file:
+            # cell values that json has no type for, such as dates, are written as text
+            json.dump({'errors': error_counts, 'rows': error_rows}, report_file, indent=4, default=str)
+    else:
+        with open(report_path, 'w', encoding='utf8', newline='') as report_file:
+            report_writer = csv.DictWriter(report_file, fieldnames=error_report_fields)
+            report_writer.writeheader()
+            report_writer.writerows(error_rows)
+
+
+def read_barcode_column(ws, input_column):
+    # yields (row number, cell value) for every row of the input column on a read only worksheet.
+    # only the rows being streamed past are ever held in memory
+    input_column_index = openpyxl.utils.column_index_from_string(input_column)
+    column_values = ws.iter_rows(min_row=1, min_col=input_column_index, max_col=input_column_index,
+                                 values_only=True)
+    for row_number, (cell_value,) in enumerate(column_values, start=1):
+        yield row_number, cell_value
+
+
+def read_sheet_barcode_values(ws, sheet_name, settings, progress_callback, keep_alive_callback, process_timer,
+                              error_rows=None):
+    # reads and checks the input column of a read only worksheet. invalid values are reported straight away, so that
+    # a sheet full of bad values shows up before anything is rendered.
+    # returns the normalized values, one per row with None for rows that can't be used, and the count of each error.
+    # if error_rows is a list, each invalid row is added to it, as described at write_error_report
+    cell_values = []
+    with process_timer.stage('read values'):
+        for _, cell_value in read_barcode_column(ws, settings['input_data_column']):
+            if not keep_alive_callback():
+                break
+            cell_values.append(cell_value)
+    with process_timer.stage('normalize'):
+        normalized_values, error_codes = normalize_barcode_column(cell_values, settings['barcode_type'],
+                                                                  settings['pad_ean_barcodes'])
+    error_counts = summarize_barcode_errors(error_codes)
+    if error_rows is not None:
+        error_rows.extend(new_error_row(sheet_name, row_number, cell_value, error_code, settings['barcode_type'])
+                          for row_number, (cell_value, error_code) in enumerate(zip(cell_values, error_codes), start=1)
+                          if error_code is not None)
+    if error_counts:
+        progress_callback(sheet_name + ": " + str(sum(error_counts.values())) + " of " + str(len(cell_values)) +
+                          " rows have invalid values (" +
+                          describe_barcode_errors(error_counts, settings['barcode_type']) + ")")
+    return normalized_values, error_counts
+
+
+def select_worksheets(sheet_names, sheet_selection):
+    # sheet_selection is None for the first sheet, 'all', or a list of sheet names or 1 based sheet numbers.
+    # returns the names of the selected sheets in workbook order
+    if sheet_selection is None:
+        return sheet_names[:1]
+    if sheet_selection == 'all':
+        return list(sheet_names)
+    selected_sheet_names = set()
+    for sheet in sheet_selection:
+        if sheet in sheet_names:
+            selected_sheet_names.add(sheet)
+        elif str(sheet).isdigit() and 1 <= int(sheet) <= len(sheet_names):
+            selected_sheet_names.add(sheet_names[int(sheet) - 1])
+        else:
+            raise ValueError("Workbook has no sheet " + str(sheet))
+    return [sheet_name for sheet_name in sheet_names if sheet_name in selected_sheet_names]
+
+
+def render_barcode_batch(input_strings, settings):
+    # this runs in a worker process. failures are handed back in place of the image, so that one bad code
+    # doesn't lose the rest of the batch
+    rendered_barcodes = []
+    for input_string in input_strings:
+        try:
+            rendered_barcodes.append(generate_barcode(input_string, settings))
+        except Exception as barcode_error:
+            rendered_barcodes.append(barcode_error)
+    return rendered_barcodes
+
+
+def get_render_process_context():
+    # worker processes have to be forked, a spawned worker would re-run main.py from the top.
+    # returns None where fork isn't available (windows), which means rendering in this process instead.
+    # multiprocessing and concurrent.futures are only imported by the code that makes a pool
+    import multiprocessing
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+# the most barcodes rendered on the render processes ahead of the one being inserted. once this many are queued or
+# waiting to be taken, the workers are held back until the inserter catches up, which keeps the rendered images in
+# memory to about this many however big the workbook is
+render_queue_size = 4096
+
+
+class BarcodeRenderPipeline():
+    # renders the distinct values of barcode_rows on a process pool, in batches, and hands every row back in order
+    # as (row number, (png bytes, width, height)), or the exception if it couldn't be rendered. batches are only
+    # submitted while fewer than render_queue_size barcodes are queued or waiting to be taken, the rest go in as the
+    # inserter takes them. rendering starts when the pipeline is made.
+    # each time a batch has all been taken, the barcodes that are queued for or being rendered by the workers, and
+    # those rendered and waiting for the inserter, are sampled into process_timer as the render and insert queues
+    def __init__(self, barcode_rows, settings, render_cache, render_workers, render_process_context,
+                 process_timer=None):
+        self.barcode_rows = iter(barcode_rows)
+        self.settings = settings
+        self.render_cache = render_cache
+        self.process_timer = process_timer
+        self.timed_stage = untimed_stage if process_timer is None else process_timer.stage
+        self.values_to_render = []
+        values_seen = set()
+        for _, input_string in barcode_rows:
+            if input_string not in values_seen:
+                values_seen.add(input_string)
+                if render_cache_key(input_string, settings) not in render_cache:
+                    self.values_to_render.append(input_string)
+        # small batches keep every worker busy, while still cutting down on the back and forth between processes
+        self.batch_size = max(1, min(64, len(self.values_to_render) // (render_workers * 4)))
+        # every worker has a batch to be getting on with, and one more waiting, however small the queue
+        self.queued_batch_limit = max(render_workers * 2, render_queue_size // self.batch_size)
+        print_if_debug("rendering " + str(len(self.values_to_render)) + " barcodes with " + str(render_workers) +
+                       " workers in batches of " + str(self.batch_size))
+        # {value: (batch future, index in the batch)} for values submitted and not yet taken
+        self.pending_barcodes = {}
+        # {batch future: values of the batch not yet taken}, in the order they were submitted
+        self.queued_batches = collections.OrderedDict()
+        # values that failed to render keep their exception, for repeats of them further down
+        self.failed_barcodes = {}
+        self.next_batch_start = 0
+        import concurrent.futures
+        self.render_pool = concurrent.futures.ProcessPoolExecutor(max_workers=render_workers,
+                                                                  mp_context=render_process_context)
+        self.submit_batches()
+
+    def submit_batches(self):
+        while len(self.queued_batches) < self.queued_batch_limit and \
+                self.next_batch_start < len(self.values_to_render):
+            batch = self.values_to_render[self.next_batch_start:self.next_batch_start + self.batch_size]
+            self.next_batch_start += len(batch)
+            batch_future = self.render_pool.submit(render_barcode_batch, batch, self.settings)
+            for batch_index, input_string in enumerate(batch):
+                self.pending_barcodes[input_string] = (batch_future, batch_index)
+            self.queued_batches[batch_future] = len(batch)
+
+    def sample_queue_depths(self):
+        if self.process_timer is None:
+            return
+        rendering_count = 0
+        rendered_count = 0
+        for batch_future, untaken_count in self.queued_batches.items():
+            if batch_future.done():
+                rendered_count += untaken_count
+            else:
+                rendering_count += untaken_count
+        self.process_timer.queue_depth('render queue', rendering_count)
+        self.process_timer.queue_depth('insert queue', rendered_count)
+
+    def take_barcode(self, input_string):
+        # takes a value's rendered barcode out of its batch, and submits more once the batch is used up
+        batch_future, batch_index = self.pending_barcodes.pop(input_string)
+        with self.timed_stage('render pool wait'):
+            rendered_barcode = batch_future.result()[batch_index]
+        self.queued_batches[batch_future] -= 1
+        if self.queued_batches[batch_future] == 0:
+            del self.queued_batches[batch_future]
+            self.sample_queue_depths()
+            self.submit_batches()
+        return rendered_barcode
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row_number, input_string = next(self.barcode_rows)
+        if input_string in self.pending_barcodes:
+            rendered_barcode = self.take_barcode(input_string)
+            if isinstance(rendered_barcode, Exception):
+                self.failed_barcodes[input_string] = rendered_barcode
+                return row_number, rendered_barcode
+            # from here on, repeats of this value come out of the render cache
+            self.render_cache.put(render_cache_key(input_string, self.settings), *rendered_barcode)
+            return row_number, rendered_barcode
+        if input_string in self.failed_barcodes:
+            return row_number, self.failed_barcodes[input_string]
+        try:
+            return row_number, generate_barcode(input_string, self.settings, self.render_cache, self.process_timer)
+        except Exception as barcode_error:
+            return row_number, barcode_error
+
+    def close(self):
+        # when processing is cancelled, batches that haven't started yet are dropped instead of waited on
+        self.render_pool.shutdown(wait=True, cancel_futures=True)
+
+
+def render_barcodes_in_order_here(barcode_rows, settings, render_cache, process_timer=None):
+    # render_barcodes_in_row_order without worker processes, each row is rendered as it is asked for
+    for row_number, input_string in barcode_rows:
+        try:
+            yield row_number, generate_barcode(input_string, settings, render_cache, process_timer)
+        except Exception as barcode_error:
+            yield row_number, barcode_error
+
+
+def render_barcodes_in_row_order(barcode_rows, settings, render_cache, render_workers=1, process_timer=None):
+    # returns an iterator of (row number, (png bytes, width, height)) for each of barcode_rows, in order, which has
+    # to be closed once it is done with. row numbers can be anything that tells the rows apart.
+    # rows that fail to render give the exception instead of the image.
+    # rendering in this process is timed stage by stage, rendering in the pool only as the time spent waiting on it.
+    # with more than one render worker, every distinct value that isn't already cached is rendered once by a
+    # BarcodeRenderPipeline, results are put into the render cache as they are handed back
+    render_process_context = get_render_process_context()
+    if render_workers <= 1 or render_process_context is None:
+        return render_barcodes_in_order_here(barcode_rows, settings, render_cache, process_timer)
+    return BarcodeRenderPipeline(barcode_rows, settings, render_cache, render_workers, render_process_context,
+                                 process_timer)
+
+
+def no_progress(text, value=None, maximum=None):
+    # default progress callback, does nothing.
+    # callbacks get a status text, and either a value and maximum, or None for both when the length of the
+    # current step is unknown
+    pass
+
+
+def always_keep_alive():
+    return True
+
+
+def layout_barcode_rows(barcode_rows, settings):
+    # works out how a sheet's barcode images will be laid out before any of them are rendered. returns the output
+    # column width, which fits the widest barcode, the height of each row that gets a barcode, and how many of the
+    # images are of each size. a value that can't be laid out can't be rendered either, so its row is left out
+    row_heights = {}
+    image_sizes = collections.Counter()
+    for row_number, upc_barcode_string in barcode_rows:
+        try:
+            width, height = get_barcode_geometry(upc_barcode_string, settings)
+        except Exception as layout_error:
+            print_if_debug(layout_error)
+            continue
+        row_heights[row_number] = int(math.ceil(float(height) * .75))
+        image_sizes[(width, height)] += 1
+    column_width = None
+    if image_sizes:
+        column_width = int(math.ceil(float(max(width for width, _ in image_sizes)) * .15))
+    return column_width, row_heights, image_sizes
+
+
+def layout_barcode_font_text(barcode_rows, settings):
+    # the font output mode's version of layout_barcode_rows, returns the output column width, which fits the longest
+    # text, and each row's text, or the exception getting it raised
+    font_texts = {}
+    for row_number, upc_barcode_string in barcode_rows:
+        try:
+            font_texts[row_number] = get_barcode_font_text(upc_barcode_string, settings['barcode_type'])
+        except Exception as barcode_error:
+            font_texts[row_number] = barcode_error
+    longest_text_length = max([len(font_text) for font_text in font_texts.values() if isinstance(font_text, str)],
+                              default=0)
+    column_width = None
+    if longest_text_length:
+        # code 39 font characters are roughly as wide as their point size, a column width unit is about 7 points
+        column_width = int(math.ceil(longest_text_length * settings['barcode_font_point_size'] / 7))
+    return column_width, font_texts
+
+
+def set_barcode_row_heights(ws, row_numbers, row_heights):
+    # row heights are set together once their rows have barcodes in, rather than one at a time as the images go in
+    for row_number in row_numbers:
+        ws.row_dimensions[row_number].height = row_heights[row_number]
+    row_numbers.clear()
+
+
+def insert_barcode_font_text(ws, barcode_rows, settings, sheet_stats, progress_callback=no_progress,
+                             keep_alive_callback=always_keep_alive, progress_prefix=""):
+    # the font output mode puts the barcode in as text, set in a barcode font, instead of as an image
+    output_column = settings['barcode_output_column']
+    barcode_font = Font(name=settings['barcode_font_name'], size=settings['barcode_font_point_size'])
+    column_width, font_texts = layout_barcode_font_text(barcode_rows, settings)
+    sheet_max_row = ws.max_row
+    for row_number, _ in barcode_rows:
+        if not keep_alive_callback():
+            break
+        progress_callback(progress_prefix + str(row_number) + "/" + str(sheet_max_row), row_number, sheet_max_row)
+        barcode_font_text = font_texts[row_number]
+        if isinstance(barcode_font_text, Exception):
+            sheet_stats['invalid'] += 1
+            sheet_stats['errors']['render_failed'] = sheet_stats['errors'].get('render_failed', 0) + 1
+            print_if_debug(barcode_font_text)
+            continue
+        output_cell = ws[output_column + str(row_number)]
+        output_cell.value = barcode_font_text
+        output_cell.font = barcode_font
+        ws.row_dimensions[row_number].height = int(math.ceil(settings['barcode_font_point_size'] * 1.25))
+        sheet_stats['inserted'] += 1
+    if column_width is not None:
+        ws.column_dimensions[output_column].width = column_width
+
+
+# a checkpoint manifest sits next to an output workbook, and records which rows of it have been processed, a hash of
+# the value each of those rows held, and which media file in the workbook holds the image for each value.
+# processing into the same output again reads the images for values it has already seen back out of the workbook
+# instead of rendering them again, so a cancelled run picks up where it stopped, and a rerun after a few rows of the
+# input changed only renders those rows
+checkpoint_manifest_version = 1
+
+
+def checkpoint_manifest_path(workbook_path):
+    return os.fspath(workbook_path) + '.checkpoint.json'
+
+
+def checkpoint_hash(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def barcode_value_hash(normalized_value):
+    # invalid rows are recorded too, with the hash of an empty value
+    return checkpoint_hash(('' if normalized_value is None else normalized_value).encode('utf8'))
+
+
+def checkpoint_settings_key(settings):
+    # everything except the value that changes what a barcode image looks like
+    return list(render_cache_key('', settings)[1:])
+
+
+def read_checkpoint_manifest(workbook_path, settings):
+    # returns the manifest for workbook_path, or None if there isn't one usable with these settings
+    try:
+        with open(checkpoint_manifest_path(workbook_path), encoding='utf8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('version') != checkpoint_manifest_version:
+        print_if_debug("ignoring checkpoint manifest for " + os.fspath(workbook_path) +
+                       " from a different version")
+        return None
+    if manifest.get('settings') != checkpoint_settings_key(settings):
+        print_if_debug("ignoring checkpoint manifest for " + os.fspath(workbook_path) +
+                       ", the barcode settings have changed")
+        return None
+    return manifest
+
+
+def load_checkpoint_barcodes(workbook_path, manifest, normalized_values):
+    # returns {value: (png bytes, width, height)} for each of normalized_values that the manifest has an image for.
+    # images that are missing from the workbook, or don't match the hash they were recorded with, are left out
+    # to be rendered again
+    checkpoint_barcodes = {}
+    try:
+        with zipfile.ZipFile(workbook_path) as archive:
+            for normalized_value in normalized_values:
+                media_entry = manifest['media'].get(barcode_value_hash(normalized_value))
+                if media_entry is None:
+                    continue
+                try:
+                    png_bytes = archive.read(media_entry['path'][1:])
+                except KeyError:
+                    continue
+                if checkpoint_hash(png_bytes) == media_entry['hash']:
+                    checkpoint_barcodes[normalized_value] = (png_bytes, media_entry['width'], media_entry['height'])
+    except (OSError, zipfile.BadZipFile) as checkpoint_error:
+        print_if_debug("could not read checkpoint images from " + os.fspath(workbook_path) + ": " +
+                       str(checkpoint_error))
+        return {}
+    return checkpoint_barcodes
+
+
+def count_unchanged_rows(manifest_sheet, value_hashes):
+    # counts the rows of a sheet that were processed before, and still hold the same value
+    unchanged_count = 0
+    hash_index = 0
+    for first_row, last_row in manifest_sheet['ranges']:
+        for row_number in range(first_row, last_row + 1):
+            if row_number <= len(value_hashes) and \
+                    manifest_sheet['hashes'][hash_index] == value_hashes[row_number - 1]:
+                unchanged_count += 1
+            hash_index += 1
+    return unchanged_count
+
+
+def write_checkpoint_manifest(workbook_path, settings, sheet_value_hashes, processed_rows, media_entries):
+    # processed_rows has the last row done for each sheet, sheets are processed from the top down so every row
+    # up to it is done
+    manifest_sheets = {}
+    for sheet_name, last_row in processed_rows.items():
+        if last_row > 0:
+            manifest_sheets[sheet_name] = {'ranges': [[1, last_row]],
+                                           'hashes': sheet_value_hashes[sheet_name][:last_row]}
+    manifest = {'version': checkpoint_manifest_version, 'settings': checkpoint_settings_key(settings),
+                'sheets': manifest_sheets, 'media': media_entries}
+    manifest_path = checkpoint_manifest_path(workbook_path)
+    temp_manifest_path = manifest_path + '.tmp'
+    with open(temp_manifest_path, 'w', encoding='utf8') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temp_manifest_path, manifest_path)
+
+
+def remove_checkpoint_manifest(workbook_path):
+    try:
+        os.remove(checkpoint_manifest_path(workbook_path))
+    except FileNotFoundError:
+        pass
+
+
+# the settings each sheet's barcode images were rendered with are kept in a custom document property of the workbook,
+# one per sheet. updating the workbook later only keeps the images it has if they were made with the same settings.
+# a property per sheet keeps each one short, excel doesn't show text properties past 255 characters
+barcode_settings_property_prefix = "barcode settings: "
+
+
+def read_barcode_settings_property(wb, sheet_name):
+    # returns the settings key the sheet's images were rendered with, or None if the workbook doesn't say
+    try:
+        return json.loads(wb.custom_doc_props[barcode_settings_property_prefix + sheet_name].value)
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+def write_barcode_settings_property(wb, sheet_names, settings):
+    for sheet_name in sheet_names:
+        property_name = barcode_settings_property_prefix + sheet_name
+        if property_name in wb.custom_doc_props.names:
+            del wb.custom_doc_props[property_name]
+        wb.custom_doc_props.append(StringProperty(name=property_name,
+                                                  value=json.dumps(checkpoint_settings_key(settings))))
+
+
+def finish_process_stats(process_stats, process_timer, render_cache, render_cache_hits, render_cache_misses,
+                         media_file_count, image_store, new_workbook_path):
+    # the end of every run that makes a workbook: totals the sheets' row counts, counts them in process_timer along
+    # with the render cache, media and output size, and puts its summary in process_stats under 'timing'.
+    # render_cache_hits and render_cache_misses are the cache's counts from before the run
+    row_stat_names = [stat_name for stat_name in ('rows', 'invalid', 'inserted', 'reused', 'removed')
+                      if stat_name in process_stats]
+    for sheet_stats in process_stats['sheets'].values():
+        for stat_name in row_stat_names:
+            process_stats[stat_name] += sheet_stats[stat_name]
+    for stat_name in row_stat_names:
+        process_timer.count(stat_name, process_stats[stat_name])
+    process_timer.count('render_cache_hits', render_cache.hits - render_cache_hits)
+    process_timer.count('render_cache_misses', render_cache.misses - render_cache_misses)
+    process_timer.count('media_files', media_file_count)
+    process_timer.count('media_bytes', image_store.total_bytes)
+    process_timer.count('media_bytes_spilled', image_store.spilled_bytes)
+    if new_workbook_path is None:
+        process_timer.count('bytes_written', 0)
+    elif is_workbook_path(new_workbook_path):
+        process_timer.count('bytes_written', os.path.getsize(new_workbook_path))
+    else:
+        process_timer.count('bytes_written', new_workbook_path.tell())
+    process_stats['timing'] = process_timer.summary()
+    return process_stats
+
+
+def do_process_workbook(old_workbook_path, new_workbook_path, settings, progress_callback=no_progress,
+                        keep_alive_callback=always_keep_alive, keep_barcodes_in_cwd=False, keep_barcode_files=False,
+                        launch_cwd=None, render_cache=None, render_workers=1, sheet_selection=None,
+                        process_timer=None, checkpoint=False, checkpoint_seconds=None, streaming=False,
+                        image_memory_budget=default_image_memory_budget):
+    # this processes the selected worksheets (see select_worksheets) of old_workbook_path into new_workbook_path.
+    # returns a dictionary of row counts, totalled and per sheet, and the stage timings under 'timing'.
+    # either workbook can be a path or a binary file object. old_workbook_path can also be an openpyxl workbook,
+    # which the barcodes are inserted into, and new_workbook_path can then be None to leave it unsaved.
+    # with checkpoint set, a checkpoint manifest is kept alongside new_workbook_path, and images are reused from
+    # what it says is already in there. with checkpoint_seconds as well, the workbook and manifest are saved that
+    # often while barcodes are being inserted, so that little is lost if the process dies.
+    # checkpoints only apply to the image output mode, the font output mode has nothing to render.
+    # the images' media is kept in a BarcodeImageStore, which holds up to image_memory_budget bytes of it in memory.
+    # with streaming set, do_process_workbook_streaming does the work instead
+    if streaming:
+        if checkpoint:
+            raise ValueError("Checkpoints can't be used while streaming")
+        return do_process_workbook_streaming(old_workbook_path, new_workbook_path, settings, progress_callback,
+                                             keep_alive_callback, render_cache, render_workers, sheet_selection,
+                                             process_timer, image_memory_budget)
+    if launch_cwd is None:
+        launch_cwd = os.getcwd()
+    if render_cache is None:
+        render_cache = BarcodeRenderCache()
+    if process_timer is None:
+        process_timer = ProcessTimer()
+    render_cache_hits, render_cache_misses = render_cache.hits, render_cache.misses
+    output_column = settings['barcode_output_column']
+    # barcodes are only written out to files when asked to, for looking at while debugging
+    tempdir = None
+    if keep_barcodes_in_cwd or keep_barcode_files:
+        tempdir = create_barcode_directory(keep_barcodes_in_cwd, launch_cwd)
+    process_stats = {'rows': 0, 'invalid': 0, 'inserted': 0, 'reused': 0, 'sheets': {}}
+    checkpoint = checkpoint and settings['barcode_output_mode'] == 'image'
+    if checkpoint and not is_workbook_path(new_workbook_path):
+        raise ValueError("Checkpoints need the output workbook to be a file")
+
+    # all the barcode values are read and checked first, so that they can be handed to the renderers together.
+    # only the input column is pulled out, streaming the sheets in read only mode
+    progress_callback("reading barcode values")
+    sheet_barcode_rows = {}
+    sheet_value_hashes = {}
+    with process_timer.stage('read values'):
+        read_only_wb = open_workbook(old_workbook_path, read_only=True)
+    try:
+        sheet_names = select_worksheets(read_only_wb.sheetnames, sheet_selection)
+        for sheet_name in sheet_names:
+            normalized_values, error_counts = read_sheet_barcode_values(
+                read_only_wb[sheet_name], sheet_name, settings, progress_callback, keep_alive_callback, process_timer)
+            barcode_rows = [(row_number, normalized_value) for row_number, normalized_value
+                            in enumerate(normalized_values, start=1) if normalized_value is not None]
+            sheet_stats = {'rows': len(normalized_values), 'invalid': len(normalized_values) - len(barcode_rows),
+                           'inserted': 0, 'reused': 0, 'errors': error_counts}
+            sheet_barcode_rows[sheet_name] = barcode_rows
+            process_stats['sheets'][sheet_name] = sheet_stats
+            if checkpoint:
+                sheet_value_hashes[sheet_name] = [barcode_value_hash(normalized_value) for normalized_value
+                                                  in normalized_values]
+    finally:
+        if read_only_wb is not old_workbook_path:
+            read_only_wb.close()
+
+    # images from the last run are read out before the test save below overwrites the workbook they are in
+    checkpoint_barcodes = {}
+    if checkpoint:
+        manifest = read_checkpoint_manifest(new_workbook_path, settings)
+        if manifest is not None:
+            progress_callback("reading checkpoint")
+            with process_timer.stage('read checkpoint'):
+                checkpoint_barcodes = load_checkpoint_barcodes(new_workbook_path, manifest, set(
+                    normalized_value for barcode_rows in sheet_barcode_rows.values()
+                    for _, normalized_value in barcode_rows))
+            unchanged_rows = sum(count_unchanged_rows(manifest['sheets'][sheet_name], value_hashes)
+                                 for sheet_name, value_hashes in sheet_value_hashes.items()
+                                 if sheet_name in manifest['sheets'])
+            progress_callback("resuming from checkpoint, " + str(unchanged_rows) + " rows are unchanged, " +
+                              str(len(checkpoint_barcodes)) + " barcodes don't need rendering")
+        # the manifest would be describing a workbook that isn't there any more
+        remove_checkpoint_manifest(new_workbook_path)
+
+    # the rows of every sheet are rendered through one pipeline, which the render processes start on straight away,
+    # so that they are rendering while the workbook is loaded. rows with an image in the checkpoint skip it
+    rows_to_render = []
+    if settings['barcode_output_mode'] == 'image':
+        rows_to_render = [((sheet_name, row_number), upc_barcode_string) for sheet_name in sheet_names
+                          for row_number, upc_barcode_string in sheet_barcode_rows[sheet_name]
+                          if upc_barcode_string not in checkpoint_barcodes]
+    rendered_barcodes = render_barcodes_in_row_order(rows_to_render, settings, render_cache, render_workers,
+                                                     process_timer)
+    try:
+        progress_callback("opening workbook")
+        with process_timer.stage('load workbook'):
+            wb = open_workbook(old_workbook_path)
+        if settings['barcode_output_mode'] == 'image':
+            write_barcode_settings_property(wb, sheet_names, settings)
+        if new_workbook_path is not None:
+            progress_callback("testing workbook save")
+            with process_timer.stage('test save'):
+                save_workbook(wb, new_workbook_path)
+
+        # every row with the same value shares one media file, numbered in the order the values are first seen
+        media_paths = {}
+        image_store = BarcodeImageStore(image_memory_budget)
+        # these are only kept up for the checkpoint manifest
+        media_entries = {}
+        processed_rows = {}
+        last_checkpoint_time = time.perf_counter()
+        for sheet_name in sheet_names:
+            if not keep_alive_callback():
+                break
+            ws = wb[sheet_name]
+            sheet_stats = process_stats['sheets'][sheet_name]
+            # the sheet name is only shown when there is more than one sheet to tell apart
+            progress_prefix = sheet_name + " " if len(sheet_names) > 1 else ""
+            # max_row is worked out from every cell in the sheet each time it is read, so it is only read once
+            sheet_max_row = ws.max_row
+            progress_callback(progress_prefix + "0/" + str(sheet_max_row), 0, sheet_max_row)
+            if settings['barcode_output_mode'] == 'font':
+                with process_timer.stage('insert text'):
+                    insert_barcode_font_text(ws, sheet_barcode_rows[sheet_name], settings, sheet_stats,
+                                             progress_callback, keep_alive_callback, progress_prefix)
+                continue
+            processed_rows[sheet_name] = 0
+            # the column width and row heights come from the barcode sizes, which are known before anything is rendered
+            with process_timer.stage('layout'):
+                column_width, row_heights, _ = layout_barcode_rows(sheet_barcode_rows[sheet_name], settings)
+            if column_width is not None:
+                ws.column_dimensions[output_column].width = column_width
+            finished_rows = []
+            try:
+                for row_number, upc_barcode_string in sheet_barcode_rows[sheet_name]:
+                    if not keep_alive_callback():
+                        break
+                    if upc_barcode_string in checkpoint_barcodes:
+                        rendered_barcode = checkpoint_barcodes[upc_barcode_string]
+                        sheet_stats['reused'] += 1
+                    else:
+                        # this includes the barcode render, border and png encode stages timed inside generate_barcode
+                        with process_timer.stage('render'):
+                            _, rendered_barcode = next(rendered_barcodes)
+                    progress_callback(progress_prefix + str(row_number) + "/" + str(sheet_max_row), row_number,
+                                      sheet_max_row)
+                    if checkpoint and checkpoint_seconds is not None and \
+                            time.perf_counter() - last_checkpoint_time > checkpoint_seconds:
+                        # rows before this one are done, this one isn't yet
+                        processed_rows[sheet_name] = row_number - 1
+                        progress_callback("saving checkpoint")
+                        with process_timer.stage('checkpoint save'):
+                            set_barcode_row_heights(ws, finished_rows, row_heights)
+                            save_workbook(wb, new_workbook_path)
+                            write_checkpoint_manifest(new_workbook_path, settings, sheet_value_hashes, processed_rows,
+                                                      media_entries)
+                        last_checkpoint_time = time.perf_counter()
+                    processed_rows[sheet_name] = row_number
+                    if isinstance(rendered_barcode, Exception):
+                        sheet_stats['invalid'] += 1
+                        sheet_stats['errors']['render_failed'] = sheet_stats['errors'].get('render_failed', 0) + 1
+                        print_if_debug(rendered_barcode)
+                        continue
+                    png_bytes, width, height = rendered_barcode
+                    if tempdir is not None:
+                        save_barcode_file(png_bytes, tempdir)
+                    with process_timer.stage('insert image'):
+                        # wrap image data as openpyxl image object
+                        if upc_barcode_string not in media_paths:
+                            media_paths[upc_barcode_string] = "/xl/media/barcode" + str(len(media_paths) + 1) + ".png"
+                            image_store.add(media_paths[upc_barcode_string], png_bytes)
+                            if checkpoint:
+                                media_entries[barcode_value_hash(upc_barcode_string)] = {
+                                    'path': media_paths[upc_barcode_string], 'width': width, 'height': height,
+                                    'hash': checkpoint_hash(png_bytes)}
+                        img = BarcodeImage(None, width, height, media_paths[upc_barcode_string], upc_barcode_string,
+                                           image_store)
+                        # attach image to cell
+                        print_if_debug("adding image to cell")
+                        # add image to cell
+                        ws.add_image(img, anchor=output_column + str(row_number))
+                    finished_rows.append(row_number)
+                    sheet_stats['inserted'] += 1
+                    print_if_debug("success")
+                else:
+                    # invalid rows after the last barcode are done too
+                    processed_rows[sheet_name] = sheet_stats['rows']
+            finally:
+                set_barcode_row_heights(ws, finished_rows, row_heights)
+    finally:
+        rendered_barcodes.close()
+    if new_workbook_path is not None:
+        print_if_debug("saving workbook to file")
+        progress_callback("saving")
+        with process_timer.stage('final save'):
+            save_workbook(wb, new_workbook_path)
+            if checkpoint:
+                write_checkpoint_manifest(new_workbook_path, settings, sheet_value_hashes, processed_rows,
+                                          media_entries)
+        print_if_debug("success")
+    if wb is not old_workbook_path:
+        # a workbook that was handed in keeps the store its images read from, for whenever it is saved
+        image_store.close()
+    if tempdir is not None and not keep_barcode_files:
+        remove_barcode_directory(tempdir)
+    return finish_process_stats(process_stats, process_timer, render_cache, render_cache_hits, render_cache_misses,
+                                len(media_paths), image_store, new_workbook_path)
+
+
+def do_process_workbook_streaming(old_workbook_path, new_workbook_path, settings, progress_callback=no_progress,
+                                  keep_alive_callback=always_keep_alive, render_cache=None, render_workers=1,
+                                  sheet_selection=None, process_timer=None,
+                                  image_memory_budget=default_image_memory_budget):
+    # this is do_process_workbook for workbooks too big to hold in memory. the input is streamed in read only mode
+    # into a write only workbook, while image anchors go into temporary files, and media files into a
+    # BarcodeImageStore, until it is saved, so memory use stays about the same however many rows there are.
+    # the catch is that only cell values are carried over, formatting, merged cells, charts and the like are lost.
+    # sheets that aren't selected are copied through as they are
+    if new_workbook_path is None:
+        raise ValueError("Streaming needs an output workbook to write to")
+    if is_workbook_path(old_workbook_path) and is_workbook_path(new_workbook_path) and \
+            os.path.abspath(old_workbook_path) == os.path.abspath(new_workbook_path):
+        # the input is read while the output is written, so they can't be the same file
+        raise ValueError("Streaming can't write over the workbook it is reading from")
+    if render_cache is None:
+        render_cache = BarcodeRenderCache()
+    if process_timer is None:
+        process_timer = ProcessTimer()
+    render_cache_hits, render_cache_misses = render_cache.hits, render_cache.misses
+    output_column = settings['barcode_output_column']
+    output_column_index = openpyxl.utils.column_index_from_string(output_column)
+    barcode_font = Font(name=settings['barcode_font_name'], size=settings['barcode_font_point_size'])
+    process_stats = {'rows': 0, 'invalid': 0, 'inserted': 0, 'reused': 0, 'sheets': {}}
+    if is_workbook_path(new_workbook_path):
+        # there is no test save, but this still finds an output that can't be written before any work is done
+        progress_callback("testing workbook save")
+        open(new_workbook_path, 'wb').close()
+
+    progress_callback("reading barcode values")
+    with process_timer.stage('read values'):
+        read_only_wb = open_workbook(old_workbook_path, read_only=True)
+    new_wb = openpyxl.Workbook(write_only=True)
+    new_wb.barcode_image_store = BarcodeImageStore(image_memory_budget)
+    streamed_drawings = []
+    media_paths = {}
+    try:
+        sheet_names = select_worksheets(read_only_wb.sheetnames, sheet_selection)
+        if settings['barcode_output_mode'] == 'image':
+            write_barcode_settings_property(new_wb, sheet_names, settings)
+        for sheet_name in read_only_wb.sheetnames:
+            if not keep_alive_callback():
+                break
+            read_only_ws = read_only_wb[sheet_name]
+            ws = new_wb.create_sheet(sheet_name)
+            if sheet_name not in sheet_names:
+                progress_callback("copying " + sheet_name)
+                with process_timer.stage('copy rows'):
+                    for row_values in read_only_ws.iter_rows(values_only=True):
+                        ws.append(row_values)
+                continue
+            normalized_values, error_counts = read_sheet_barcode_values(
+                read_only_ws, sheet_name, settings, progress_callback, keep_alive_callback, process_timer)
+            barcode_rows = [(row_number, normalized_value) for row_number, normalized_value
+                            in enumerate(normalized_values, start=1) if normalized_value is not None]
+            sheet_stats = {'rows': len(normalized_values), 'invalid': len(normalized_values) - len(barcode_rows),
+                           'inserted': 0, 'reused': 0, 'errors': error_counts}
+            process_stats['sheets'][sheet_name] = sheet_stats
+            progress_prefix = sheet_name + " " if len(sheet_names) > 1 else ""
+            sheet_row_count = len(normalized_values)
+            render_generator = None
+            with process_timer.stage('layout'):
+                # a write only sheet's column widths go out before its first row, so the layout is worked out first
+                if settings['barcode_output_mode'] == 'font':
+                    insert_stage_name = 'insert text'
+                    column_width, font_texts = layout_barcode_font_text(barcode_rows, settings)
+                else:
+                    insert_stage_name = 'insert image'
+                    column_width, row_heights, _ = layout_barcode_rows(barcode_rows, settings)
+            if column_width is not None:
+                ws.column_dimensions[output_column].width = column_width
+            if settings['barcode_output_mode'] == 'image':
+                ws.streamed_barcode_drawing = StreamedBarcodeDrawing()
+                streamed_drawings.append(ws.streamed_barcode_drawing)
+                render_generator = render_barcodes_in_row_order(barcode_rows, settings, render_cache,
+                                                                render_workers, process_timer)
+            barcode_row_numbers = iter(barcode_rows)
+            next_barcode_row_number = next(barcode_row_numbers, (None, None))[0]
+            try:
+                for row_number, row_values in enumerate(read_only_ws.iter_rows(values_only=True), start=1):
+                    if not keep_alive_callback():
+                        break
+                    if row_number != next_barcode_row_number:
+                        with process_timer.stage('copy rows'):
+                            ws.append(row_values)
+                        continue
+                    next_barcode_row_number = next(barcode_row_numbers, (None, None))[0]
+                    progress_callback(progress_prefix + str(row_number) + "/" + str(sheet_row_count), row_number,
+                                      sheet_row_count)
+                    if settings['barcode_output_mode'] == 'font':
+                        rendered_barcode = font_texts[row_number]
+                    else:
+                        with process_timer.stage('render'):
+                            _, rendered_barcode = next(render_generator)
+                    if isinstance(rendered_barcode, Exception):
+                        sheet_stats['invalid'] += 1
+                        sheet_stats['errors']['render_failed'] = sheet_stats['errors'].get('render_failed', 0) + 1
+                        print_if_debug(rendered_barcode)
+                        with process_timer.stage('copy rows'):
+                            ws.append(row_values)
+                        continue
+                    with process_timer.stage(insert_stage_name):
+                        if settings['barcode_output_mode'] == 'font':
+                            row_values = list(row_values)
+                            row_values.extend([None] * (output_column_index - len(row_values)))
+                            row_values[output_column_index - 1] = WriteOnlyCell(ws, value=rendered_barcode)
+                            row_values[output_column_index - 1].font = barcode_font
+                            row_height = int(math.ceil(settings['barcode_font_point_size'] * 1.25))
+                        else:
+                            png_bytes, width, height = rendered_barcode
+                            upc_barcode_string = normalized_values[row_number - 1]
+                            if upc_barcode_string not in media_paths:
+                                media_paths[upc_barcode_string] = \
+                                    "/xl/media/barcode" + str(len(media_paths) + 1) + ".png"
+                                new_wb.barcode_image_store.add(media_paths[upc_barcode_string], png_bytes)
+                            ws.streamed_barcode_drawing.add_image(media_paths[upc_barcode_string], width, height,
+                                                                  row_number, output_column_index, upc_barcode_string)
+                            # openpyxl only writes a sheet's drawing when it has images, the drawing stands in
+                            # for them
+                            ws._images = [ws.streamed_barcode_drawing]
+                            row_height = row_heights[row_number]
+                        # row dimensions are written out with their row, and aren't needed after that
+                        ws.row_dimensions[row_number].height = row_height
+                        ws.append(row_values)
+                        del ws.row_dimensions[row_number]
+                    sheet_stats['inserted'] += 1
+            finally:
+                if render_generator is not None:
+                    render_generator.close()
+        print_if_debug("saving workbook to file")
+        progress_callback("saving")
+        with process_timer.stage('final save'):
+            save_workbook(new_wb, new_workbook_path)
+        print_if_debug("success")
+    finally:
+        if read_only_wb is not old_workbook_path:
+            read_only_wb.close()
+        new_wb.barcode_image_store.close()
+        for streamed_drawing in streamed_drawings:
+            streamed_drawing.close()
+    return finish_process_stats(process_stats, process_timer, render_cache, render_cache_hits, render_cache_misses,
+                                len(media_paths), new_wb.barcode_image_store, new_workbook_path)
+
+
+def index_barcode_images(ws, output_column_index):
+    # sorts the images of a worksheet into the barcodes in the output column, {row number: (value, image)}, and
+    # every other image. the value is the picture description BarcodeSpreadsheetDrawing wrote, images from before
+    # it did that, or put in the output column by hand, don't have one that can match a barcode value.
+    # only one image on a cell can be its barcode, any others there are left out of both
+    barcode_images = {}
+    other_images = []
+    for img in ws._images:
+        if isinstance(img, BarcodeImage):
+            row_number, column_index = openpyxl.utils.cell.coordinate_to_tuple(img.anchor)
+            barcode_value = img.barcode_value
+        elif getattr(img.anchor, '_from', None) is not None:
+            row_number, column_index = img.anchor._from.row + 1, img.anchor._from.col + 1
+            picture_frame = img.anchor.pic
+            barcode_value = picture_frame.nvPicPr.cNvPr.descr if picture_frame is not None else None
+        else:
+            # absolute anchors aren't on a cell
+            row_number, column_index = None, None
+        if column_index != output_column_index:
+            other_images.append(img)
+        elif row_number not in barcode_images:
+            barcode_images[row_number] = (barcode_value, img)
+    return barcode_images, other_images
+
+
+def do_update_workbook(old_workbook_path, new_workbook_path, settings, progress_callback=no_progress,
+                       keep_alive_callback=always_keep_alive, render_cache=None, render_workers=1,
+                       sheet_selection=None, process_timer=None, image_memory_budget=default_image_memory_budget):
+    # this brings a workbook processed before up to date with the values now in its input column, writing it to
+    # new_workbook_path, which can be old_workbook_path itself. images in the output column are kept where they
+    # encode the value their row holds now, with the settings the workbook says they were rendered with. only rows
+    # whose value changed, or that are new, are rendered, and images on rows that no longer have a value are dropped.
+    # returns the same stats as do_process_workbook, with 'reused' counting the images kept and 'removed' the
+    # images dropped. the workbook is still loaded and saved whole, but the images that are kept are only copied.
+    # the media of the updated images is kept in a BarcodeImageStore, as do_process_workbook does.
+    # the font output mode rewrites every row's text, which needs no rendering, so it is processed as usual
+    if settings['barcode_output_mode'] == 'font':
+        return do_process_workbook(old_workbook_path, new_workbook_path, settings, progress_callback,
+                                   keep_alive_callback, render_cache=render_cache, render_workers=render_workers,
+                                   sheet_selection=sheet_selection, process_timer=process_timer,
+                                   image_memory_budget=image_memory_budget)
+    if render_cache is None:
+        render_cache = BarcodeRenderCache()
+    if process_timer is None:
+        process_timer = ProcessTimer()
+    render_cache_hits, render_cache_misses = render_cache.hits, render_cache.misses
+    output_column = settings['barcode_output_column']
+    output_column_index = openpyxl.utils.column_index_from_string(output_column)
+    process_stats = {'rows': 0, 'invalid': 0, 'inserted': 0, 'reused': 0, 'removed': 0, 'sheets': {}}
+
+    # as in do_process_workbook, the barcode values are all read and checked first
+    progress_callback("reading barcode values")
+    sheet_barcode_rows = {}
+    with process_timer.stage('read values'):
+        read_only_wb = open_workbook(old_workbook_path, read_only=True)
+    try:
+        sheet_names = select_worksheets(read_only_wb.sheetnames, sheet_selection)
+        for sheet_name in sheet_names:
+            normalized_values, error_counts = read_sheet_barcode_values(
+                read_only_wb[sheet_name], sheet_name, settings, progress_callback, keep_alive_callback, process_timer)
+            barcode_rows = [(row_number, normalized_value) for row_number, normalized_value
+                            in enumerate(normalized_values, start=1) if normalized_value is not None]
+            sheet_barcode_rows[sheet_name] = barcode_rows
+            process_stats['sheets'][sheet_name] = {
+                'rows': len(normalized_values), 'invalid': len(normalized_values) - len(barcode_rows), 'inserted': 0,
+                'reused': 0, 'removed': 0, 'errors': error_counts}
+    finally:
+        if read_only_wb is not old_workbook_path:
+            read_only_wb.close()
+
+    progress_callback("opening workbook")
+    with process_timer.stage('load workbook'):
+        wb, sheet_barcode_images = open_workbook_for_update(old_workbook_path, sheet_names, output_column)
+    if new_workbook_path is not None and not (
+            is_workbook_path(old_workbook_path) and is_workbook_path(new_workbook_path) and
+            os.path.abspath(old_workbook_path) == os.path.abspath(new_workbook_path)):
+        # writing over the workbook being updated can only be tried at the end. the barcode images aren't back in
+        # the workbook yet, so this takes no longer than it does for a workbook without them
+        progress_callback("testing workbook save")
+        with process_timer.stage('test save'):
+            save_workbook(wb, new_workbook_path)
+
+    # every row with the same value shares one media file, kept images included
+    media_paths = {}
+    image_store = BarcodeImageStore(image_memory_budget)
+    for sheet_name in sheet_names:
+        if not keep_alive_callback():
+            break
+        ws = wb[sheet_name]
+        barcode_rows = sheet_barcode_rows[sheet_name]
+        sheet_stats = process_stats['sheets'][sheet_name]
+        progress_prefix = sheet_name + " " if len(sheet_names) > 1 else ""
+        with process_timer.stage('index images'):
+            ws._images.extend(sheet_barcode_images.get(sheet_name, []))
+            barcode_images, other_images = index_barcode_images(ws, output_column_index)
+            sheet_stats['removed'] += len(ws._images) - len(barcode_images) - len(other_images)
+            if read_barcode_settings_property(wb, sheet_name) != checkpoint_settings_key(settings):
+                # the images were made with other settings, or the workbook doesn't say, none of them can be kept
+                barcode_images = {row_number: (None, img) for row_number, (_, img) in barcode_images.items()}
+        with process_timer.stage('layout'):
+            column_width, row_heights, _ = layout_barcode_rows(barcode_rows, settings)
+        if column_width is not None:
+            ws.column_dimensions[output_column].width = column_width
+        rows_to_render = [(row_number, upc_barcode_string) for row_number, upc_barcode_string in barcode_rows
+                          if barcode_images.get(row_number, (None, None))[0] != upc_barcode_string]
+        progress_callback(progress_prefix + str(len(barcode_rows) - len(rows_to_render)) +
+                          " barcodes are unchanged, " + str(len(rows_to_render)) + " need rendering")
+        rendered_barcodes = render_barcodes_in_row_order(rows_to_render, settings, render_cache, render_workers,
+                                                         process_timer)
+        updated_images = []
+        finished_rows = []
+        # rows up to this one have been brought up to date, the images of rows after it are left as they were
+        last_row_number = 0
+        try:
+            for row_number, upc_barcode_string in barcode_rows:
+                if not keep_alive_callback():
+                    break
+                progress_callback(progress_prefix + str(row_number) + "/" + str(sheet_stats['rows']), row_number,
+                                  sheet_stats['rows'])
+                image_value, img = barcode_images.get(row_number, (None, None))
+                last_row_number = row_number
+                if image_value == upc_barcode_string:
+                    # the kept image's media is only read for the first row with its value, after that it is in the
+                    # store
+                    png_bytes = None if upc_barcode_string in media_paths else read_image_data(img)
+                    rendered_barcode = (png_bytes, img.width, img.height)
+                    sheet_stats['reused'] += 1
+                else:
+                    with process_timer.stage('render'):
+                        _, rendered_barcode = next(rendered_barcodes)
+                if isinstance(rendered_barcode, Exception):
+                    sheet_stats['invalid'] += 1
+                    sheet_stats['errors']['render_failed'] = sheet_stats['errors'].get('render_failed', 0) + 1
+                    print_if_debug(rendered_barcode)
+                    continue
+                png_bytes, width, height = rendered_barcode
+                with process_timer.stage('insert image'):
+                    if upc_barcode_string not in media_paths:
+                        media_paths[upc_barcode_string] = "/xl/media/barcode" + str(len(media_paths) + 1) + ".png"
+                        image_store.add(media_paths[upc_barcode_string], png_bytes)
+                    img = BarcodeImage(None, width, height, media_paths[upc_barcode_string], upc_barcode_string,
+                                       image_store)
+                    img.anchor = output_column + str(row_number)
+                    updated_images.append(img)
+                finished_rows.append(row_number)
+                sheet_stats['inserted'] += 1
+            else:
+                last_row_number = sheet_stats['rows']
+        finally:
+            rendered_barcodes.close()
+            set_barcode_row_heights(ws, finished_rows, row_heights)
+        barcode_row_numbers = set(row_number for row_number, _ in barcode_rows)
+        for row_number, (_, img) in barcode_images.items():
+            if row_number > last_row_number:
+                if isinstance(img, BarcodeImage):
+                    # the media path it had may have gone to another value since
+                    img.media_path = None
+                updated_images.append(img)
+            elif row_number not in barcode_row_numbers:
+                # the row keeps its height, it may have had it before the image
+                sheet_stats['removed'] += 1
+        ws._images = other_images + updated_images
+        if last_row_number == sheet_stats['rows']:
+            # a sheet left part way still has images made with whatever settings it had before
+            write_barcode_settings_property(wb, [sheet_name], settings)
+    if new_workbook_path is not None:
+        print_if_debug("saving workbook to file")
+        progress_callback("saving")
+        with process_timer.stage('final save'):
+            save_workbook(wb, new_workbook_path)
+        print_if_debug("success")
+    if wb is not old_workbook_path:
+        image_store.close()
+    return finish_process_stats(process_stats, process_timer, render_cache, render_cache_hits, render_cache_misses,
+                                len(media_paths), image_store, new_workbook_path)
+
+
+# each barcode image adds its anchor to the sheet's drawing and a row height to the sheet, which come to about this
+# many bytes in a saved workbook once compressed
+barcode_anchor_bytes = 140
+# how many barcodes of each image size are rendered to estimate the size of the media files
+layout_sample_count = 10
+
+
+def do_layout_workbook(old_workbook_path, settings, progress_callback=no_progress,
+                       keep_alive_callback=always_keep_alive, render_cache=None, render_workers=1,
+                       sheet_selection=None, process_timer=None, error_rows=None):
+    # this is a dry run of do_process_workbook. it reads the barcode values of the selected worksheets and works out
+    # the layout they would get, the output column width, row heights and image sizes, without rendering them or
+    # writing a workbook. returns row counts and error counts, totalled and per sheet, and the stage timings under
+    # 'timing', along with estimates of the output workbook size and of how long rendering would take.
+    # the estimates render a few barcodes of each image size, and count every distinct value of that size as being
+    # as big and as slow as they are, barcodes already in render_cache don't count towards the time.
+    # if error_rows is a list, every row that would be skipped is added to it, as described at write_error_report
+    if render_cache is None:
+        render_cache = BarcodeRenderCache()
+    if process_timer is None:
+        process_timer = ProcessTimer()
+    layout_stats = {'rows': 0, 'invalid': 0, 'barcodes': 0, 'errors': {}, 'sheets': {}}
+    # values share a media file across sheets, as they do in do_process_workbook
+    media_value_sizes = {}
+    progress_callback("reading barcode values")
+    with process_timer.stage('read values'):
+        read_only_wb = open_workbook(old_workbook_path, read_only=True)
+    try:
+        for sheet_name in select_worksheets(read_only_wb.sheetnames, sheet_selection):
+            if not keep_alive_callback():
+                break
+            sheet_error_rows = []
+            normalized_values, error_counts = read_sheet_barcode_values(
+                read_only_wb[sheet_name], sheet_name, settings, progress_callback, keep_alive_callback, process_timer,
+                sheet_error_rows)
+            barcode_rows = [(row_number, normalized_value) for row_number, normalized_value
+                            in enumerate(normalized_values, start=1) if normalized_value is not None]
+            progress_callback("laying out " + sheet_name)
+            with process_timer.stage('layout'):
+                if settings['barcode_output_mode'] == 'font':
+                    column_width, font_texts = layout_barcode_font_text(barcode_rows, settings)
+                    laid_out_rows = [row_number for row_number, font_text in font_texts.items()
+                                     if isinstance(font_text, str)]
+                    row_height = int(math.ceil(settings['barcode_font_point_size'] * 1.25))
+                    row_heights = dict.fromkeys(laid_out_rows, row_height)
+                    image_sizes = {}
+                else:
+                    column_width, row_heights, image_sizes = layout_barcode_rows(barcode_rows, settings)
+                    for row_number, upc_barcode_string in barcode_rows:
+                        if row_number in row_heights:
+                            media_value_sizes[upc_barcode_string] = get_barcode_geometry(upc_barcode_string,
+                                                                                         settings)
+            failed_count = len(barcode_rows) - len(row_heights)
+            if failed_count:
+                error_counts['render_failed'] = error_counts.get('render_failed', 0) + failed_count
+                sheet_error_rows.extend(new_error_row(sheet_name, row_number, upc_barcode_string, 'render_failed',
+                                                      settings['barcode_type'])
+                                        for row_number, upc_barcode_string in barcode_rows
+                                        if row_number not in row_heights)
+                sheet_error_rows.sort(key=lambda error_row: error_row['row'])
+            if error_rows is not None:
+                error_rows.extend(sheet_error_rows)
+            for error_code, error_count in error_counts.items():
+                layout_stats['errors'][error_code] = layout_stats['errors'].get(error_code, 0) + error_count
+            layout_stats['sheets'][sheet_name] = {
+                'rows': len(normalized_values), 'invalid': len(normalized_values) - len(row_heights),
+                'barcodes': len(row_heights), 'errors': error_counts, 'column_width': column_width,
+                'row_height_total': sum(row_heights.values()),
+                'image_sizes': {str(width) + "x" + str(height): image_count
+                                for (width, height), image_count in sorted(image_sizes.items())}}
+    finally:
+        if read_only_wb is not old_workbook_path:
+            read_only_wb.close()
+    for sheet_stats in layout_stats['sheets'].values():
+        for stat_name in ('rows', 'invalid', 'barcodes'):
+            layout_stats[stat_name] += sheet_stats[stat_name]
+
+    progress_callback("estimating output size")
+    sample_media_bytes = collections.defaultdict(list)
+    sample_render_seconds = collections.defaultdict(list)
+    with process_timer.stage('estimate'):
+        for upc_barcode_string, image_size in media_value_sizes.items():
+            if len(sample_media_bytes[image_size]) < layout_sample_count:
+                # the samples skip the render cache, so that they are timed rendering
+                render_start_time = time.perf_counter()
+                png_bytes = generate_barcode(upc_barcode_string, settings, process_timer=process_timer)[0]
+                sample_render_seconds[image_size].append(time.perf_counter() - render_start_time)
+                # media files are deflated into the workbook like everything else in it
+                sample_media_bytes[image_size].append(len(zlib.compress(png_bytes)))
+    media_bytes = int(sum(sum(sample_media_bytes[image_size]) / len(sample_media_bytes[image_size])
+                          for image_size in media_value_sizes.values()))
+    # the first render of a run loads the font, so the median is used rather than the mean
+    median_render_seconds = {image_size: statistics.median(render_seconds)
+                             for image_size, render_seconds in sample_render_seconds.items()}
+    uncached_image_sizes = [image_size for upc_barcode_string, image_size in media_value_sizes.items()
+                            if render_cache_key(upc_barcode_string, settings) not in render_cache]
+    layout_stats['renders'] = len(uncached_image_sizes)
+    layout_stats['estimated_render_seconds'] = round(sum(median_render_seconds[image_size] for image_size
+                                                         in uncached_image_sizes) / render_workers, 1)
+    workbook_bytes = os.path.getsize(old_workbook_path) if is_workbook_path(old_workbook_path) else 0
+    layout_stats['media_files'] = len(media_value_sizes)
+    layout_stats['estimated_media_bytes'] = media_bytes
+    layout_stats['estimated_output_bytes'] = workbook_bytes + media_bytes
+    if settings['barcode_output_mode'] == 'image':
+        layout_stats['estimated_output_bytes'] += layout_stats['barcodes'] * barcode_anchor_bytes
+    for stat_name in ('rows', 'invalid', 'barcodes', 'media_files', 'renders', 'estimated_media_bytes',
+                      'estimated_output_bytes'):
+        process_timer.count(stat_name, layout_stats[stat_name])
+    layout_stats['timing'] = process_timer.summary()
+    return layout_stats
+
+
+def render_barcode_files_in_order(input_strings, settings, export_format, render_cache, render_workers=1,
+                                  process_timer=None):
+    # yields (input string, file contents) for each of input_strings, in order, or the exception it failed with.
+    # png and pdf files are rendered through render_barcodes_in_row_order, so they can use the render processes
+    if export_format == 'svg':
+        for input_string in input_strings:
+            try:
+                yield input_string, generate_barcode_svg(input_string, settings, render_cache)
+            except Exception as barcode_error:
+                yield input_string, barcode_error
+        return
+    rendered_barcodes = render_barcodes_in_row_order(list(enumerate(input_strings)), settings, render_cache,
+                                                     render_workers, process_timer)
+    try:
+        for input_string, (_, rendered_barcode) in zip(input_strings, rendered_barcodes):
+            if isinstance(rendered_barcode, Exception):
+                yield input_string, rendered_barcode
+                continue
+            try:
+                yield input_string, convert_barcode_png(rendered_barcode[0], settings, export_format)
+            except Exception as conversion_error:
+                yield input_string, conversion_error
+    finally:
+        rendered_barcodes.close()
+
+
+export_file_name_pattern = re.compile(r'[^A-Za-z0-9._-]')
+
+
+def barcode_export_file_name(input_string, export_format, used_file_names):
+    # file names are the barcode value, with anything that isn't safe in a file name replaced.
+    # values that come out the same get a number added, names are compared ignoring case for windows
+    file_name_stem = export_file_name_pattern.sub('_', input_string)
+    file_name = file_name_stem + '.' + export_format
+    file_name_number = 1
+    while file_name.lower() in used_file_names:
+        file_name_number += 1
+        file_name = file_name_stem + '_' + str(file_name_number) + '.' + export_format
+    used_file_names.add(file_name.lower())
+    return file_name
+
+
+def is_zip_export(export_destination):
+    return not is_workbook_path(export_destination) or os.fspath(export_destination).lower().endswith('.zip')
+
+
+def do_export_barcodes(workbook_source, export_destination, settings, export_format='png',
+                       progress_callback=no_progress, keep_alive_callback=always_keep_alive, render_cache=None,
+                       render_workers=1, sheet_selection=None, process_timer=None):
+    # writes a file for every distinct barcode value in the selected worksheets, named after the value, without
+    # making a workbook. export_destination is a folder, which is made if it isn't there, or a zip file, either
+    # a path ending in .zip or a binary file object. files are written straight into the folder or zip file as
+    # they are rendered. returns row counts like do_process_workbook, with the number of files under 'exported'
+    if render_cache is None:
+        render_cache = BarcodeRenderCache()
+    if process_timer is None:
+        process_timer = ProcessTimer()
+    export_stats = {'rows': 0, 'invalid': 0, 'exported': 0, 'failed': 0, 'sheets': {}}
+    progress_callback("reading barcode values")
+    export_values = {}
+    with process_timer.stage('read values'):
+        read_only_wb = open_workbook(workbook_source, read_only=True)
+    try:
+        for sheet_name in select_worksheets(read_only_wb.sheetnames, sheet_selection):
+            normalized_values, error_counts = read_sheet_barcode_values(
+                read_only_wb[sheet_name], sheet_name, settings, progress_callback, keep_alive_callback, process_timer)
+            sheet_stats = {'rows': len(normalized_values), 'invalid': sum(error_counts.values()),
+                           'errors': error_counts}
+            export_values.update((normalized_value, None) for normalized_value in normalized_values
+                                 if normalized_value is not None)
+            export_stats['sheets'][sheet_name] = sheet_stats
+            export_stats['rows'] += sheet_stats['rows']
+            export_stats['invalid'] += sheet_stats['invalid']
+    finally:
+        if read_only_wb is not workbook_source:
+            read_only_wb.close()
+
+    export_values = list(export_values)
+    export_archive = None
+    if is_zip_export(export_destination):
+        export_archive = zipfile.ZipFile(export_destination, 'w')
+    else:
+        os.makedirs(export_destination, exist_ok=True)
+    # pngs and pdfs are compressed already, deflating them again would only cost time
+    compress_type = zipfile.ZIP_DEFLATED if export_format == 'svg' else zipfile.ZIP_STORED
+    used_file_names = set()
+    bytes_written = 0
+    rendered_files = render_barcode_files_in_order(export_values, settings, export_format, render_cache,
+                                                   render_workers, process_timer)
+    try:
+        for export_count, (input_string, file_contents) in enumerate(rendered_files, start=1):
+            if not keep_alive_callback():
+                break
+            progress_callback(str(export_count) + "/" + str(len(export_values)), export_count, len(export_values))
+            if isinstance(file_contents, Exception):
+                export_stats['failed'] += 1
+                print_if_debug(file_contents)
+                continue
+            file_name = barcode_export_file_name(input_string, export_format, used_file_names)
+            with process_timer.stage('write files'):
+                if export_archive is not None:
+                    export_archive.writestr(file_name, file_contents, compress_type=compress_type)
+                else:
+                    with open(os.path.join(export_destination, file_name), 'wb') as export_file:
+                        export_file.write(file_contents)
+            bytes_written += len(file_contents)
+            export_stats['exported'] += 1
+    finally:
+        rendered_files.close()
+        if export_archive is not None:
+            with process_timer.stage('write files'):
+                export_archive.close()
+    for stat_name in ('rows', 'invalid', 'exported'):
+        process_timer.count(stat_name, export_stats[stat_name])
+    process_timer.count('bytes_written', bytes_written)
+    export_stats['timing'] = process_timer.summary()
+    return export_stats
+
+
+class BarcodeRenderer():
+    # renders barcodes with one set of settings, keeping them in its render cache, for programs using this module
+    # directly. settings can be given in full or in part, anything left out comes from default_settings.
+    # raises ValueError if the settings aren't usable
+    def __init__(self, settings=None, render_cache=None):
+        self.settings = dict(default_settings)
+        if settings is not None:
+            self.settings.update(settings)
+        settings_problems = check_settings(self.settings)
+        if settings_problems:
+            raise ValueError(", ".join(settings_problems))
+        if render_cache is None:
+            render_cache = BarcodeRenderCache()
+        self.render_cache = render_cache
+        self.normalize_value = get_barcode_value_normalizer(self.settings['barcode_type'],
+                                                            self.settings['pad_ean_barcodes'])
+
+    def normalize(self, value):
+        # returns the value as it would be encoded, a cell value can be given as it is.
+        # raises ValueError if it can't be encoded
+        normalized_value, error_code = self.normalize_value('' if value is None else str(value))
+        if error_code is not None:
+            raise ValueError(barcode_value_error_message(error_code, self.settings['barcode_type']))
+        return normalized_value
+
+    def render(self, value):
+        # returns (png bytes, width, height)
+        return generate_barcode(self.normalize(value), self.settings, self.render_cache)
+
+
+class WorkbookProcessor():
+    # inserts barcodes into workbooks with a BarcodeRenderer's settings and render cache, a new renderer with the
+    # default settings is made if one isn't given. the other options are the ones do_process_workbook takes
+    def __init__(self, renderer=None, render_workers=1, sheet_selection=None, checkpoint=False,
+                 checkpoint_seconds=None, streaming=False, image_memory_budget=default_image_memory_budget):
+        if renderer is None:
+            renderer = BarcodeRenderer()
+        self.renderer = renderer
+        self.render_workers = render_workers
+        self.sheet_selection = sheet_selection
+        self.checkpoint = checkpoint
+        self.checkpoint_seconds = checkpoint_seconds
+        self.streaming = streaming
+        self.image_memory_budget = image_memory_budget
+
+    def process(self, input_workbook, output_workbook=None, progress_callback=no_progress,
+                keep_alive_callback=always_keep_alive):
+        # input_workbook is a path, a binary file object, or an openpyxl workbook, and output_workbook a path or
+        # binary file object. without output_workbook, input_workbook has to be an openpyxl workbook, and the
+        # barcodes are left in it unsaved. returns the stats from do_process_workbook
+        if output_workbook is None and not isinstance(input_workbook, openpyxl.Workbook):
+            raise ValueError("An output workbook is needed, unless an openpyxl workbook is being processed")
+        return do_process_workbook(input_workbook, output_workbook, self.renderer.settings,
+                                   progress_callback=progress_callback, keep_alive_callback=keep_alive_callback,
+                                   render_cache=self.renderer.render_cache, render_workers=self.render_workers,
+                                   sheet_selection=self.sheet_selection, checkpoint=self.checkpoint,
+                                   checkpoint_seconds=self.checkpoint_seconds, streaming=self.streaming,
+                                   image_memory_budget=self.image_memory_budget)
+
+    def update(self, input_workbook, output_workbook=None, progress_callback=no_progress,
+               keep_alive_callback=always_keep_alive):
+        # brings input_workbook, processed before, up to date with its values, see do_update_workbook.
+        # the workbooks are given as for process, output_workbook can be input_workbook itself
+        if output_workbook is None and not isinstance(input_workbook, openpyxl.Workbook):
+            raise ValueError("An output workbook is needed, unless an openpyxl workbook is being updated")
+        return do_update_workbook(input_workbook, output_workbook, self.renderer.settings,
+                                  progress_callback=progress_callback, keep_alive_callback=keep_alive_callback,
+                                  render_cache=self.renderer.render_cache, render_workers=self.render_workers,
+                                  sheet_selection=self.sheet_selection, image_memory_budget=self.image_memory_budget)
+
+    def layout(self, input_workbook, progress_callback=no_progress, keep_alive_callback=always_keep_alive,
+               error_rows=None):
+        # works out what process would do with input_workbook without doing it, returns the stats from
+        # do_layout_workbook, and fills in error_rows if it is a list
+        return do_layout_workbook(input_workbook, self.renderer.settings, progress_callback=progress_callback,
+                                  keep_alive_callback=keep_alive_callback, render_cache=self.renderer.render_cache,
+                                  render_workers=self.render_workers, sheet_selection=self.sheet_selection,
+                                  error_rows=error_rows)
+
+
+def find_batch_workbooks(input_paths):
+    # expands a list of workbook files, folders and glob patterns into the xlsx files they name.
+    # excel's own lock files (~$name.xlsx) are skipped
+    workbook_paths = []
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            matched_paths = glob.glob(os.path.join(glob.escape(input_path), '*.xlsx'))
+        elif os.path.isfile(input_path):
+            matched_paths = [input_path]
+        else:
+            matched_paths = glob.glob(input_path, recursive=True)
+        for matched_path in sorted(matched_paths):
+            if os.path.isfile(matched_path) and matched_path.lower().endswith('.xlsx') and \
+                    not os.path.basename(matched_path).startswith('~$') and matched_path not in workbook_paths:
+                workbook_paths.append(matched_path)
+    return workbook_paths
+
+
+# each batch worker process keeps one render cache for all of the workbooks it is handed
+batch_job_render_cache = None
+
+
+def new_batch_result(old_workbook_path, new_workbook_path):
+    return {'input': old_workbook_path, 'output': new_workbook_path, 'status': 'done', 'error': '', 'sheets': '',
+            'rows': 0, 'invalid': 0, 'inserted': 0, 'reused': 0, 'seconds': 0.0, 'timing': {}}
+
+
+def process_batch_job(old_workbook_path, new_workbook_path, settings, sheet_selection, render_cache=None,
+                      render_workers=1, keep_alive_callback=always_keep_alive, checkpoint=False,
+                      checkpoint_seconds=None, streaming=False, image_memory_budget=default_image_memory_budget):
+    # processes one workbook of a batch, and returns its line of the batch report.
+    # failures are recorded in the report instead of being raised, so one broken workbook doesn't stop the batch
+    global batch_job_render_cache
+    if render_cache is None:
+        if batch_job_render_cache is None:
+            batch_job_render_cache = BarcodeRenderCache()
+        render_cache = batch_job_render_cache
+    batch_result = new_batch_result(old_workbook_path, new_workbook_path)
+    start_time = time.perf_counter()
+    try:
+        process_stats = do_process_workbook(old_workbook_path, new_workbook_path, settings,
+                                            keep_alive_callback=keep_alive_callback, render_cache=render_cache,
+                                            render_workers=render_workers, sheet_selection=sheet_selection,
+                                            checkpoint=checkpoint, checkpoint_seconds=checkpoint_seconds,
+                                            streaming=streaming, image_memory_budget=image_memory_budget)
+        batch_result['sheets'] = ", ".join(process_stats['sheets'])
+        for stat_name in ('rows', 'invalid', 'inserted', 'reused'):
+            batch_result[stat_name] = process_stats[stat_name]
+        batch_result['timing'] = process_stats['timing']
+    except Exception as batch_job_error:
+        batch_result['status'] = 'failed'
+        batch_result['error'] = str(batch_job_error)
+    batch_result['seconds'] = round(time.perf_counter() - start_time, 3)
+    return batch_result
+
+
+def do_process_workbook_batch(workbook_paths, output_directory, settings, sheet_selection=None, jobs=1,
+                              progress_callback=no_progress, keep_alive_callback=always_keep_alive,
+                              render_cache=None, render_workers=1, checkpoint=False, checkpoint_seconds=None,
+                              streaming=False, image_memory_budget=default_image_memory_budget):
+    # processes each workbook into output_directory under the same file name, returns the batch report lines.
+    # with more than one job, workbooks are handed to a pool of worker processes, no more than two per worker
+    # are queued up at a time so that a large batch isn't all submitted at once
+    if render_cache is None:
+        render_cache = BarcodeRenderCache()
+    batch_jobs = []
+    batch_results = []
+    for old_workbook_path in workbook_paths:
+        new_workbook_path = os.path.join(output_directory, os.path.basename(old_workbook_path))
+        if os.path.abspath(new_workbook_path) == os.path.abspath(old_workbook_path):
+            batch_result = new_batch_result(old_workbook_path, new_workbook_path)
+            batch_result['status'] = 'failed'
+            batch_result['error'] = "Output would overwrite the input workbook"
+            batch_results.append(batch_result)
+        else:
+            batch_jobs.append((old_workbook_path, new_workbook_path))
+    progress_callback("0/" + str(len(workbook_paths)) + " workbooks", 0, len(workbook_paths))
+    render_process_context = get_render_process_context()
+    if jobs <= 1 or render_process_context is None:
+        for old_workbook_path, new_workbook_path in batch_jobs:
+            if not keep_alive_callback():
+                break
+            batch_results.append(process_batch_job(old_workbook_path, new_workbook_path, settings, sheet_selection,
+                                                   render_cache, render_workers, keep_alive_callback, checkpoint,
+                                                   checkpoint_seconds, streaming, image_memory_budget))
+            progress_callback(str(len(batch_results)) + "/" + str(len(workbook_paths)) + " workbooks",
+                              len(batch_results), len(workbook_paths))
+    else:
+        import concurrent.futures
+        batch_pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=render_process_context)
+        try:
+            queued_jobs = collections.deque(batch_jobs)
+            running_jobs = set()
+            while queued_jobs or running_jobs:
+                while queued_jobs and len(running_jobs) < jobs * 2 and keep_alive_callback():
+                    old_workbook_path, new_workbook_path = queued_jobs.popleft()
+                    running_jobs.add(batch_pool.submit(process_batch_job, old_workbook_path, new_workbook_path,
+                                                       settings, sheet_selection, checkpoint=checkpoint,
+                                                       checkpoint_seconds=checkpoint_seconds, streaming=streaming,
+                                                       image_memory_budget=image_memory_budget))
+                if not running_jobs:
+                    break
+                finished_jobs, running_jobs = concurrent.futures.wait(
+                    running_jobs, return_when=concurrent.futures.FIRST_COMPLETED)
+                for finished_job in finished_jobs:
+                    batch_results.append(finished_job.result())
+                progress_callback(str(len(batch_results)) + "/" + str(len(workbook_paths)) + " workbooks",
+                                  len(batch_results), len(workbook_paths))
+        finally:
+            batch_pool.shutdown(wait=True, cancel_futures=True)
+    # the report lists workbooks in the order they were given, not the order they finished in
+    workbook_order = {old_workbook_path: index for index, old_workbook_path in enumerate(workbook_paths)}
+    batch_results.sort(key=lambda batch_result: workbook_order[batch_result['input']])
+    return batch_results
+
+
+batch_report_fields = ['input', 'output', 'status', 'error', 'sheets', 'rows', 'invalid', 'inserted', 'reused',
+                       'seconds']
+
+
+def write_batch_report(report_path, batch_results):
+    # the report is json if the file name ends in .json, and csv otherwise
+    if report_path.lower().endswith('.json'):
+        batch_summary = {'workbooks': len(batch_results)}
+        for stat_name in ('rows', 'invalid', 'inserted', 'reused', 'seconds'):
+            batch_summary[stat_name] = sum(batch_result[stat_name] for batch_result in batch_results)
+        batch_summary['failed'] = sum(1 for batch_result in batch_results if batch_result['status'] != 'done')
+        with open(report_path, 'w', encoding='utf8') as report_file:
+            json.dump({'summary': batch_summary, 'workbooks': batch_results}, report_file, indent=4)
+    else:
+        with open(report_path, 'w', encoding='utf8', newline='') as report_file:
+            # the stage timings don't fit in a csv column, they are only in the json report
+            report_writer = csv.DictWriter(report_file, fieldnames=batch_report_fields, extrasaction='ignore')
+            report_writer.writeheader()
+            report_writer.writerows(batch_results)
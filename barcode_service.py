@@ -0,0 +1,436 @@
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import http
+import json
+import logging
+import os
+import time
+import urllib.parse
+from barcode_settings import appname, supported_barcode_types, check_settings
+from barcode_processing import BarcodeRenderCache, render_cache_key, generate_barcode, generate_barcode_svg, \
+    get_barcode_value_normalizer, barcode_value_error_message, get_render_process_context
+
+# this is the render service, a long running process that renders barcodes for other programs over http, on a tcp
+# port or a unix socket. the processing code stays loaded and the render cache stays warm between requests, so a
+# barcode that was rendered before is answered straight from the cache, without leaving the event loop.
+#
+# GET /render?value=...&format=png renders one barcode, and answers with the image itself. png answers carry the
+# image size in the X-Barcode-Width and X-Barcode-Height headers. any setting can be given as a query parameter
+# under its settings name, such as barcode_type=ean13, settings left out are the ones the service started with.
+# POST /render takes a json object {"values": [...], "format": "png", "settings": {...}}, format and settings are
+# optional, and answers {"barcodes": [...]}, one entry per value, in order. each entry is either
+# {"value", "data" (the image, base64 encoded), "width", "height"} or {"value", "error"}.
+# GET /metrics answers with request counts, render cache counts and request latencies as json.
+#
+# renders run on a thread, or on a pool of forked processes, a fixed number at a time. a value that is already
+# being rendered for another request is waited on instead of being rendered twice, and once too many values are
+# waiting for a render, requests that need one are turned away with 503 until the backlog clears. a request that
+# needs more renders than the whole backlog holds is turned away with 413, as are request bodies over
+# service_max_request_bytes
+
+logger = logging.getLogger(appname)
+
+service_image_formats = {'png': 'image/png', 'svg': 'image/svg+xml'}
+service_latency_samples = 10000
+service_max_request_bytes = 4 * 1024 * 1024
+service_max_batch_values = 10000
+service_max_header_lines = 100
+
+
+class ServiceRequestError(Exception):
+    # raised for requests that can't be answered, status is the http status to answer with
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def service_cache_key(input_string, settings, image_format):
+    # the same keys generate_barcode and generate_barcode_svg use, so the service can share a cache file with them
+    if image_format == 'svg':
+        return render_cache_key(input_string, settings) + ('svg',)
+    return render_cache_key(input_string, settings)
+
+
+def render_service_batch(input_strings, settings, image_format):
+    # this runs on the render thread or in a render process, and returns (image bytes, width, height) for each value,
+    # or the exception it failed with. svg images have no pixel size, so their width and height are 0
+    rendered_barcodes = []
+    for input_string in input_strings:
+        try:
+            if image_format == 'svg':
+                rendered_barcodes.append((generate_barcode_svg(input_string, settings), 0, 0))
+            else:
+                rendered_barcodes.append(generate_barcode(input_string, settings))
+        except Exception as barcode_error:
+            rendered_barcodes.append(barcode_error)
+    return rendered_barcodes
+
+
+def latency_percentile(sorted_samples, percentile):
+    return sorted_samples[min(len(sorted_samples) - 1, int(round(percentile / 100 * (len(sorted_samples) - 1))))]
+
+
+async def read_http_request(reader, max_request_bytes=service_max_request_bytes):
+    # returns (method, target, headers, body), or None when the client has closed the connection.
+    # the body's length is checked before any of it is read
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, http_version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise ServiceRequestError(400, "Malformed request line")
+    headers = {}
+    while True:
+        header_line = await reader.readline()
+        if header_line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= service_max_header_lines:
+            raise ServiceRequestError(400, "Too many headers")
+        header_name, _, header_value = header_line.decode('latin-1').partition(':')
+        headers[header_name.strip().lower()] = header_value.strip()
+    if http_version == 'HTTP/1.0' and headers.get('connection', '').lower() != 'keep-alive':
+        headers['connection'] = 'close'
+    try:
+        content_length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise ServiceRequestError(400, "Malformed content length")
+    if content_length < 0:
+        raise ServiceRequestError(400, "Malformed content length")
+    if content_length > max_request_bytes:
+        raise ServiceRequestError(413, "Request is larger than " + str(max_request_bytes) + " bytes")
+    body = await reader.readexactly(content_length) if content_length > 0 else b''
+    return method, target, headers, body
+
+
+def json_response(status, response_object):
+    return status, 'application/json', json.dumps(response_object).encode('utf8'), {}
+
+
+class RenderService():
+    # settings are the ones requests start from. with render_workers above 1, renders go to that many forked
+    # processes, otherwise to one thread. max_queued_renders is how many values can be waiting for a render
+    # before requests are turned away, and max_request_bytes the largest request body read
+    def __init__(self, settings, render_cache=None, render_workers=1, max_queued_renders=1024,
+                 max_request_bytes=service_max_request_bytes):
+        self.settings = dict(settings)
+        if render_cache is None:
+            render_cache = BarcodeRenderCache()
+        self.render_cache = render_cache
+        self.render_workers = max(render_workers, 1)
+        self.max_queued_renders = max_queued_renders
+        self.max_request_bytes = max_request_bytes
+        self.render_executor = None
+        self.render_slots = asyncio.Semaphore(self.render_workers)
+        self.renders_in_flight = {}
+        self.queued_renders = 0
+        self.normalizers = {}
+        self.counters = collections.Counter()
+        self.latency_counts = collections.Counter()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=service_latency_samples))
+        self.start_time = time.monotonic()
+
+    def warm_up(self):
+        # renders one barcode of each type and format before the first request, so that python-barcode, pillow
+        # and the fonts are loaded by then, and forked render processes start with them loaded too
+        for barcode_type in supported_barcode_types:
+            warm_up_settings = dict(self.settings, barcode_type=barcode_type)
+            warm_up_value, _ = get_barcode_value_normalizer(barcode_type, True)('1')
+            for image_format in service_image_formats:
+                render_service_batch([warm_up_value], warm_up_settings, image_format)
+
+    def start(self):
+        # this has to run before the service starts listening. render processes are forked all at once by their
+        # first job, and one forked while a request was being answered would hold a copy of its connection open
+        render_process_context = get_render_process_context()
+        if self.render_workers > 1 and render_process_context is not None:
+            self.render_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.render_workers,
+                                                                          mp_context=render_process_context)
+            self.render_executor.submit(int).result()
+        else:
+            self.render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.render_workers)
+
+    def close(self):
+        if self.render_executor is not None:
+            self.render_executor.shutdown(cancel_futures=True)
+            self.render_executor = None
+
+    def get_normalizer(self, settings):
+        normalizer_key = (settings['barcode_type'], settings['pad_ean_barcodes'])
+        if normalizer_key not in self.normalizers:
+            self.normalizers[normalizer_key] = get_barcode_value_normalizer(*normalizer_key)
+        return self.normalizers[normalizer_key]
+
+    def request_settings(self, setting_values):
+        # the service's settings, with the ones given in a request put over them
+        settings = dict(self.settings)
+        for setting_name, setting_value in setting_values.items():
+            if setting_name not in settings:
+                raise ServiceRequestError(400, "Unknown setting " + str(setting_name))
+            try:
+                if isinstance(settings[setting_name], bool):
+                    if isinstance(setting_value, str):
+                        setting_value = setting_value.lower() in ('1', 'true', 'yes', 'on')
+                    settings[setting_name] = bool(setting_value)
+                elif isinstance(settings[setting_name], int):
+                    settings[setting_name] = int(setting_value)
+                else:
+                    settings[setting_name] = str(setting_value)
+            except (TypeError, ValueError):
+                raise ServiceRequestError(400, "Setting " + setting_name + " must be a number")
+        settings_problems = check_settings(settings)
+        if settings_problems:
+            raise ServiceRequestError(400, ", ".join(settings_problems))
+        return settings
+
+    async def render_values(self, input_values, settings, image_format):
+        # returns a list with (image bytes, width, height) or an error message for each value, and how many
+        # of the values had to be rendered, rather than coming from the cache
+        normalize_value = self.get_normalizer(settings)
+        value_results = []
+        found_barcodes = {}
+        waiting_renders = {}
+        new_renders = []
+        for input_value in input_values:
+            normalized_value, error_code = normalize_value('' if input_value is None else str(input_value))
+            if error_code is not None:
+                value_results.append(barcode_value_error_message(error_code, settings['barcode_type']))
+                continue
+            cache_key = service_cache_key(normalized_value, settings, image_format)
+            value_results.append(cache_key)
+            if cache_key in found_barcodes or cache_key in waiting_renders:
+                continue
+            cached_barcode = self.render_cache.get(cache_key)
+            if cached_barcode is not None:
+                found_barcodes[cache_key] = cached_barcode
+            elif cache_key in self.renders_in_flight:
+                waiting_renders[cache_key] = self.renders_in_flight[cache_key]
+            else:
+                # the future other requests can wait on is only made once this request isn't turned away
+                waiting_renders[cache_key] = None
+                new_renders.append((cache_key, normalized_value))
+        if new_renders:
+            # a request that would fill the backlog on its own could never get in, so it isn't asked to retry
+            if len(new_renders) > self.max_queued_renders:
+                self.counters['rejected'] += 1
+                raise ServiceRequestError(413, "Request has more than " + str(self.max_queued_renders) +
+                                          " barcodes to render")
+            if self.queued_renders + len(new_renders) > self.max_queued_renders:
+                self.counters['rejected'] += 1
+                raise ServiceRequestError(503, "Too many barcodes waiting to be rendered, try again later")
+            for cache_key, _ in new_renders:
+                render_future = asyncio.get_running_loop().create_future()
+                self.renders_in_flight[cache_key] = render_future
+                waiting_renders[cache_key] = render_future
+            await self.run_renders(new_renders, settings, image_format)
+        for cache_key, render_future in waiting_renders.items():
+            try:
+                found_barcodes[cache_key] = await render_future
+            except Exception as render_error:
+                found_barcodes[cache_key] = str(render_error)
+        return [found_barcodes[value_result] if isinstance(value_result, tuple) else value_result
+                for value_result in value_results], len(waiting_renders)
+
+    async def run_renders(self, new_renders, settings, image_format):
+        # renders the values of one request together on the render executor, handing each image to the future
+        # that requests for that value are waiting on. render_values has already checked the backlog has room
+        render_keys = [cache_key for cache_key, _ in new_renders]
+        try:
+            self.queued_renders += len(new_renders)
+            try:
+                await self.render_slots.acquire()
+            finally:
+                self.queued_renders -= len(new_renders)
+            try:
+                render_start_time = time.perf_counter()
+                rendered_barcodes = await asyncio.get_running_loop().run_in_executor(
+                    self.render_executor, render_service_batch,
+                    [normalized_value for _, normalized_value in new_renders], settings, image_format)
+                self.record_latency('render executor', time.perf_counter() - render_start_time)
+            finally:
+                self.render_slots.release()
+        except BaseException as render_error:
+            # whatever stopped this render also fails any other request waiting on these values
+            if not isinstance(render_error, Exception):
+                render_error = ServiceRequestError(503, "Render was cancelled")
+            for cache_key in render_keys:
+                render_future = self.renders_in_flight.pop(cache_key)
+                render_future.set_exception(render_error)
+                # the request this render was for is raising instead of waiting on its futures. reading the
+                # exception marks it as seen, so asyncio doesn't log it for futures no other request joined
+                render_future.exception()
+            raise
+        self.counters['renders'] += len(rendered_barcodes)
+        for cache_key, rendered_barcode in zip(render_keys, rendered_barcodes):
+            render_future = self.renders_in_flight.pop(cache_key)
+            if isinstance(rendered_barcode, Exception):
+                self.counters['render errors'] += 1
+                render_future.set_exception(rendered_barcode)
+            else:
+                self.render_cache.put(cache_key, *rendered_barcode)
+                render_future.set_result(rendered_barcode)
+
+    async def render_single(self, query):
+        if 'value' not in query:
+            raise ServiceRequestError(400, "No value given")
+        input_value = query.pop('value')
+        image_format = query.pop('format', 'png')
+        if image_format not in service_image_formats:
+            raise ServiceRequestError(400, "Format must be one of " + ", ".join(service_image_formats))
+        settings = self.request_settings(query)
+        value_results, render_count = await self.render_values([input_value], settings, image_format)
+        if isinstance(value_results[0], str):
+            raise ServiceRequestError(400, value_results[0])
+        image_bytes, width, height = value_results[0]
+        response_headers = {}
+        if image_format == 'png':
+            response_headers = {'X-Barcode-Width': str(width), 'X-Barcode-Height': str(height)}
+        return ('render' if render_count else 'render cached'), \
+            (200, service_image_formats[image_format], image_bytes, response_headers)
+
+    async def render_batch(self, body):
+        try:
+            batch_request = json.loads(body)
+        except ValueError:
+            raise ServiceRequestError(400, "Request body is not json")
+        if not isinstance(batch_request, dict) or not isinstance(batch_request.get('values'), list):
+            raise ServiceRequestError(400, "Request needs a list of values")
+        if len(batch_request['values']) > service_max_batch_values:
+            raise ServiceRequestError(413, "Request has more than " + str(service_max_batch_values) + " values")
+        image_format = batch_request.get('format', 'png')
+        if image_format not in service_image_formats:
+            raise ServiceRequestError(400, "Format must be one of " + ", ".join(service_image_formats))
+        if not isinstance(batch_request.get('settings', {}), dict):
+            raise ServiceRequestError(400, "Settings must be an object")
+        settings = self.request_settings(batch_request.get('settings', {}))
+        value_results, render_count = await self.render_values(batch_request['values'], settings, image_format)
+        batch_barcodes = []
+        for input_value, value_result in zip(batch_request['values'], value_results):
+            if isinstance(value_result, str):
+                batch_barcodes.append({'value': input_value, 'error': value_result})
+                continue
+            image_bytes, width, height = value_result
+            batch_barcodes.append({'value': input_value, 'data': base64.b64encode(image_bytes).decode('ascii'),
+                                   'width': width, 'height': height})
+        return ('render batch' if render_count else 'render batch cached'), json_response(200,
+                                                                                          {'barcodes': batch_barcodes})
+
+    async def handle_request(self, method, target, body):
+        # returns the name the request's latency is recorded under, and (status, content type, body, headers)
+        request_url = urllib.parse.urlsplit(target)
+        if request_url.path == '/render':
+            if method == 'GET':
+                return await self.render_single(dict(urllib.parse.parse_qsl(request_url.query,
+                                                                            keep_blank_values=True)))
+            if method == 'POST':
+                return await self.render_batch(body)
+            raise ServiceRequestError(405, "Render takes GET or POST")
+        if request_url.path == '/metrics':
+            if method == 'GET':
+                return 'metrics', json_response(200, self.metrics())
+            raise ServiceRequestError(405, "Metrics takes GET")
+        raise ServiceRequestError(404, "Nothing at " + request_url.path)
+
+    async def handle_connection(self, reader, writer):
+        # connections are kept open between requests unless the client asks otherwise
+        try:
+            while True:
+                keep_alive = True
+                try:
+                    http_request = await read_http_request(reader, self.max_request_bytes)
+                    if http_request is None:
+                        break
+                    method, target, headers, body = http_request
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    request_start_time = time.perf_counter()
+                    self.counters['requests'] += 1
+                    try:
+                        latency_name, (status, content_type, response_body, response_headers) = \
+                            await self.handle_request(method, target, body)
+                    except ServiceRequestError as request_error:
+                        latency_name = 'error'
+                        status, content_type, response_body, response_headers = json_response(
+                            request_error.status, {'error': str(request_error)})
+                    except Exception as request_error:
+                        logger.exception("render service request failed")
+                        latency_name = 'error'
+                        status, content_type, response_body, response_headers = json_response(
+                            500, {'error': str(request_error)})
+                except (ServiceRequestError, ValueError) as request_error:
+                    # the request couldn't be read, so the connection can't be trusted to be at the next one
+                    keep_alive = False
+                    request_start_time = None
+                    status, content_type, response_body, response_headers = json_response(
+                        getattr(request_error, 'status', 400), {'error': str(request_error)})
+                if status >= 400:
+                    self.counters['errors'] += 1
+                response_head = ['HTTP/1.1 ' + str(status) + ' ' + http.HTTPStatus(status).phrase,
+                                 'Content-Type: ' + content_type, 'Content-Length: ' + str(len(response_body)),
+                                 'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+                response_head.extend(header_name + ': ' + header_value
+                                     for header_name, header_value in response_headers.items())
+                writer.write(('\r\n'.join(response_head) + '\r\n\r\n').encode('latin-1') + response_body)
+                await writer.drain()
+                if request_start_time is not None:
+                    self.record_latency(latency_name, time.perf_counter() - request_start_time)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def record_latency(self, latency_name, seconds):
+        self.latency_counts[latency_name] += 1
+        self.latencies[latency_name].append(seconds)
+
+    def metrics(self):
+        # latency percentiles are over the most recent requests of each kind, counts are since the service started
+        service_metrics = {
+            'uptime_seconds': round(time.monotonic() - self.start_time, 1),
+            'counters': dict(self.counters),
+            'renders_in_flight': len(self.renders_in_flight),
+            'queued_renders': self.queued_renders,
+            'render_workers': self.render_workers,
+            'render_cache': {'entries': len(self.render_cache), 'bytes': self.render_cache.total_bytes,
+                             'hits': self.render_cache.hits, 'misses': self.render_cache.misses},
+            'latency_ms': {},
+        }
+        for latency_name, latency_samples in self.latencies.items():
+            sorted_samples = sorted(latency_samples)
+            service_metrics['latency_ms'][latency_name] = {
+                'count': self.latency_counts[latency_name],
+                'p50': round(latency_percentile(sorted_samples, 50) * 1000, 3),
+                'p90': round(latency_percentile(sorted_samples, 90) * 1000, 3),
+                'p99': round(latency_percentile(sorted_samples, 99) * 1000, 3),
+                'max': round(sorted_samples[-1] * 1000, 3),
+            }
+        return service_metrics
+
+
+def run_render_service(render_service, host='127.0.0.1', port=8470, unix_socket_path=None, ready_callback=None):
+    # serves until interrupted. ready_callback is called with a description of where the service is listening
+    async def serve():
+        if unix_socket_path is not None:
+            server = await asyncio.start_unix_server(render_service.handle_connection, path=unix_socket_path)
+            listening_on = unix_socket_path
+        else:
+            server = await asyncio.start_server(render_service.handle_connection, host, port)
+            listening_on = 'http://' + host + ':' + str(server.sockets[0].getsockname()[1])
+        async with server:
+            if ready_callback is not None:
+                ready_callback(listening_on)
+            await server.serve_forever()
+
+    render_service.warm_up()
+    render_service.start()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        render_service.close()
+        if unix_socket_path is not None and os.path.exists(unix_socket_path):
+            os.remove(unix_socket_path)
@@ -0,0 +1,107 @@
+# this module holds the program's settings, what they can be set to, and how they are read from the configuration
+# file. it is kept apart from the processing code so that the settings can be checked, and the interface shown,
+# without loading openpyxl, pillow and python-barcode first
+
+appname = "Barcode Insert Utility"
+
+supported_barcode_types = ['code39', 'ean8', 'ean13', 'UPC']
+
+
+def get_column_letter(column_number):
+    # this is openpyxl.utils.get_column_letter, done here so that checking the settings doesn't need openpyxl
+    column_letter = ''
+    while column_number > 0:
+        column_number, letter_index = divmod(column_number - 1, 26)
+        column_letter = chr(ord('A') + letter_index) + column_letter
+    return column_letter
+
+
+column_letter_tuple = tuple(get_column_letter(column_number) for column_number in range(1, 201))
+column_letter_list = list(column_letter_tuple)
+
+# these are the acceptable ranges for the numeric settings, shared between the config check and the command line
+barcode_dpi_range = range(120, 400)
+barcode_module_height_range = range(5, 50)
+barcode_border_range = range(0, 25)
+barcode_font_size_range = range(0, 15)
+barcode_font_point_size_range = range(6, 144)
+barcode_png_compression_range = range(0, 10)
+
+# image puts a rendered picture of each barcode over its cell, font writes the barcode as text for a barcode font
+barcode_output_modes = ['image', 'font']
+
+# single barcodes, and the export command, can write any of these. svg is drawn straight from the bars, so it
+# isn't affected by dpi, pdf is the png on a page of its own size
+barcode_export_formats = ['png', 'svg', 'pdf']
+
+# how the png of each barcode is stored. rgb is what the program always wrote, grayscale is the same picture at about
+# half the size, bilevel is one bit per pixel and the smallest by far, but the antialiased edges of the text under
+# the bars come out hard. without text, bilevel loses nothing
+barcode_png_modes = ['rgb', 'grayscale', 'bilevel']
+
+# the settings a new configuration file starts with
+default_settings = {
+    'barcode_type': 'code39',
+    'barcode_dpi': 120,
+    'barcode_module_height': 5,
+    'barcode_border': 0,
+    'barcode_font_size': 6,
+    'input_data_column': 'B',
+    'barcode_output_column': 'A',
+    'pad_ean_barcodes': False,
+    'barcode_output_mode': 'image',
+    'barcode_font_name': 'Libre Barcode 39',
+    'barcode_font_point_size': 28,
+    'barcode_png_mode': 'rgb',
+    'barcode_png_compression': 6,
+}
+
+
+def settings_from_config(config):
+    # this reads the barcode settings out of the configuration file into a plain dictionary
+    return {
+        'barcode_type': config.get('settings', 'barcode type'),
+        'barcode_dpi': config.getint('settings', 'barcode_dpi'),
+        'barcode_module_height': config.getint('settings', 'barcode_module_height'),
+        'barcode_border': config.getint('settings', 'barcode_border'),
+        'barcode_font_size': config.getint('settings', 'barcode_font_size'),
+        'input_data_column': config.get('settings', 'input_data_column'),
+        'barcode_output_column': config.get('settings', 'barcode_output_column'),
+        'pad_ean_barcodes': config.getboolean('settings', 'pad ean barcodes'),
+        # the output mode options were added later, so older configuration files won't have them
+        'barcode_output_mode': config.get('settings', 'barcode output mode', fallback='image'),
+        'barcode_font_name': config.get('settings', 'barcode font name', fallback='Libre Barcode 39'),
+        'barcode_font_point_size': config.getint('settings', 'barcode font point size', fallback=28),
+        'barcode_png_mode': config.get('settings', 'barcode png mode', fallback='rgb'),
+        'barcode_png_compression': config.getint('settings', 'barcode png compression', fallback=6),
+    }
+
+
+def check_settings(settings):
+    # returns a list of problems with the supplied settings, an empty list means they are usable
+    problems = []
+    if settings['barcode_type'] not in supported_barcode_types:
+        problems.append("barcode type must be one of " + ", ".join(supported_barcode_types))
+    if settings['barcode_dpi'] not in barcode_dpi_range:
+        problems.append("barcode dpi must be between 120 and 399")
+    if settings['barcode_module_height'] not in barcode_module_height_range:
+        problems.append("barcode module height must be between 5 and 49")
+    if settings['barcode_border'] not in barcode_border_range:
+        problems.append("barcode border must be between 0 and 24")
+    if settings['barcode_font_size'] not in barcode_font_size_range:
+        problems.append("barcode font size must be between 0 and 14")
+    if settings['input_data_column'] not in column_letter_list:
+        problems.append("input column must be a column letter between A and " + column_letter_list[-1])
+    if settings['barcode_output_column'] not in column_letter_list:
+        problems.append("output column must be a column letter between A and " + column_letter_list[-1])
+    if settings['barcode_output_mode'] not in barcode_output_modes:
+        problems.append("output mode must be one of " + ", ".join(barcode_output_modes))
+    if settings['barcode_output_mode'] == 'font' and settings['barcode_type'] != 'code39':
+        problems.append("font output mode only works with code39 barcodes")
+    if settings['barcode_font_point_size'] not in barcode_font_point_size_range:
+        problems.append("barcode font point size must be between 6 and 143")
+    if settings['barcode_png_mode'] not in barcode_png_modes:
+        problems.append("png mode must be one of " + ", ".join(barcode_png_modes))
+    if settings['barcode_png_compression'] not in barcode_png_compression_range:
+        problems.append("png compression must be between 0 and 9")
+    return problems
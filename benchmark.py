@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import tempfile
+import shutil
+import random
+import time
+import json
+import platform
+import datetime
+import importlib.metadata
+import subprocess
+import statistics
+import openpyxl
+from barcode_settings import supported_barcode_types, default_settings
+from barcode_processing import interpret_barcode_string, generate_barcode, BarcodeImage, save_workbook, \
+    do_process_workbook, BarcodeRenderCache, BarcodeImageStore
+
+# this times the workbook processing, both the whole do_process_workbook path and its pieces on their own, against
+# generated workbooks and the bundled sample workbook. results are written as json, so that a later run can be
+# compared against them with --compare to catch rendering or save time regressions
+
+# baselines from version 1 were rendered at 200 dpi instead of the default
+benchmark_file_version = 2
+
+program_folder = os.path.dirname(os.path.abspath(__file__))
+sample_workbook_path = os.path.join(program_folder, 'stripped sample data.xlsx')
+
+benchmark_suites = ['startup', 'pieces', 'full']
+
+# the settings a new configuration file starts with, which is what a first run of the program renders with
+benchmark_settings = dict(default_settings)
+
+# digits each generated value has, these are the lengths that don't need padding
+generated_value_lengths = {'ean8': 7, 'ean13': 12, 'UPC': 11}
+
+
+def get_benchmark_settings(barcode_type, pad_ean_barcodes=False):
+    return dict(benchmark_settings, barcode_type=barcode_type, pad_ean_barcodes=pad_ean_barcodes)
+
+
+def generate_values(barcode_type, row_count, duplicate_ratio, seed=0):
+    # returns row_count values, of which about duplicate_ratio are repeats of an earlier value.
+    # numeric types get numbers, as they would be typed into a spreadsheet, code39 gets part number strings
+    value_random = random.Random(seed)
+    distinct_count = max(1, int(round(row_count * (1 - duplicate_ratio))))
+    distinct_values = []
+    while len(distinct_values) < distinct_count:
+        if barcode_type == 'code39':
+            distinct_values.append("SKU-" + str(value_random.randrange(10 ** 7)).zfill(7))
+        else:
+            # no leading zero, as the cell would lose it
+            value_length = generated_value_lengths[barcode_type]
+            distinct_values.append(value_random.randrange(10 ** (value_length - 1), 10 ** value_length))
+    values = list(distinct_values)
+    while len(values) < row_count:
+        values.append(value_random.choice(distinct_values))
+    value_random.shuffle(values)
+    return values
+
+
+def write_benchmark_workbook(workbook_path, values):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for value in values:
+        ws.append([None, value])
+    wb.save(workbook_path)
+
+
+def time_call(repeat, function, *function_args):
+    # returns the fastest of repeat runs in seconds, and what the last run returned
+    fastest_seconds = None
+    function_result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function_result = function(*function_args)
+        run_seconds = time.perf_counter() - start_time
+        if fastest_seconds is None or run_seconds < fastest_seconds:
+            fastest_seconds = run_seconds
+    return fastest_seconds, function_result
+
+
+def benchmark_result(seconds, rows, **extra_fields):
+    result = {'seconds': round(seconds, 4), 'rows': rows}
+    if seconds > 0:
+        result['rows_per_second'] = round(rows / seconds, 1)
+    result.update(extra_fields)
+    return result
+
+
+def benchmark_interpret(barcode_type, values, repeat):
+    value_strings = [str(value) for value in values]
+
+    def interpret_values():
+        for value_string in value_strings:
+            interpret_barcode_string(value_string, barcode_type, False)
+
+    seconds, _ = time_call(repeat, interpret_values)
+    return benchmark_result(seconds, len(values))
+
+
+def benchmark_generate(barcode_type, render_count, repeat):
+    # renders distinct values without a render cache, so every one of them goes through the image writer
+    settings = get_benchmark_settings(barcode_type)
+    input_strings = [interpret_barcode_string(str(value), barcode_type, False) for value in
+                     generate_values(barcode_type, render_count, 0)]
+
+    def generate_values_once():
+        png_size = 0
+        for input_string in input_strings:
+            png_size += len(generate_barcode(input_string, settings)[0])
+        return png_size
+
+    seconds, png_size = time_call(repeat, generate_values_once)
+    return benchmark_result(seconds, render_count, png_bytes=png_size)
+
+
+def build_image_workbook(values, png_bytes, width, height):
+    # inserts an image for every value the way do_process_workbook does, repeated values sharing a media file.
+    # every value gets the same picture, so that this times inserting and saving rather than rendering
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    media_paths = {}
+    image_store = BarcodeImageStore()
+    for row_number, value in enumerate(values, start=1):
+        ws.row_dimensions[row_number].height = height * .75
+        if value not in media_paths:
+            media_paths[value] = "/xl/media/barcode" + str(len(media_paths) + 1) + ".png"
+            image_store.add(media_paths[value], png_bytes)
+        ws.add_image(BarcodeImage(None, width, height, media_paths[value], image_store=image_store),
+                     anchor='A' + str(row_number))
+    return wb
+
+
+def benchmark_insert_and_save(values, work_directory, repeat):
+    png_bytes, width, height = generate_barcode('123456789012', get_benchmark_settings('ean13'))
+    insert_seconds, wb = time_call(repeat, build_image_workbook, values, png_bytes, width, height)
+    saved_workbook_path = os.path.join(work_directory, 'save benchmark.xlsx')
+    save_seconds, _ = time_call(repeat, save_workbook, wb, saved_workbook_path)
+    insert_result = benchmark_result(insert_seconds, len(values))
+    save_result = benchmark_result(save_seconds, len(values), bytes_written=os.path.getsize(saved_workbook_path))
+    os.remove(saved_workbook_path)
+    return insert_result, save_result
+
+
+def benchmark_full_path(old_workbook_path, work_directory, settings, repeat):
+    # the render cache starts empty on every run, as it would for a first run of the program
+    new_workbook_path = os.path.join(work_directory, 'full benchmark output.xlsx')
+    seconds, process_stats = time_call(
+        repeat, lambda: do_process_workbook(old_workbook_path, new_workbook_path, settings,
+                                            render_cache=BarcodeRenderCache()))
+    os.remove(new_workbook_path)
+    return benchmark_result(seconds, process_stats['rows'], inserted=process_stats['inserted'],
+                            stages=process_stats['timing']['stages'],
+                            counters=process_stats['timing']['counters'],
+                            peak_memory_bytes=process_stats['timing'].get('peak_memory_bytes'))
+
+
+def benchmark_startup(command_arguments, work_directory, runs):
+    # times a fresh python process running command_arguments, which is what launching the program from a script
+    # costs. the configuration file goes in work_directory, so each run starts from the same default settings
+    startup_environment = dict(os.environ, HOME=work_directory, XDG_DATA_HOME=work_directory, APPDATA=work_directory)
+    run_seconds = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable] + command_arguments, cwd=work_directory, env=startup_environment,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        run_seconds.append(time.perf_counter() - start_time)
+    return {'seconds': round(min(run_seconds), 4), 'median_seconds': round(statistics.median(run_seconds), 4),
+            'runs': runs}
+
+
+def run_startup_benchmarks(work_directory, runs, record):
+    main_path = os.path.join(program_folder, 'main.py')
+    record("startup/main --help", benchmark_startup([main_path, '--help'], work_directory, runs))
+    for module_name in ('barcode_settings', 'barcode_processing'):
+        record("startup/import " + module_name, benchmark_startup(
+            ['-c', "import sys; sys.path.insert(0, " + repr(program_folder) + "); import " + module_name],
+            work_directory, runs))
+    # a one row workbook, so that this is nearly all startup
+    one_row_workbook_path = os.path.join(work_directory, 'one row.xlsx')
+    write_benchmark_workbook(one_row_workbook_path, generate_values('ean8', 1, 0))
+    record("startup/process one row", benchmark_startup(
+        [main_path, 'process', one_row_workbook_path, os.path.join(work_directory, 'one row output.xlsx'),
+         '--type', 'ean8', '--input_column', 'B', '--output_column', 'A'], work_directory, runs))
+
+
+def get_environment():
+    environment = {'python': platform.python_version(), 'platform': platform.platform(),
+                   'cpus': os.cpu_count(), 'packages': {}}
+    for package_name in ('python-barcode', 'openpyxl', 'pillow'):
+        try:
+            environment['packages'][package_name] = importlib.metadata.version(package_name)
+        except importlib.metadata.PackageNotFoundError:
+            environment['packages'][package_name] = None
+    return environment
+
+
+def run_benchmarks(suites, sizes, duplicate_ratios, barcode_types, render_count, repeat, startup_runs,
+                   work_directory, progress):
+    results = {}
+
+    def record(result_name, result):
+        results[result_name] = result
+        progress(result_name + ": " + str(result['seconds']) + "s")
+
+    if 'startup' in suites:
+        run_startup_benchmarks(work_directory, startup_runs, record)
+    if 'pieces' in suites:
+        largest_size = max(sizes)
+        for barcode_type in barcode_types:
+            record("interpret/" + barcode_type + "/" + str(largest_size),
+                   benchmark_interpret(barcode_type, generate_values(barcode_type, largest_size, 0), repeat))
+            record("generate/" + barcode_type + "/" + str(render_count),
+                   benchmark_generate(barcode_type, render_count, repeat))
+        for size in sizes:
+            for duplicate_ratio in duplicate_ratios:
+                size_name = str(size) + "/duplicates " + str(duplicate_ratio)
+                insert_result, save_result = benchmark_insert_and_save(
+                    generate_values('ean13', size, duplicate_ratio), work_directory, repeat)
+                record("insert/" + size_name, insert_result)
+                record("save/" + size_name, save_result)
+    if 'full' not in suites:
+        return results
+    for size in sizes:
+        for duplicate_ratio in duplicate_ratios:
+            size_name = str(size) + "/duplicates " + str(duplicate_ratio)
+            for barcode_type in barcode_types:
+                workbook_path = os.path.join(work_directory, 'benchmark input.xlsx')
+                write_benchmark_workbook(workbook_path, generate_values(barcode_type, size, duplicate_ratio))
+                record("full/" + barcode_type + "/" + size_name,
+                       benchmark_full_path(workbook_path, work_directory, get_benchmark_settings(barcode_type),
+                                           repeat))
+    if os.path.isfile(sample_workbook_path):
+        # the sample workbook holds six digit values, which are ean8 codes once padded
+        record("full/sample workbook", benchmark_full_path(sample_workbook_path, work_directory,
+                                                           get_benchmark_settings('ean8', True), repeat))
+    return results
+
+
+def compare_results(results, baseline_results, tolerance):
+    # returns the names of results that are more than tolerance slower than the baseline, printing each comparison
+    regressions = []
+    for result_name, result in results.items():
+        if result_name not in baseline_results:
+            continue
+        baseline_seconds = baseline_results[result_name]['seconds']
+        if baseline_seconds <= 0:
+            continue
+        change = result['seconds'] / baseline_seconds - 1
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(result_name)
+        print(result_name + ": " + str(baseline_seconds) + "s -> " + str(result['seconds']) + "s (" +
+              format(change, '+.1%') + ")" + (" REGRESSION" if regressed else ""))
+    return regressions
+
+
+def parse_list(list_string, item_type):
+    return [item_type(item.strip()) for item in list_string.split(',') if item.strip()]
+
+
+def main():
+    benchmark_options = argparse.ArgumentParser(description="time barcode insertion against generated workbooks")
+    benchmark_options.add_argument('--suites', default=",".join(benchmark_suites),
+                                   help="comma separated benchmarks to run, out of " + ", ".join(benchmark_suites))
+    benchmark_options.add_argument('--sizes', default='1000,10000,100000',
+                                   help="comma separated row counts of the generated workbooks")
+    benchmark_options.add_argument('--duplicate_ratios', default='0,0.5,0.9',
+                                   help="comma separated fractions of rows repeating an earlier value")
+    benchmark_options.add_argument('--types', default=",".join(supported_barcode_types),
+                                   help="comma separated barcode types to benchmark")
+    benchmark_options.add_argument('--render_count', type=int, default=200,
+                                   help="number of barcodes rendered when timing generate_barcode")
+    benchmark_options.add_argument('--repeat', type=int, default=1,
+                                   help="run each benchmark this many times and keep the fastest")
+    benchmark_options.add_argument('--startup_runs', type=int, default=10,
+                                   help="number of times each startup benchmark launches python")
+    benchmark_options.add_argument('--output', metavar='RESULTS_FILE', help="write the results to this json file")
+    benchmark_options.add_argument('--compare', metavar='BASELINE_FILE',
+                                   help="compare the results against an earlier results file")
+    benchmark_options.add_argument('--tolerance', type=float, default=0.25,
+                                   help="how much slower than the baseline a result can be before it is a "
+                                        "regression, as a fraction")
+    benchmark_args = benchmark_options.parse_args()
+
+    suites = parse_list(benchmark_args.suites, str)
+    for suite in suites:
+        if suite not in benchmark_suites:
+            print("benchmark suites must be out of " + ", ".join(benchmark_suites), file=sys.stderr)
+            return 2
+    barcode_types = parse_list(benchmark_args.types, str)
+    for barcode_type in barcode_types:
+        if barcode_type not in supported_barcode_types:
+            print("barcode type must be one of " + ", ".join(supported_barcode_types), file=sys.stderr)
+            return 2
+    sizes = parse_list(benchmark_args.sizes, int)
+    duplicate_ratios = parse_list(benchmark_args.duplicate_ratios, float)
+    if not sizes or min(sizes) < 1 or not all(0 <= ratio < 1 for ratio in duplicate_ratios):
+        print("sizes must be at least 1, and duplicate ratios from 0 up to 1", file=sys.stderr)
+        return 2
+    baseline = None
+    if benchmark_args.compare is not None:
+        with open(benchmark_args.compare, encoding='utf8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('version') != benchmark_file_version:
+            print("Baseline " + benchmark_args.compare + " is from a different benchmark version", file=sys.stderr)
+            return 2
+
+    work_directory = tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(suites, sizes, duplicate_ratios, barcode_types, benchmark_args.render_count,
+                                 max(1, benchmark_args.repeat), max(1, benchmark_args.startup_runs), work_directory,
+                                 print)
+    finally:
+        shutil.rmtree(work_directory)
+    benchmark_run = {'version': benchmark_file_version,
+                     'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                     'environment': get_environment(), 'results': results}
+    if benchmark_args.output is not None:
+        with open(benchmark_args.output, 'w', encoding='utf8') as results_file:
+            json.dump(benchmark_run, results_file, indent=4)
+    if baseline is not None:
+        regressions = compare_results(results, baseline['results'], benchmark_args.tolerance)
+        if regressions:
+            print(str(len(regressions)) + " benchmarks are slower than the baseline", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,38 +1,23 @@
 #!/usr/bin/env python3
 
-import shutil
-import warnings
-import barcode
-import openpyxl
-import openpyxl.utils
-from openpyxl.drawing.image import Image as OpenPyXlImage
-from PIL import Image as pil_Image
-import ImageOps as pil_ImageOps
-import math
-from barcode.writer import ImageWriter
-import tkinter
-import tkinter.ttk
-import tkinter.filedialog
-import tkinter.messagebox
-import tempfile
+import sys
 import argparse
 import textwrap
 import threading
-import platform
+import queue
 import os
 import configparser
 import appdirs
-import re
-import io
-import barcode.pybarcode
 import logging
-from contextlib import redirect_stdout
+import json
+import time
+from barcode_settings import appname, supported_barcode_types, barcode_output_modes, barcode_export_formats, \
+    barcode_png_modes, column_letter_tuple, settings_from_config, check_settings
 
-version = '1.7.1'
+# tkinter, and the processing code with openpyxl, pillow and python-barcode behind it, are imported where they are
+# first needed. the headless commands never load tkinter, and the interface opens before the processing code loads
 
-appname = "Barcode Insert Utility"
-
-supported_barcode_types = ['code39', 'ean8', 'ean13', 'UPC']
+version = '1.7.1'
 
 config_folder = appdirs.user_data_dir(appname)
 try:
@@ -49,6 +34,102 @@ launch_options.add_argument('--keep_barcodes_in_cwd', action='store_true',
                             help="temp folder in working directory")
 launch_options.add_argument('--keep_barcode_files', action='store_true', help="don't delete temp files")
 launch_options.add_argument('--reset_configuration', action='store_true', help="remove configuration file")
+launch_commands = launch_options.add_subparsers(dest='command', metavar='command',
+                                                help="run without a command to open the interface")
+# the process, batch, export and serve commands run without the interface, barcode options that aren't given come
+# from the configuration file
+barcode_options = argparse.ArgumentParser(add_help=False)
+barcode_options.add_argument('--type', dest='barcode_type', choices=supported_barcode_types, help="barcode type")
+barcode_options.add_argument('--dpi', dest='barcode_dpi', type=int, help="barcode dpi")
+barcode_options.add_argument('--module_height', dest='barcode_module_height', type=int,
+                             help="barcode bar height in mm")
+barcode_options.add_argument('--border', dest='barcode_border', type=int, help="border around barcode in pixels")
+barcode_options.add_argument('--font_size', dest='barcode_font_size', type=int, help="barcode text size in pt")
+barcode_options.add_argument('--input_column', dest='input_data_column', help="column to read values from")
+barcode_options.add_argument('--output_column', dest='barcode_output_column', help="column to insert barcodes into")
+barcode_options.add_argument('--pad_ean', dest='pad_ean_barcodes', action='store_true', default=None,
+                             help="pad ean and upc values with zeroes")
+barcode_options.add_argument('--no_pad_ean', dest='pad_ean_barcodes', action='store_false',
+                             help="don't pad ean and upc values")
+barcode_options.add_argument('--output_mode', dest='barcode_output_mode', choices=barcode_output_modes,
+                             help="insert barcodes as images, or as text for a code39 barcode font")
+barcode_options.add_argument('--barcode_font', dest='barcode_font_name', metavar='FONT_NAME',
+                             help="font used by the font output mode")
+barcode_options.add_argument('--barcode_font_point_size', dest='barcode_font_point_size', type=int,
+                             help="text size used by the font output mode")
+barcode_options.add_argument('--png_mode', dest='barcode_png_mode', choices=barcode_png_modes,
+                             help="store barcode images as rgb, grayscale or black and white bilevel pngs")
+barcode_options.add_argument('--png_compression', dest='barcode_png_compression', type=int, metavar='LEVEL',
+                             help="zlib level used for barcode images, 0 to 9")
+barcode_options.add_argument('--render_cache', metavar='CACHE_FILE',
+                             help="load rendered barcodes from this file before processing, and save them after")
+barcode_options.add_argument('--render_cache_size', type=int, default=64, metavar='MEGABYTES',
+                             help="maximum size of rendered barcodes kept in the cache")
+barcode_options.add_argument('--workers', type=int, default=1,
+                             help="number of processes rendering barcodes, 0 uses one per cpu")
+workbook_options = argparse.ArgumentParser(add_help=False)
+workbook_options.add_argument('--sheets', metavar='SHEETS',
+                              help="'all', or a comma separated list of sheet names or numbers to process, "
+                                   "defaults to the first sheet")
+workbook_options.add_argument('--stats', metavar='STATS_FILE',
+                              help="write the time spent in each stage and the run's counters to this file as "
+                                   "json, '-' prints them instead")
+workbook_options.add_argument('--profile', metavar='PROFILE_FILE',
+                              help="run under cProfile and write the profile to this file, for reading with pstats. "
+                                   "only this process is profiled, not render or batch worker processes")
+headless_options = argparse.ArgumentParser(add_help=False, parents=[barcode_options, workbook_options])
+headless_options.add_argument('--checkpoint', action='store_true',
+                              help="keep a checkpoint manifest next to each output workbook, and reuse the barcodes "
+                                   "it lists when processing into that workbook again")
+headless_options.add_argument('--checkpoint_minutes', type=float, default=5, metavar='MINUTES',
+                              help="with --checkpoint, how often to save the output workbook while processing")
+headless_options.add_argument('--streaming', action='store_true',
+                              help="stream rows and images through to the output instead of loading the whole "
+                                   "workbook, for workbooks too big to fit in memory. only cell values are kept, "
+                                   "formatting is lost")
+headless_options.add_argument('--image_memory', type=int, default=256, metavar='MEGABYTES',
+                              help="how much of the barcode images to hold in memory until the workbook is saved, "
+                                   "the rest are kept in a temporary file")
+process_options = launch_commands.add_parser('process', parents=[headless_options],
+                                             help="process a workbook without opening the interface")
+process_options.add_argument('input_workbook', help="workbook to read barcode values from")
+process_options.add_argument('output_workbook', help="workbook to write with barcodes inserted")
+process_options.add_argument('--dry_run', action='store_true',
+                             help="work out the column width, row heights and image sizes the output would get, and "
+                                  "about how big it would be, without rendering the barcodes or writing it")
+process_options.add_argument('--error_report', metavar='REPORT_FILE',
+                             help="with --dry_run, write every row that would be skipped and why to this file, as "
+                                  "json if it ends in .json, otherwise as csv")
+process_options.add_argument('--update', action='store_true',
+                             help="the input workbook was processed before, keep its barcodes for rows whose value "
+                                  "hasn't changed, render the rest, and drop barcodes from rows that no longer have "
+                                  "a value. the output can be the input workbook itself")
+batch_options = launch_commands.add_parser('batch', parents=[headless_options],
+                                           help="process many workbooks without opening the interface")
+batch_options.add_argument('input_workbooks', nargs='+', metavar='input',
+                           help="workbooks, folders of workbooks, or glob patterns to process")
+batch_options.add_argument('--output_directory', required=True,
+                           help="folder to write processed workbooks into, under their original names")
+batch_options.add_argument('--jobs', type=int, default=1,
+                           help="number of workbooks processed at once, 0 uses one per cpu")
+batch_options.add_argument('--report', metavar='REPORT_FILE',
+                           help="write a summary of the batch to this file, as json if it ends in .json, "
+                                "otherwise as csv")
+export_options = launch_commands.add_parser('export', parents=[barcode_options, workbook_options],
+                                            help="write every barcode in a workbook to its own file, in a folder or "
+                                                 "a zip file, without making a workbook")
+export_options.add_argument('input_workbook', help="workbook to read barcode values from")
+export_options.add_argument('destination', help="folder to write barcode files into, or a zip file ending in .zip")
+export_options.add_argument('--format', dest='export_format', choices=barcode_export_formats, default='png',
+                            help="file format of the barcodes")
+serve_options = launch_commands.add_parser('serve', parents=[barcode_options],
+                                           help="run a render service that answers barcode images over http")
+serve_options.add_argument('--host', default='127.0.0.1', help="address to listen on")
+serve_options.add_argument('--port', type=int, default=8470, help="port to listen on, 0 picks a free one")
+serve_options.add_argument('--socket', metavar='SOCKET_PATH',
+                           help="listen on this unix socket instead of a tcp port")
+serve_options.add_argument('--max_queued', type=int, default=1024, metavar='VALUES',
+                           help="turn requests away once this many barcodes are waiting to be rendered")
 args = launch_options.parse_args()
 
 if args.reset_configuration:  # remove configuration file if reset_configuration flag is set
@@ -76,142 +157,61 @@ if not os.path.exists(settings_file_path):
 
 config.read(settings_file_path)  # open config file
 
-root_window = tkinter.Tk()
-
-root_window.title("Barcode Insert Utility " + version)
-
-# this builds a list of the launch flags
-flags_list_string = "Flags="
-flags_count = 0
-if args.debug:
-    flags_list_string += "(Debug)"
-    flags_count += 1
-if args.log:
-    flags_list_string += "(Logged)"
-    flags_count += 1
-if args.keep_barcodes_in_cwd:
-    flags_list_string += "(Barcodes In Working Directory)"
-    flags_count += 1
-if args.keep_barcode_files:
-    flags_list_string += "(Keep Barcodes)"
-    flags_count += 1
-if args.reset_configuration:
-    flags_list_string += "(Reset Configuration)"
-    flags_count += 1
-
-old_workbook_path = ""
-new_workbook_path = ""
-
-program_launch_cwd = os.getcwd()
-
-process_workbook_keep_alive = True
-
-
-column_letter_list = []
-column_count = 0
-while column_count < 200:
-    column_count += 1
-    column_letter = openpyxl.utils.get_column_letter(column_count)
-    column_letter_list.append(column_letter)
-column_letter_tuple = tuple(column_letter_list)
-
-barcode_type_variable = tkinter.StringVar()
-pad_ean_option = tkinter.BooleanVar()
-
 
 def invalid_configuration_error():
-    root_window.withdraw()
+    if args.command is not None:
+        print("Configuration file is broken, relaunch program with the option '--reset_configuration'",
+              file=sys.stderr)
+        raise SystemExit(1)
+    import tkinter
+    import tkinter.messagebox
+    tkinter.Tk().withdraw()
     tkinter.messagebox.showerror(title="Batch File Sender Version " + version,
                                  message="Configuration file is broken, "
                                          "relaunch program with the option '--reset_configuration'")
     raise SystemExit
 
 
-# set initial variables for configuration file test
-barcode_dpi_test = None
-barcode_module_height_test = None
-barcode_border_test = None
-barcode_font_size_test = None
-barcode_type_test = None
-invalid_configuration = False
-input_barcode_test_column = None
-output_barcode_test_column = None
-
-# check to see if the following four are integers
-try:
-    barcode_dpi_test = config.getint('settings', 'barcode_dpi')
-    barcode_module_height_test = config.getint('settings', 'barcode_module_height')
-    barcode_border_test = config.getint('settings', 'barcode_border')
-    barcode_font_size_test = config.getint('settings', 'barcode_font_size')
-except ValueError:
-    invalid_configuration_error()
+configured_settings = None
 
+# check that the configuration values can be read, and are in acceptable ranges
 try:
-    input_barcode_test_column = config.get('settings', 'input_data_column')
-    output_barcode_test_column = config.get('settings', 'barcode_output_column')
-    barcode_type_test = config.get('settings', 'barcode type')
-    _ = config.getboolean('settings', 'pad ean barcodes')
-except (configparser.NoOptionError, ValueError):
+    configured_settings = settings_from_config(config)
+except (configparser.NoSectionError, configparser.NoOptionError, ValueError):
     invalid_configuration_error()
-
-# check that values are in acceptable ranges
-if input_barcode_test_column not in column_letter_list or output_barcode_test_column not in column_letter_list:
-    invalid_configuration = True
-if barcode_dpi_test not in range(120, 400):
-    invalid_configuration = True
-if barcode_module_height_test not in range(5, 50):
-    invalid_configuration = True
-if barcode_border_test not in range(0, 25):
-    invalid_configuration = True
-if barcode_font_size_test not in range(0, 15):
-    invalid_configuration = True
-if barcode_type_test not in supported_barcode_types:
-    invalid_configuration = True
-if invalid_configuration:  # if any of the previous values are incorrect, show an error dialog and close out
+if check_settings(configured_settings):  # if any of the values are incorrect, show an error and close out
     invalid_configuration_error()
 
-# the following sets internal open file limits
-try:
-    if platform.system() == 'Windows':
-        import win32file
-
-        file_limit = win32file._getmaxstdio()
-    else:
-        import resource
 
-        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-        file_limit = soft
-except Exception as error:
-    warnings.warn("Getting open file limit failed with: " + str(error) + " setting internal file limit to 100")
-    file_limit = 100
-
-if args.log:
-    class Logger():
-        def __init__(self):
-            self.logger = logging.getLogger('Barcode Insert Utility')
-            self.logger.setLevel(logging.DEBUG)
+# debug output goes to stdout when --debug is set, and to the log file when --log is set, either can be used alone
+class Logger():
+    def __init__(self):
+        self.logger = logging.getLogger(appname)
+        self.logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+        if args.log:
             fh = logging.FileHandler('logfile.log')
-            ch = logging.StreamHandler()
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
             fh.setFormatter(formatter)
-            ch.setFormatter(formatter)
             self.logger.addHandler(fh)
+        if args.debug:
+            ch = logging.StreamHandler(sys.stdout)
+            ch.setFormatter(formatter)
             self.logger.addHandler(ch)
 
-        def write(self, message):
-            self.logger.debug(message)
+    def write(self, message):
+        self.logger.debug(message)
 
-        def flush(self):
-            # this flush method is needed for python 3 compatibility.
-            # this handles the flush command by doing nothing.
-            # you might want to specify some extra behavior here.
-            pass
+    def flush(self):
+        # this flush method is needed for python 3 compatibility.
+        # this handles the flush command by doing nothing.
+        # you might want to specify some extra behavior here.
+        pass
 
 
-    loghandler = Logger()
+loghandler = Logger()
 
 if args.debug:
-    print(launch_options.parse_args())
+    print(args)
 
 
 # this is a wrapper function for print, so that we can have it only spam stdout when debug is set
@@ -222,13 +222,375 @@ def print_if_debug(string):
 
 print_if_debug("Barcode Insert Utility version " + version)
 
-print_if_debug("File limit is: " + str(file_limit))
-
 # get supported formats from pybarcode, in case debugging is required
-with io.StringIO() as buf, redirect_stdout(buf):
-    barcode.pybarcode.list_types(ImageWriter)
-    output = buf.getvalue()
-print_if_debug(output)
+if args.debug:
+    import io
+    from contextlib import redirect_stdout
+    import barcode.pybarcode
+    from barcode.writer import ImageWriter
+    with io.StringIO() as buf, redirect_stdout(buf):
+        barcode.pybarcode.list_types(ImageWriter)
+        output = buf.getvalue()
+    print_if_debug(output)
+
+
+def print_headless_progress(text, value=None, maximum=None):
+    # only steps without a row count are printed, printing every row would flood the terminal
+    if value is None:
+        print(text)
+
+
+def print_headless_memory(timing_summary):
+    # peak memory isn't known on every platform
+    if 'peak_memory_bytes' in timing_summary:
+        memory_text = "peak memory use " + str(round(timing_summary['peak_memory_bytes'] / 1000000, 1)) + " MB"
+        if timing_summary['counters'].get('media_bytes_spilled'):
+            memory_text += ", " + str(round(timing_summary['counters']['media_bytes_spilled'] / 1000000, 1)) + \
+                " MB of barcode images kept on disk"
+        print(memory_text)
+
+
+def print_batch_progress(text, value=None, maximum=None):
+    # the batch command only reports once per workbook, so all of it is printed
+    print(text)
+
+
+def get_headless_settings():
+    # settings given on the command line override the configuration file.
+    # returns None after printing what is wrong if the combined settings aren't usable
+    settings = dict(configured_settings)
+    for setting_name in settings:
+        if getattr(args, setting_name) is not None:
+            settings[setting_name] = getattr(args, setting_name)
+    settings['input_data_column'] = settings['input_data_column'].upper()
+    settings['barcode_output_column'] = settings['barcode_output_column'].upper()
+    settings_problems = check_settings(settings)
+    if settings_problems:
+        for problem in settings_problems:
+            print(problem, file=sys.stderr)
+        return None
+    return settings
+
+
+def get_headless_sheet_selection():
+    if args.sheets is None or args.sheets == 'all':
+        return args.sheets
+    return [sheet.strip() for sheet in args.sheets.split(',')]
+
+
+def load_headless_render_cache():
+    from barcode_processing import BarcodeRenderCache
+    render_cache = BarcodeRenderCache(max_bytes=args.render_cache_size * 1024 * 1024)
+    if args.render_cache is not None:
+        render_cache.load(args.render_cache)
+    return render_cache
+
+
+def save_headless_render_cache(render_cache):
+    if args.render_cache is not None:
+        try:
+            render_cache.save(args.render_cache)
+        except OSError as cache_save_error:
+            print("Error saving render cache: " + str(cache_save_error), file=sys.stderr)
+
+
+def write_headless_stats(run_stats):
+    if args.stats is None:
+        return
+    if args.stats == '-':
+        print(json.dumps(run_stats, indent=4))
+        return
+    try:
+        with open(args.stats, 'w', encoding='utf8') as stats_file:
+            json.dump(run_stats, stats_file, indent=4)
+    except OSError as stats_save_error:
+        print("Error saving stats: " + str(stats_save_error), file=sys.stderr)
+
+
+def run_headless_command(command_function):
+    # runs one of the headless commands, under the profiler if --profile was given
+    if args.profile is None:
+        return command_function()
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(command_function)
+    finally:
+        profiler.dump_stats(args.profile)
+        print_if_debug("profile written to " + args.profile)
+
+
+def process_workbook_headless():
+    # this runs the process command
+    settings = get_headless_settings()
+    if settings is None:
+        return 2
+    if args.streaming and args.checkpoint:
+        print("--streaming can't be used with --checkpoint", file=sys.stderr)
+        return 2
+    if not os.path.isfile(args.input_workbook):
+        print("Input workbook " + args.input_workbook + " does not exist", file=sys.stderr)
+        return 1
+    if not os.path.isdir(os.path.dirname(os.path.abspath(args.output_workbook))):
+        print("Output folder for " + args.output_workbook + " does not exist", file=sys.stderr)
+        return 1
+    if args.dry_run:
+        return layout_workbook_headless(settings)
+    if args.error_report is not None:
+        print("--error_report can only be used with --dry_run", file=sys.stderr)
+        return 2
+    if args.update:
+        return update_workbook_headless(settings)
+    print_if_debug("processing " + args.input_workbook + " into " + args.output_workbook + " with " + str(settings))
+    from barcode_processing import do_process_workbook
+    render_cache = load_headless_render_cache()
+    try:
+        process_stats = do_process_workbook(args.input_workbook, args.output_workbook, settings,
+                                            progress_callback=print_headless_progress,
+                                            keep_barcodes_in_cwd=args.keep_barcodes_in_cwd,
+                                            keep_barcode_files=args.keep_barcode_files,
+                                            render_cache=render_cache,
+                                            render_workers=args.workers or os.cpu_count(),
+                                            sheet_selection=get_headless_sheet_selection(),
+                                            checkpoint=args.checkpoint,
+                                            checkpoint_seconds=args.checkpoint_minutes * 60,
+                                            streaming=args.streaming,
+                                            image_memory_budget=args.image_memory * 1024 * 1024)
+    except Exception as process_error:
+        print("Error processing workbook: " + str(process_error), file=sys.stderr)
+        return 1
+    save_headless_render_cache(render_cache)
+    print(str(process_stats['inserted']) + " barcodes inserted from " + str(process_stats['rows']) + " rows")
+    if process_stats['reused']:
+        print(str(process_stats['reused']) + " of them reused from the checkpoint")
+    print_headless_memory(process_stats['timing'])
+    write_headless_stats(dict(process_stats, input=args.input_workbook, output=args.output_workbook))
+    return 0
+
+
+def update_workbook_headless(settings):
+    # this runs the process command with --update
+    if args.checkpoint or args.streaming:
+        print("--update can't be used with --checkpoint or --streaming", file=sys.stderr)
+        return 2
+    print_if_debug("updating " + args.input_workbook + " into " + args.output_workbook + " with " + str(settings))
+    from barcode_processing import do_update_workbook
+    render_cache = load_headless_render_cache()
+    try:
+        update_stats = do_update_workbook(args.input_workbook, args.output_workbook, settings,
+                                          progress_callback=print_headless_progress, render_cache=render_cache,
+                                          render_workers=args.workers or os.cpu_count(),
+                                          sheet_selection=get_headless_sheet_selection(),
+                                          image_memory_budget=args.image_memory * 1024 * 1024)
+    except Exception as update_error:
+        print("Error updating workbook: " + str(update_error), file=sys.stderr)
+        return 1
+    save_headless_render_cache(render_cache)
+    if settings['barcode_output_mode'] == 'font':
+        # the font output mode was processed as usual
+        print(str(update_stats['inserted']) + " barcodes inserted from " + str(update_stats['rows']) + " rows")
+    else:
+        print(str(update_stats['inserted']) + " barcodes in " + str(update_stats['rows']) + " rows, " +
+              str(update_stats['inserted'] - update_stats['reused']) + " of them rendered")
+    if update_stats.get('removed'):
+        print(str(update_stats['removed']) + " barcodes removed from rows without a value")
+    print_headless_memory(update_stats['timing'])
+    write_headless_stats(dict(update_stats, input=args.input_workbook, output=args.output_workbook))
+    return 0
+
+
+def layout_workbook_headless(settings):
+    # this runs the process command with --dry_run, nothing is written but the stats
+    print_if_debug("laying out " + args.input_workbook + " with " + str(settings))
+    from barcode_processing import do_layout_workbook, write_error_report, describe_barcode_errors
+    render_cache = load_headless_render_cache()
+    error_rows = []
+    try:
+        layout_stats = do_layout_workbook(args.input_workbook, settings, progress_callback=print_headless_progress,
+                                          render_cache=render_cache, render_workers=args.workers or os.cpu_count(),
+                                          sheet_selection=get_headless_sheet_selection(), error_rows=error_rows)
+    except Exception as layout_error:
+        print("Error laying out workbook: " + str(layout_error), file=sys.stderr)
+        return 1
+    if args.error_report is not None:
+        try:
+            write_error_report(args.error_report, error_rows, layout_stats['errors'])
+        except OSError as report_save_error:
+            print("Error saving error report: " + str(report_save_error), file=sys.stderr)
+            return 1
+    for sheet_name, sheet_stats in layout_stats['sheets'].items():
+        sheet_text = sheet_name + ": " + str(sheet_stats['barcodes']) + " barcodes from " + str(sheet_stats['rows']) + \
+            " rows"
+        # a sheet without any barcodes leaves the output column as it is
+        if sheet_stats['column_width'] is not None:
+            sheet_text += ", output column width " + str(sheet_stats['column_width'])
+        print(sheet_text)
+        for image_size, image_count in sheet_stats['image_sizes'].items():
+            print("    " + str(image_count) + " images of " + image_size + " pixels")
+    print(str(layout_stats['barcodes']) + " barcodes would be inserted from " + str(layout_stats['rows']) + " rows")
+    if layout_stats['invalid']:
+        print(str(layout_stats['invalid']) + " rows would be skipped (" +
+              describe_barcode_errors(layout_stats['errors'], settings['barcode_type']) + ")")
+    if layout_stats['renders']:
+        print("rendering " + str(layout_stats['renders']) + " barcodes would take about " +
+              str(layout_stats['estimated_render_seconds']) + " seconds")
+    estimate_text = "estimated output size " + str(round(layout_stats['estimated_output_bytes'] / 1000000, 1)) + " MB"
+    if layout_stats['media_files']:
+        estimate_text += ", " + str(round(layout_stats['estimated_media_bytes'] / 1000000, 1)) + " MB of it in " + \
+            str(layout_stats['media_files']) + " barcode images"
+    print(estimate_text)
+    write_headless_stats(dict(layout_stats, input=args.input_workbook, output=args.output_workbook))
+    return 0
+
+
+def process_batch_headless():
+    # this runs the batch command, one failed workbook doesn't stop the rest, but does make the exit status 1
+    settings = get_headless_settings()
+    if settings is None:
+        return 2
+    if args.streaming and args.checkpoint:
+        print("--streaming can't be used with --checkpoint", file=sys.stderr)
+        return 2
+    if not os.path.isdir(args.output_directory):
+        print("Output folder " + args.output_directory + " does not exist", file=sys.stderr)
+        return 1
+    from barcode_processing import find_batch_workbooks, do_process_workbook_batch, write_batch_report, \
+        merge_timing_summaries
+    workbook_paths = find_batch_workbooks(args.input_workbooks)
+    if not workbook_paths:
+        print("No workbooks found to process", file=sys.stderr)
+        return 1
+    print_if_debug("processing " + str(len(workbook_paths)) + " workbooks into " + args.output_directory +
+                   " with " + str(settings))
+    render_cache = load_headless_render_cache()
+    batch_start_time = time.perf_counter()
+    batch_results = do_process_workbook_batch(workbook_paths, args.output_directory, settings,
+                                              sheet_selection=get_headless_sheet_selection(),
+                                              jobs=args.jobs or os.cpu_count(),
+                                              progress_callback=print_batch_progress,
+                                              render_cache=render_cache,
+                                              render_workers=args.workers or os.cpu_count(),
+                                              checkpoint=args.checkpoint,
+                                              checkpoint_seconds=args.checkpoint_minutes * 60,
+                                              streaming=args.streaming,
+                                              image_memory_budget=args.image_memory * 1024 * 1024)
+    save_headless_render_cache(render_cache)
+    if args.report is not None:
+        write_batch_report(args.report, batch_results)
+    # with more than one job the stage times add up to more than the time the batch took
+    batch_timing = merge_timing_summaries([batch_result['timing'] for batch_result in batch_results],
+                                          time.perf_counter() - batch_start_time)
+    write_headless_stats({'workbooks': len(batch_results), 'timing': batch_timing})
+    failed_count = 0
+    for batch_result in batch_results:
+        if batch_result['status'] != 'done':
+            failed_count += 1
+            print(batch_result['input'] + ": " + batch_result['error'], file=sys.stderr)
+    print(str(len(batch_results) - failed_count) + " of " + str(len(workbook_paths)) + " workbooks processed, " +
+          str(sum(batch_result['inserted'] for batch_result in batch_results)) + " barcodes inserted")
+    print_headless_memory(batch_timing)
+    if failed_count:
+        return 1
+    return 0
+
+
+def export_barcodes_headless():
+    # this runs the export command
+    settings = get_headless_settings()
+    if settings is None:
+        return 2
+    if not os.path.isfile(args.input_workbook):
+        print("Input workbook " + args.input_workbook + " does not exist", file=sys.stderr)
+        return 1
+    print_if_debug("exporting " + args.input_workbook + " to " + args.destination + " as " + args.export_format +
+                   " with " + str(settings))
+    from barcode_processing import do_export_barcodes
+    render_cache = load_headless_render_cache()
+    try:
+        export_stats = do_export_barcodes(args.input_workbook, args.destination, settings, args.export_format,
+                                          progress_callback=print_headless_progress, render_cache=render_cache,
+                                          render_workers=args.workers or os.cpu_count(),
+                                          sheet_selection=get_headless_sheet_selection())
+    except Exception as export_error:
+        print("Error exporting barcodes: " + str(export_error), file=sys.stderr)
+        return 1
+    save_headless_render_cache(render_cache)
+    print(str(export_stats['exported']) + " barcode files written from " + str(export_stats['rows']) + " rows")
+    if export_stats['failed']:
+        print(str(export_stats['failed']) + " barcodes could not be rendered", file=sys.stderr)
+    write_headless_stats(dict(export_stats, input=args.input_workbook, output=args.destination))
+    return 0
+
+
+def serve_headless():
+    # this runs the serve command, the render cache is saved when the service is stopped
+    settings = get_headless_settings()
+    if settings is None:
+        return 2
+    from barcode_service import RenderService, run_render_service
+    render_cache = load_headless_render_cache()
+    render_service = RenderService(settings, render_cache=render_cache,
+                                   render_workers=args.workers or os.cpu_count(), max_queued_renders=args.max_queued)
+    try:
+        run_render_service(render_service, host=args.host, port=args.port, unix_socket_path=args.socket,
+                           ready_callback=lambda listening_on: print("Render service listening on " + listening_on,
+                                                                     flush=True))
+    except OSError as serve_error:
+        print("Error starting render service: " + str(serve_error), file=sys.stderr)
+        return 1
+    save_headless_render_cache(render_cache)
+    return 0
+
+
+if args.command == 'process':
+    raise SystemExit(run_headless_command(process_workbook_headless))
+if args.command == 'batch':
+    raise SystemExit(run_headless_command(process_batch_headless))
+if args.command == 'export':
+    raise SystemExit(run_headless_command(export_barcodes_headless))
+if args.command == 'serve':
+    raise SystemExit(serve_headless())
+
+import tkinter
+import tkinter.ttk
+import tkinter.filedialog
+import tkinter.messagebox
+
+root_window = tkinter.Tk()
+
+root_window.title("Barcode Insert Utility " + version)
+
+# this builds a list of the launch flags
+flags_list_string = "Flags="
+flags_count = 0
+if args.debug:
+    flags_list_string += "(Debug)"
+    flags_count += 1
+if args.log:
+    flags_list_string += "(Logged)"
+    flags_count += 1
+if args.keep_barcodes_in_cwd:
+    flags_list_string += "(Barcodes In Working Directory)"
+    flags_count += 1
+if args.keep_barcode_files:
+    flags_list_string += "(Keep Barcodes)"
+    flags_count += 1
+if args.reset_configuration:
+    flags_list_string += "(Reset Configuration)"
+    flags_count += 1
+
+old_workbook_path = ""
+new_workbook_path = ""
+
+program_launch_cwd = os.getcwd()
+
+process_workbook_keep_alive = True
+
+# rendered barcodes are kept for the whole session, so reprocessing with the same settings is quick
+interface_render_cache = None
+
+barcode_type_variable = tkinter.StringVar()
+pad_ean_option = tkinter.BooleanVar()
 
 
 # this is the workbook selector, the code was a bit of an experiment and is a bit of a pain to debug.
@@ -252,6 +614,7 @@ def select_folder_old_new_wrapper(selection):
                 with open(settings_file_path, 'w', encoding='utf8') as configuration_file:
                     config.write(configuration_file)
                 try:
+                    import openpyxl
                     openpyxl.load_workbook(old_workbook_path_proposed, read_only=True)
                     file_is_xlsx = True
                 except Exception as file_test_open_error:
@@ -289,181 +652,111 @@ def select_folder_old_new_wrapper(selection):
     old_workbook_selection_button.configure(state=tkinter.NORMAL)
 
 
-def generate_barcode(input_string, tempdir):
-    border_size = int(border_spinbox.get())
-    ean = barcode.get(barcode_type_variable.get(), input_string, writer=ImageWriter())
-    # select output image size via dpi. internally, pybarcode renders as svg, then renders that as a png file.
-    # dpi is the conversion from svg image size in mm, to what the image writer thinks is inches.
-    ean.default_writer_options['dpi'] = int(dpi_spinbox.get())
-    # module height is the barcode bar height in mm
-    ean.default_writer_options['module_height'] = float(height_spinbox.get())
-    # text distance is the distance between the bottom of the barcode, and the top of the text in mm
-    ean.default_writer_options['text_distance'] = 1
-    # font size is the text size in pt
-    ean.default_writer_options['font_size'] = int(font_size_spinbox.get())
-    # quiet zone is the distance from the ends of the barcode to the ends of the image in mm
-    ean.default_writer_options['quiet_zone'] = 2
-    # save barcode image with generated filename
-    print_if_debug("generating barcode image")
-    with tempfile.NamedTemporaryFile(dir=tempdir, suffix='.png', delete=False) as initial_temp_file_path:
-        filename = ean.save(initial_temp_file_path.name[0:-4])
-        print_if_debug("success, barcode image path is: " + filename)
-        print_if_debug("opening " + str(filename) + " to add border")
-        barcode_image = pil_Image.open(str(filename))  # open image as pil object
-        print_if_debug("success")
-        print_if_debug("adding barcode and saving")
-        img_save = pil_ImageOps.expand(barcode_image, border=border_size,
-                                        fill='white')  # add border around image
-        width, height = img_save.size  # get image size of barcode with border
-        # write out image to file
-        with tempfile.NamedTemporaryFile(dir=tempdir, suffix='.png', delete=False) as final_barcode_path:
-            img_save.save(final_barcode_path.name)
-            print_if_debug("success, final barcode path is: " + final_barcode_path.name)
-    return final_barcode_path.name, width, height
-
-def interpret_barcode_string(upc_barcode_string):
-    if not upc_barcode_string == '':
-        if barcode_type_variable.get() == "ean13" or barcode_type_variable.get() == "ean8":
-            try:
-                _ = int(upc_barcode_string)  # check that "upc_barcode_string" can be cast to int
-            except ValueError as exc:
-                raise ValueError("Input contents are not an integer") from exc
-        # select barcode type, specify barcode, and select image writer to save as png
-        if barcode_type_variable.get() == "ean8":
-            if pad_ean_option.get() is True:
-                if len(upc_barcode_string) < 6:
-                    upc_barcode_string = upc_barcode_string.rjust(6, '0')
-                if len(upc_barcode_string) <= 7:
-                    upc_barcode_string = upc_barcode_string.ljust(7, '0')
-                else:
-                    raise ValueError("Input contents are more than 7 characters")
-            else:
-                if len(upc_barcode_string) != 7:
-                    raise ValueError("Input contents are not 7 characters")
-        elif barcode_type_variable.get() == "ean13":
-            if pad_ean_option.get() is True:
-                if len(upc_barcode_string) < 11:
-                    upc_barcode_string = upc_barcode_string.rjust(11, '0')
-                if len(upc_barcode_string) <= 12:
-                    upc_barcode_string = upc_barcode_string.ljust(12, '0')
-                else:
-                    raise ValueError("Input contents are more than 12 characters")
-            else:
-                if len(upc_barcode_string) != 12:
-                    raise ValueError("Input contents are not 12 characters")
-        elif barcode_type_variable.get() == "UPC":
-            if pad_ean_option.get() is True:
-                if len(upc_barcode_string) < 10:
-                    upc_barcode_string = upc_barcode_string.rjust(11, '0')
-                if len(upc_barcode_string) <= 11:
-                    upc_barcode_string = upc_barcode_string.ljust(12, '0')
-                else:
-                    raise ValueError("Input contents are more than 11 characters")
-            else:
-                if len(upc_barcode_string) != 11:
-                    raise ValueError("Input contents are not 11 characters")
-        elif barcode_type_variable.get() == "code39":
-            upc_barcode_string = upc_barcode_string.upper()
-            upc_barcode_string = re.sub('[^A-Z0-9./*$%+\- ]+', ' ', upc_barcode_string)
-        return upc_barcode_string
-    raise ValueError("Input is empty")
-
-def do_process_workbook():
-    # this is called as a background thread to ensure the interface is responsive
-    print_if_debug("creating temp directory")
-    if not args.keep_barcodes_in_cwd:
-        tempdir = tempfile.mkdtemp()
+def get_interface_settings():
+    # this reads the barcode settings out of the interface, in the same form as settings_from_config
+    return {
+        'barcode_type': barcode_type_variable.get(),
+        'barcode_dpi': int(dpi_spinbox.get()),
+        'barcode_module_height': int(height_spinbox.get()),
+        'barcode_border': int(border_spinbox.get()),
+        'barcode_font_size': int(font_size_spinbox.get()),
+        'input_data_column': input_column_spinbox.get(),
+        'barcode_output_column': output_column_spinbox.get(),
+        'pad_ean_barcodes': pad_ean_option.get(),
+        # the output mode and png options aren't shown in the interface, they only come from the configuration file
+        'barcode_output_mode': configured_settings['barcode_output_mode'],
+        'barcode_font_name': configured_settings['barcode_font_name'],
+        'barcode_font_point_size': configured_settings['barcode_font_point_size'],
+        'barcode_png_mode': configured_settings['barcode_png_mode'],
+        'barcode_png_compression': configured_settings['barcode_png_compression'],
+    }
+
+
+# the processing thread doesn't touch the interface, it sends progress and its result through this queue, which
+# the interface checks every progress_poll_milliseconds. row by row progress is only sent every
+# progress_update_seconds, there's no use redrawing the bar faster than that
+process_workbook_events = queue.Queue()
+progress_poll_milliseconds = 100
+progress_update_seconds = 0.25
+last_progress_update_time = 0.0
+
+
+def queue_progress(text, value=None, maximum=None):
+    # progress callback for do_process_workbook, this runs on the processing thread
+    global last_progress_update_time
+    if value is not None and value != maximum:
+        progress_update_time = time.monotonic()
+        if progress_update_time - last_progress_update_time < progress_update_seconds:
+            return
+        last_progress_update_time = progress_update_time
+    process_workbook_events.put(('progress', (text, value, maximum)))
+
+
+def update_progress(text, value=None, maximum=None):
+    # steps without a known length show as a bouncing bar
+    if value is None:
+        progress_bar.configure(mode='indeterminate', maximum=100, value=0)
+        progress_bar.start()
     else:
-        temp_dir_in_cwd = os.path.join(program_launch_cwd, 'barcode images')
-        os.mkdir(temp_dir_in_cwd)
-        tempdir = temp_dir_in_cwd
-    print_if_debug("temp directory created as: " + tempdir)
-    progress_bar.configure(mode='indeterminate', maximum=100)
-    progress_bar.start()
-    progress_numbers.configure(text="opening workbook")
-    wb = openpyxl.load_workbook(old_workbook_path)
-    ws = wb.worksheets[0]
-    progress_numbers.configure(text="testing workbook save")
-    wb.save(new_workbook_path)
-    count = 0
-    save_counter = 0
-    progress_bar.configure(maximum=ws.max_row, value=count)
-    progress_numbers.configure(text=str(count) + "/" + str(ws.max_row))
-
-    for _ in ws.iter_rows():  # iterate over all rows in current worksheet
-        if not process_workbook_keep_alive:
-            break
-        try:
-            count += 1
-            progress_bar.configure(maximum=ws.max_row, value=count, mode='determinate')
-            progress_numbers.configure(text=str(count) + "/" + str(ws.max_row))
-            progress_bar.configure(value=count)
-            # get code from column selected in input_colum_spinbox, on current row,
-            # add a zeroes to the end if option is selected to make seven or 12 digits
-            print_if_debug("getting cell contents on line number " + str(count))
-            upc_barcode_string = str(ws[input_column_spinbox.get() + str(count)].value)
-            print_if_debug("cell contents are: " + upc_barcode_string)
-            upc_barcode_string = interpret_barcode_string(upc_barcode_string)
-            generated_barcode_path, width, height = generate_barcode(upc_barcode_string, tempdir)
-            # resize cell to size of image
-            ws.column_dimensions[output_column_spinbox.get()].width = int(math.ceil(float(width) * .15))
-            ws.row_dimensions[count].height = int(math.ceil(float(height) * .75))
-
-            # open image with as openpyxl image object
-            print_if_debug("opening " + generated_barcode_path + " to insert into output spreadsheet")
-            img = OpenPyXlImage(generated_barcode_path)
-            print_if_debug("success")
-            # attach image to cell
-            print_if_debug("adding image to cell")
-            # add image to cell
-            ws.add_image(img, anchor=output_column_spinbox.get() + str(count))
-            save_counter += 1
-            print_if_debug("success")
-        except Exception as barcode_error:
-            print_if_debug(barcode_error)
-        # This save in the loop frees references to the barcode images,
-        #  so that python's garbage collector can clear them
-        if save_counter >= file_limit - 50:
-            print_if_debug("saving intermediate workbook to free file handles")
-            progress_bar.configure(mode='indeterminate', maximum=100)
-            progress_bar.start()
-            progress_numbers.configure(text=str(count) + "/" + str(ws.max_row) + " saving")
-            wb.save(new_workbook_path)
-            print_if_debug("success")
-            save_counter = 1
-            progress_numbers.configure(text=str(count) + "/" + str(ws.max_row))
-    progress_bar.configure(value=0)
-    print_if_debug("saving workbook to file")
-    progress_bar.configure(mode='indeterminate', maximum=100)
-    progress_bar.start()
-    progress_numbers.configure(text="saving")
-    wb.save(new_workbook_path)
-    print_if_debug("success")
-    if not args.keep_barcode_files:
-        print_if_debug("removing temp folder " + tempdir)
-        shutil.rmtree(tempdir)
-        print_if_debug("success")
-
-
-def process_workbook_thread():
-    # this function handles setup and teardown of the process workbook thread
-    global new_workbook_path
-    process_errors = False
+        progress_bar.stop()
+        progress_bar.configure(maximum=maximum, value=value, mode='determinate')
+    progress_numbers.configure(text=text)
+
+
+def get_interface_render_cache():
+    # the cache is made on first use, along with importing the processing code
+    global interface_render_cache
+    if interface_render_cache is None:
+        from barcode_processing import BarcodeRenderCache
+        interface_render_cache = BarcodeRenderCache()
+    return interface_render_cache
+
+
+def process_workbook_thread(settings):
+    # this function handles setup and teardown of the process workbook thread.
+    # how it went is sent back as 'done', 'save error', or 'failed' for anything unexpected
     global process_workbook_keep_alive
+    global last_progress_update_time
     process_workbook_keep_alive = True
+    last_progress_update_time = 0.0
+    process_result = 'failed'
     try:
-        do_process_workbook()
+        from barcode_processing import do_process_workbook
+        process_stats = do_process_workbook(old_workbook_path, new_workbook_path, settings,
+                                            progress_callback=queue_progress,
+                                            keep_alive_callback=lambda: process_workbook_keep_alive,
+                                            keep_barcodes_in_cwd=args.keep_barcodes_in_cwd,
+                                            keep_barcode_files=args.keep_barcode_files, launch_cwd=program_launch_cwd,
+                                            render_cache=get_interface_render_cache())
+        print_if_debug("stage timings: " + json.dumps(process_stats['timing']))
+        process_result = 'done'
     except (IOError, OSError):
         print("Error saving file")
-        process_errors = True
-        new_workbook_label.configure(text="Error saving, select another output file.", background='red')
+        process_result = 'save error'
     finally:
-        progress_bar.stop()
-        progress_bar.configure(maximum=100, value=0, mode='determinate')
-        progress_numbers.configure(text="")
-    new_workbook_path = ""
-    if not process_errors:
-        new_workbook_label.configure(text="No File Selected")
+        process_workbook_events.put(('finished', process_result))
+
+
+def poll_process_workbook_events(finished_callback):
+    # this runs on the interface thread, only the newest of the progress updates waiting is shown.
+    # it keeps rescheduling itself until the processing thread says it has finished
+    latest_progress = None
+    process_result = None
+    while process_result is None:
+        try:
+            event_type, event_value = process_workbook_events.get_nowait()
+        except queue.Empty:
+            break
+        if event_type == 'progress':
+            latest_progress = event_value
+        else:
+            process_result = event_value
+    if latest_progress is not None:
+        update_progress(*latest_progress)
+    if process_result is None:
+        root_window.after(progress_poll_milliseconds, poll_process_workbook_events, finished_callback)
+    else:
+        finished_callback(process_result)
 
 
 def process_workbook_command_wrapper():
@@ -493,54 +786,63 @@ def process_workbook_command_wrapper():
     cancel_process_workbook_button = tkinter.ttk.Button(master=go_button_frame, command=kill_process_workbook,
                                                         text="Cancel")
     cancel_process_workbook_button.pack(side=tkinter.RIGHT)
-    process_workbook_thread_object = threading.Thread(target=process_workbook_thread)
+
+    def finish_process_workbook(process_result):
+        # this puts the interface back once the processing thread is done
+        global new_workbook_path
+        progress_bar.stop()
+        progress_bar.configure(maximum=100, value=0, mode='determinate')
+        progress_numbers.configure(text="")
+        if process_result == 'save error':
+            new_workbook_label.configure(text="Error saving, select another output file.", background='red')
+        if process_result != 'failed':
+            new_workbook_path = ""
+        if process_result == 'done':
+            new_workbook_label.configure(text="No File Selected")
+        cancel_process_workbook_button.destroy()
+        new_workbook_selection_button.configure(state=tkinter.NORMAL)
+        old_workbook_selection_button.configure(state=tkinter.NORMAL)
+        for child in size_spinbox_frame.winfo_children():
+            child.configure(state=tkinter.NORMAL)
+        set_spinbutton_state_read_only()
+        if process_workbook_keep_alive:
+            process_workbook_button.configure(text="Done Processing Workbook")
+        else:
+            process_workbook_button.configure(text="Processing Workbook Canceled")
+
+    process_workbook_thread_object = threading.Thread(target=process_workbook_thread,
+                                                      args=(get_interface_settings(),))
     process_workbook_thread_object.start()
-    while process_workbook_thread_object.is_alive():
-        root_window.update()
-    cancel_process_workbook_button.destroy()
-    new_workbook_selection_button.configure(state=tkinter.NORMAL)
-    old_workbook_selection_button.configure(state=tkinter.NORMAL)
-    for child in size_spinbox_frame.winfo_children():
-        child.configure(state=tkinter.NORMAL)
-    set_spinbutton_state_read_only()
-    if process_workbook_keep_alive:
-        process_workbook_button.configure(text="Done Processing Workbook")
-    else:
-        process_workbook_button.configure(text="Processing Workbook Canceled")
+    # the interface stays in its own event loop while the workbook is processed, checking in on the thread
+    root_window.after(progress_poll_milliseconds, poll_process_workbook_events, finish_process_workbook)
 
 
 def generate_single_barcode():
-    print("single barcode stub")
-
     if upc_entry.get() == '':
         return
 
-    print_if_debug("creating temp directory")
-    if not args.keep_barcodes_in_cwd:
-        tempdir = tempfile.mkdtemp()
-    else:
-        temp_dir_in_cwd = os.path.join(program_launch_cwd, 'barcode images')
-        os.mkdir(temp_dir_in_cwd)
-        tempdir = temp_dir_in_cwd
-
     save_path = tkinter.filedialog.asksaveasfilename(
         initialdir=config.get('settings', 'initial_output_folder'),
         initialfile=upc_entry.get(),
         defaultextension='.png',
-        filetypes=[("PNG Image File", "*.png")])
+        filetypes=[("PNG Image File", "*.png"), ("SVG Image File", "*.svg"), ("PDF File", "*.pdf")])
 
     try:
         if os.path.exists(os.path.dirname(save_path)):
-            barcode_path, _, _ = generate_barcode(interpret_barcode_string(upc_entry.get()), tempdir)
-            shutil.copyfile(barcode_path, save_path)
+            from barcode_processing import generate_barcode_file, interpret_barcode_string
+            settings = get_interface_settings()
+            # the format is picked by the extension of the file name, anything unknown is saved as png
+            export_format = os.path.splitext(save_path)[1].lower().lstrip('.')
+            if export_format not in barcode_export_formats:
+                export_format = 'png'
+            file_contents = generate_barcode_file(
+                interpret_barcode_string(upc_entry.get(), settings['barcode_type'], settings['pad_ean_barcodes']),
+                settings, export_format, get_interface_render_cache())
+            with open(save_path, 'wb') as barcode_file:
+                barcode_file.write(file_contents)
     except Exception as error:
         tkinter.messagebox.showerror(master=root_window, message=f"Failed to generate barcode image: {str(error)}")
 
-    if not args.keep_barcode_files:
-        print_if_debug("removing temp folder " + tempdir)
-        shutil.rmtree(tempdir)
-        print_if_debug("success")
-
 
 both_workbook_frame = tkinter.ttk.Frame(root_window)
 old_workbook_file_frame = tkinter.ttk.Frame(both_workbook_frame)
@@ -0,0 +1,53 @@
+import os
+import sys
+import openpyxl
+import pytest
+
+# the modules are run as scripts from the repository folder, so the tests import them from there too
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from barcode_settings import default_settings  # noqa: E402
+
+
+@pytest.fixture
+def ean13_settings():
+    return dict(default_settings, barcode_type='ean13', pad_ean_barcodes=True)
+
+
+@pytest.fixture
+def write_value_workbook(tmp_path):
+    # writes {sheet name: [values]} to a workbook in tmp_path, the values going down column B as the default
+    # settings read them, and returns its path
+    def write_workbook(file_name, sheet_values):
+        wb = openpyxl.Workbook()
+        wb.remove(wb.active)
+        for sheet_name, values in sheet_values.items():
+            ws = wb.create_sheet(sheet_name)
+            for row_number, value in enumerate(values, start=1):
+                ws.cell(row=row_number, column=1, value="item " + str(row_number))
+                ws.cell(row=row_number, column=2, value=value)
+        workbook_path = str(tmp_path / file_name)
+        wb.save(workbook_path)
+        return workbook_path
+    return write_workbook
+
+
+@pytest.fixture
+def read_barcode_images():
+    # returns {sheet name: {(row, column): (png bytes, picture description)}} for the images of a workbook, along
+    # with {sheet name: {row: height}} and {sheet name: width of column A}
+    def read_images(workbook_path):
+        wb = openpyxl.load_workbook(workbook_path)
+        sheet_images = {}
+        sheet_row_heights = {}
+        sheet_column_widths = {}
+        for ws in wb.worksheets:
+            sheet_images[ws.title] = {
+                (img.anchor._from.row + 1, img.anchor._from.col + 1):
+                    (img.ref.getvalue(), img.anchor.pic.nvPicPr.cNvPr.descr)
+                for img in ws._images}
+            sheet_row_heights[ws.title] = {row_number: row_dimension.height for row_number, row_dimension
+                                           in ws.row_dimensions.items() if row_dimension.height}
+            sheet_column_widths[ws.title] = ws.column_dimensions['A'].width
+        return sheet_images, sheet_row_heights, sheet_column_widths
+    return read_images
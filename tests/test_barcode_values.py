@@ -0,0 +1,63 @@
+import pytest
+from barcode_processing import normalize_barcode_column, summarize_barcode_errors, barcode_value_error_message, \
+    interpret_barcode_string
+
+
+@pytest.mark.parametrize('barcode_type, pad_ean, cell_value, expected', [
+    ('code39', False, 'sku-12', ('SKU-12', None)),
+    ('code39', False, 'a_b#%c', ('A B %C', None)),
+    ('code39', False, 'x__y', ('X Y', None)),
+    ('code39', False, 1234, ('1234', None)),
+    ('code39', False, None, (None, 'empty')),
+    ('code39', False, '', (None, 'empty')),
+    ('ean8', True, '123', ('0001230', None)),
+    ('ean8', True, '123456', ('1234560', None)),
+    ('ean8', True, '1234567', ('1234567', None)),
+    ('ean8', True, '12345678', (None, 'too_long')),
+    ('ean8', True, '12a', (None, 'not_integer')),
+    ('ean8', False, 1234567, ('1234567', None)),
+    ('ean8', False, '123456', (None, 'wrong_length')),
+    ('ean8', False, '12345678', (None, 'wrong_length')),
+    ('ean13', True, '12345', ('000000123450', None)),
+    ('ean13', True, '12345678901', ('123456789010', None)),
+    ('ean13', True, '123456789012', ('123456789012', None)),
+    ('ean13', True, '1234567890123', (None, 'too_long')),
+    ('ean13', True, 1234567.0, (None, 'not_integer')),
+    ('ean13', True, None, (None, 'empty')),
+    ('ean13', False, '123456789012', ('123456789012', None)),
+    ('ean13', False, '12345678901', (None, 'wrong_length')),
+    ('UPC', True, '123456789', ('001234567890', None)),
+    ('UPC', True, '1234567890', ('123456789000', None)),
+    ('UPC', True, '12345678901', ('123456789010', None)),
+    ('UPC', True, '123456789012', (None, 'too_long')),
+    ('UPC', False, '12345678901', ('12345678901', None)),
+    ('UPC', False, '1234567890', (None, 'wrong_length')),
+    ('UPC', False, '123456789012', (None, 'wrong_length')),
+])
+def test_barcode_values_are_normalized(barcode_type, pad_ean, cell_value, expected):
+    normalized_values, error_codes = normalize_barcode_column([cell_value], barcode_type, pad_ean)
+    assert (normalized_values[0], error_codes[0]) == expected
+
+
+def test_column_errors_are_counted_by_code():
+    normalized_values, error_codes = normalize_barcode_column(['1234567', None, 'abc', '12345678', '', '7654321'],
+                                                              'ean8', True)
+    assert normalized_values == ['1234567', None, None, None, None, '7654321']
+    assert summarize_barcode_errors(error_codes) == {'empty': 2, 'not_integer': 1, 'too_long': 1}
+
+
+@pytest.mark.parametrize('error_code, barcode_type, message', [
+    ('empty', 'code39', "Input is empty"),
+    ('not_integer', 'ean13', "Input contents are not an integer"),
+    ('too_long', 'ean8', "Input contents are more than 7 characters"),
+    ('too_long', 'UPC', "Input contents are more than 11 characters"),
+    ('wrong_length', 'ean13', "Input contents are not 12 characters"),
+])
+def test_error_codes_have_messages(error_code, barcode_type, message):
+    assert barcode_value_error_message(error_code, barcode_type) == message
+
+
+def test_single_values_raise_the_error_message():
+    assert interpret_barcode_string('42', 'ean13', True) == '000000000420'
+    with pytest.raises(ValueError, match="Input contents are not 12 characters"):
+        interpret_barcode_string('42', 'ean13', False)
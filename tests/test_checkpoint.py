@@ -0,0 +1,130 @@
+import io
+import json
+import pathlib
+import pytest
+import barcode_processing
+from barcode_processing import do_process_workbook, checkpoint_manifest_path, BarcodeRenderCache
+
+catalog_values = [str(590123400000 + row_number * 1013) for row_number in range(40)]
+
+
+class ProcessStopper():
+    # stops processing once the row given has been inserted, as the interface's cancel button would
+    def __init__(self, stop_row):
+        self.stop_row = stop_row
+        self.stopped = False
+
+    def progress(self, text, value=None, maximum=None):
+        if value is not None and value >= self.stop_row:
+            self.stopped = True
+
+    def keep_alive(self):
+        return not self.stopped
+
+
+def process_with_checkpoint(input_path, output_path, settings, **process_options):
+    # a new render cache every time, so that nothing is reused but what comes from the checkpoint
+    return do_process_workbook(input_path, output_path, settings, render_cache=BarcodeRenderCache(), checkpoint=True,
+                               **process_options)
+
+
+def test_checkpoint_manifest_lets_a_rerun_reuse_every_image(tmp_path, ean13_settings, write_value_workbook,
+                                                             read_barcode_images):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': catalog_values})
+    output_path = str(tmp_path / 'output.xlsx')
+    first_stats = process_with_checkpoint(input_path, output_path, ean13_settings)
+    first_images = read_barcode_images(output_path)
+    with open(checkpoint_manifest_path(output_path), encoding='utf8') as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest['sheets']['Sheet']['ranges'] == [[1, len(catalog_values)]]
+    assert len(manifest['media']) == len(set(catalog_values))
+
+    second_stats = process_with_checkpoint(input_path, output_path, ean13_settings)
+    assert first_stats['reused'] == 0
+    assert second_stats['inserted'] == len(catalog_values)
+    assert second_stats['reused'] == len(catalog_values)
+    assert second_stats['timing']['counters']['render_cache_misses'] == 0
+    assert read_barcode_images(output_path) == first_images
+
+
+def test_cancelled_run_resumes_from_its_checkpoint(tmp_path, ean13_settings, write_value_workbook,
+                                                   read_barcode_images):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': catalog_values})
+    uninterrupted_path = str(tmp_path / 'uninterrupted.xlsx')
+    do_process_workbook(input_path, uninterrupted_path, ean13_settings)
+    output_path = str(tmp_path / 'output.xlsx')
+    process_stopper = ProcessStopper(stop_row=15)
+    cancelled_stats = process_with_checkpoint(input_path, output_path, ean13_settings,
+                                              progress_callback=process_stopper.progress,
+                                              keep_alive_callback=process_stopper.keep_alive)
+    assert cancelled_stats['inserted'] == 15
+    with open(checkpoint_manifest_path(output_path), encoding='utf8') as manifest_file:
+        assert json.load(manifest_file)['sheets']['Sheet']['ranges'] == [[1, 15]]
+
+    resumed_stats = process_with_checkpoint(input_path, output_path, ean13_settings)
+    assert resumed_stats['inserted'] == len(catalog_values)
+    assert resumed_stats['reused'] == 15
+    assert read_barcode_images(output_path) == read_barcode_images(uninterrupted_path)
+
+
+def test_checkpoint_saves_while_processing(tmp_path, ean13_settings, write_value_workbook, monkeypatch):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': catalog_values})
+    output_path = str(tmp_path / 'output.xlsx')
+    saved_manifests = []
+    write_checkpoint_manifest = barcode_processing.write_checkpoint_manifest
+
+    def record_manifest(workbook_path, settings, sheet_value_hashes, processed_rows, media_entries):
+        saved_manifests.append(dict(processed_rows))
+        write_checkpoint_manifest(workbook_path, settings, sheet_value_hashes, processed_rows, media_entries)
+    monkeypatch.setattr(barcode_processing, 'write_checkpoint_manifest', record_manifest)
+    process_with_checkpoint(input_path, output_path, ean13_settings, checkpoint_seconds=0)
+    # one save before each row, of the rows before it, and one at the end
+    assert len(saved_manifests) == len(catalog_values) + 1
+    assert saved_manifests[1] == {'Sheet': 1}
+    assert saved_manifests[-1] == {'Sheet': len(catalog_values)}
+
+
+def test_changed_values_are_rendered_and_the_rest_reused(tmp_path, ean13_settings, write_value_workbook,
+                                                         read_barcode_images):
+    output_path = str(tmp_path / 'output.xlsx')
+    process_with_checkpoint(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}), output_path,
+                            ean13_settings)
+    changed_values = list(catalog_values)
+    changed_values[3] = '111111111111'
+    changed_values[20] = '222222222222'
+    changed_path = write_value_workbook('changed.xlsx', {'Sheet': changed_values})
+    changed_stats = process_with_checkpoint(changed_path, output_path, ean13_settings)
+    assert changed_stats['reused'] == len(catalog_values) - 2
+    fresh_path = str(tmp_path / 'fresh.xlsx')
+    do_process_workbook(changed_path, fresh_path, ean13_settings)
+    assert read_barcode_images(output_path) == read_barcode_images(fresh_path)
+
+
+@pytest.mark.parametrize('changed_setting', [{'barcode_dpi': 200}, {'barcode_png_mode': 'grayscale'}])
+def test_checkpoint_from_other_settings_is_ignored(tmp_path, ean13_settings, write_value_workbook,
+                                                   changed_setting):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': catalog_values})
+    output_path = str(tmp_path / 'output.xlsx')
+    process_with_checkpoint(input_path, output_path, ean13_settings)
+    changed_stats = process_with_checkpoint(input_path, output_path, dict(ean13_settings, **changed_setting))
+    assert changed_stats['reused'] == 0
+    assert changed_stats['inserted'] == len(catalog_values)
+
+
+def test_checkpoint_needs_an_output_file(tmp_path, ean13_settings, write_value_workbook):
+    with pytest.raises(ValueError):
+        do_process_workbook(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}), io.BytesIO(),
+                            ean13_settings, checkpoint=True)
+    assert not list(tmp_path.glob('*.checkpoint.json'))
+
+
+def test_stale_checkpoint_given_as_paths_is_ignored(tmp_path, ean13_settings, write_value_workbook):
+    input_path = pathlib.Path(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}))
+    output_path = tmp_path / 'output.xlsx'
+    process_with_checkpoint(input_path, output_path, ean13_settings)
+    changed_stats = process_with_checkpoint(input_path, output_path, dict(ean13_settings, barcode_dpi=200))
+    assert changed_stats['reused'] == 0
+    assert changed_stats['inserted'] == len(catalog_values)
+    with open(checkpoint_manifest_path(output_path), 'w', encoding='utf8') as manifest_file:
+        json.dump({'version': -1}, manifest_file)
+    assert process_with_checkpoint(input_path, output_path, ean13_settings)['reused'] == 0
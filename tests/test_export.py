@@ -0,0 +1,40 @@
+import io
+import zipfile
+import xml.etree.ElementTree
+from barcode_settings import default_settings
+from barcode_processing import do_export_barcodes, generate_barcode
+
+# sku-1 is the same barcode as SKU-1 once upper cased, and A/B and A B only differ in what a file name can't hold
+catalog_values = ['SKU-1', 'sku-1', 'A/B', 'A B', None, 'SKU-2']
+
+
+def test_svg_zip_export_has_one_valid_svg_per_value(tmp_path, write_value_workbook):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': catalog_values})
+    export_path = str(tmp_path / 'barcodes.zip')
+    export_stats = do_export_barcodes(input_path, export_path, default_settings, 'svg')
+    assert (export_stats['rows'], export_stats['invalid'], export_stats['exported'], export_stats['failed']) == \
+        (6, 1, 4, 0)
+    with zipfile.ZipFile(export_path) as export_archive:
+        assert export_archive.namelist() == ['SKU-1.svg', 'A_B.svg', 'A_B_2.svg', 'SKU-2.svg']
+        for member_name in export_archive.namelist():
+            assert export_archive.getinfo(member_name).compress_type == zipfile.ZIP_DEFLATED
+            svg_root = xml.etree.ElementTree.fromstring(export_archive.read(member_name))
+            assert svg_root.tag == '{http://www.w3.org/2000/svg}svg'
+
+
+def test_png_folder_export_matches_the_workbook_images(tmp_path, write_value_workbook):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': catalog_values})
+    export_folder = tmp_path / 'barcodes'
+    do_export_barcodes(input_path, str(export_folder), default_settings, 'png')
+    assert sorted(export_file.name for export_file in export_folder.iterdir()) == \
+        ['A_B.png', 'A_B_2.png', 'SKU-1.png', 'SKU-2.png']
+    assert (export_folder / 'SKU-2.png').read_bytes() == generate_barcode('SKU-2', default_settings)[0]
+
+
+def test_pdf_export_to_a_file_object(write_value_workbook):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': ['SKU-1', 'SKU-2']})
+    export_file = io.BytesIO()
+    do_export_barcodes(input_path, export_file, default_settings, 'pdf')
+    with zipfile.ZipFile(export_file) as export_archive:
+        assert export_archive.namelist() == ['SKU-1.pdf', 'SKU-2.pdf']
+        assert export_archive.read('SKU-1.pdf').startswith(b'%PDF')
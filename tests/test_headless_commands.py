@@ -0,0 +1,122 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+repository_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sample_workbook_path = os.path.join(repository_folder, 'stripped sample data.xlsx')
+
+
+def run_main(arguments, home_folder):
+    # runs in home_folder, and the configuration file goes there too, so each run starts from the default settings
+    command_environment = dict(os.environ, HOME=str(home_folder), XDG_DATA_HOME=str(home_folder),
+                               APPDATA=str(home_folder))
+    return subprocess.run([sys.executable, os.path.join(repository_folder, 'main.py')] + arguments,
+                          capture_output=True, text=True, env=command_environment, cwd=str(home_folder))
+
+
+@pytest.mark.parametrize('command_arguments', [
+    ['process', '--streaming', '--checkpoint', sample_workbook_path, 'output.xlsx'],
+    ['batch', '--streaming', '--checkpoint', '--output_directory', '.', sample_workbook_path],
+])
+def test_streaming_with_checkpoint_is_rejected_before_processing(command_arguments, tmp_path):
+    completed_command = run_main(command_arguments, tmp_path)
+    assert completed_command.returncode == 2
+    assert "--streaming can't be used with --checkpoint" in completed_command.stderr
+    assert "opening workbook" not in completed_command.stdout
+    assert not (tmp_path / 'output.xlsx').exists()
+
+
+@pytest.fixture
+def batch_input_folder(tmp_path, write_value_workbook):
+    # a folder with a two sheet workbook, a corrupt one, and an excel lock file that the glob has to skip
+    (tmp_path / 'in').mkdir()
+    write_value_workbook('in/catalog.xlsx', {'First': ['SKU-1', 'SKU-2', 'SKU-3'], 'Second': ['SKU-4', 'SKU-5']})
+    (tmp_path / 'in' / 'corrupt.xlsx').write_bytes(b'this is not a workbook')
+    (tmp_path / 'in' / '~$catalog.xlsx').write_bytes(b'lock')
+    (tmp_path / 'out').mkdir()
+    return tmp_path / 'in'
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_batch_reports_each_workbook_and_carries_on_past_a_failure(tmp_path, batch_input_folder, jobs):
+    completed_command = run_main(['batch', '--sheets', 'all', '--jobs', jobs, '--output_directory', 'out',
+                                  '--report', 'report.csv', os.path.join('in', '*.xlsx')], tmp_path)
+    assert completed_command.returncode == 1
+    assert "1 of 2 workbooks processed, 5 barcodes inserted" in completed_command.stdout
+    assert os.path.join('in', 'corrupt.xlsx') + ": " in completed_command.stderr
+    with open(tmp_path / 'report.csv', encoding='utf8', newline='') as report_file:
+        report_rows = list(csv.DictReader(report_file))
+    # the report follows the sorted order of the glob, whichever job finished first
+    assert [report_row['input'] for report_row in report_rows] == [os.path.join('in', 'catalog.xlsx'),
+                                                                   os.path.join('in', 'corrupt.xlsx')]
+    catalog_row, corrupt_row = report_rows
+    assert catalog_row['output'] == os.path.join('out', 'catalog.xlsx')
+    assert (catalog_row['status'], catalog_row['error'], catalog_row['sheets']) == ('done', '', 'First, Second')
+    assert (catalog_row['rows'], catalog_row['invalid'], catalog_row['inserted']) == ('5', '0', '5')
+    assert corrupt_row['status'] == 'failed'
+    assert corrupt_row['error']
+    assert corrupt_row['inserted'] == '0'
+    assert (tmp_path / 'out' / 'catalog.xlsx').exists()
+    assert not (tmp_path / 'out' / 'corrupt.xlsx').exists()
+
+
+def test_batch_json_report_has_a_summary(tmp_path, batch_input_folder):
+    completed_command = run_main(['batch', '--output_directory', 'out', '--report', 'report.json', 'in'], tmp_path)
+    assert completed_command.returncode == 1
+    with open(tmp_path / 'report.json', encoding='utf8') as report_file:
+        batch_report = json.load(report_file)
+    summary = batch_report['summary']
+    # without --sheets only the first sheet of the workbook is processed
+    assert (summary['workbooks'], summary['failed'], summary['rows'], summary['inserted']) == (2, 1, 3, 3)
+    assert [workbook['status'] for workbook in batch_report['workbooks']] == ['done', 'failed']
+    assert batch_report['workbooks'][0]['sheets'] == 'First'
+    assert batch_report['workbooks'][0]['timing']['stages']
+
+
+def test_batch_without_workbooks_fails(tmp_path):
+    completed_command = run_main(['batch', '--output_directory', '.', 'missing*.xlsx'], tmp_path)
+    assert completed_command.returncode == 1
+    assert "No workbooks found to process" in completed_command.stderr
+
+
+@pytest.mark.parametrize('report_name', ['errors.csv', 'errors.json'])
+def test_dry_run_estimates_and_reports_skipped_rows(tmp_path, write_value_workbook, report_name):
+    write_value_workbook('catalog.xlsx', {'Good': ['590123412345', '12', 'abc', '590123412345', None],
+                                          'Bad': ['abc', '1234567890123']})
+    completed_command = run_main(['process', '--dry_run', '--type', 'ean13', '--pad_ean', '--sheets', 'all',
+                                  '--error_report', report_name, '--stats', 'stats.json', 'catalog.xlsx',
+                                  'output.xlsx'], tmp_path)
+    assert completed_command.returncode == 0
+    assert not (tmp_path / 'output.xlsx').exists()
+    summary_lines = completed_command.stdout.splitlines()
+    assert "Good: 3 barcodes from 5 rows, output column width 26" in summary_lines
+    # nothing goes in the output column of a sheet without barcodes, so it has no width to report
+    assert "Bad: 0 barcodes from 2 rows" in summary_lines
+    assert "3 barcodes would be inserted from 7 rows" in summary_lines
+    assert "4 rows would be skipped (" in completed_command.stdout
+    assert "rendering 2 barcodes would take about " in completed_command.stdout
+    with open(tmp_path / 'stats.json', encoding='utf8') as stats_file:
+        layout_stats = json.load(stats_file)
+    assert (layout_stats['media_files'], layout_stats['renders']) == (2, 2)
+    assert layout_stats['estimated_output_bytes'] > os.path.getsize(tmp_path / 'catalog.xlsx') + \
+        layout_stats['estimated_media_bytes'] > 0
+    assert layout_stats['sheets']['Bad']['column_width'] is None
+
+    expected_rows = [['Good', 3, 'abc', 'not_integer'], ['Good', 5, '', 'empty'], ['Bad', 1, 'abc', 'not_integer'],
+                     ['Bad', 2, '1234567890123', 'too_long']]
+    with open(tmp_path / report_name, encoding='utf8', newline='') as report_file:
+        if report_name.endswith('.json'):
+            error_report = json.load(report_file)
+            assert error_report['errors'] == {'not_integer': 2, 'empty': 1, 'too_long': 1}
+            report_rows = error_report['rows']
+            expected_rows[1][2] = None
+        else:
+            report_rows = list(csv.DictReader(report_file))
+            for expected_row in expected_rows:
+                expected_row[1] = str(expected_row[1])
+    assert [[report_row[field] for field in ('sheet', 'row', 'value', 'error')] for report_row in report_rows] == \
+        expected_rows
+    assert report_rows[3]['message'] == "Input contents are more than 12 characters"
@@ -0,0 +1,75 @@
+import io
+import openpyxl
+import pytest
+from barcode_processing import BarcodeImageStore, do_process_workbook, save_workbook
+
+catalog_values = [str(590123400000 + row_number * 1013) for row_number in range(30)]
+
+
+def media_file(media_number):
+    return "/xl/media/barcode" + str(media_number) + ".png", bytes([media_number]) * (100 + media_number)
+
+
+def test_files_past_the_budget_are_spilled_and_read_back():
+    image_store = BarcodeImageStore(memory_budget=1000)
+    media_files = [media_file(media_number) for media_number in range(1, 21)]
+    try:
+        for media_path, png_bytes in media_files:
+            image_store.add(media_path, png_bytes)
+        assert 0 < image_store.memory_bytes <= 1000
+        assert image_store.spilled_bytes > 0
+        assert image_store.total_bytes == sum(len(png_bytes) for _, png_bytes in media_files)
+        assert list(image_store.items()) == media_files
+        # reads and adds can be mixed, the spill file is mapped again when it has grown
+        extra_path, extra_bytes = media_file(21)
+        image_store.add(extra_path, extra_bytes)
+        assert image_store.read(extra_path) == extra_bytes
+        assert image_store.read(media_files[-1][0]) == media_files[-1][1]
+        assert extra_path in image_store
+    finally:
+        image_store.close()
+
+
+def test_nothing_is_spilled_within_the_budget():
+    image_store = BarcodeImageStore()
+    image_store.add(*media_file(1))
+    assert image_store.spill_file is None
+    assert image_store.read(media_file(1)[0]) == media_file(1)[1]
+    image_store.close()
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_spilled_media_gives_the_same_workbook(tmp_path, ean13_settings, write_value_workbook, read_barcode_images,
+                                               streaming):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': catalog_values})
+    in_memory_path = str(tmp_path / 'in memory.xlsx')
+    spilled_path = str(tmp_path / 'spilled.xlsx')
+    in_memory_stats = do_process_workbook(input_path, in_memory_path, ean13_settings, streaming=streaming)
+    spilled_stats = do_process_workbook(input_path, spilled_path, ean13_settings, streaming=streaming,
+                                        image_memory_budget=0)
+    assert in_memory_stats['timing']['counters']['media_bytes_spilled'] == 0
+    assert spilled_stats['timing']['counters']['media_bytes_spilled'] == \
+        spilled_stats['timing']['counters']['media_bytes'] > 0
+    assert read_barcode_images(spilled_path) == read_barcode_images(in_memory_path)
+
+
+def test_workbook_handed_in_can_be_saved_again(tmp_path, ean13_settings, write_value_workbook):
+    wb = openpyxl.load_workbook(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}))
+    do_process_workbook(wb, None, ean13_settings, image_memory_budget=0)
+    saved_workbooks = []
+    for _ in range(2):
+        saved_workbook = io.BytesIO()
+        save_workbook(wb, saved_workbook)
+        saved_workbooks.append(openpyxl.load_workbook(saved_workbook))
+    # openpyxl's own save reads the images the same way
+    wb.save(str(tmp_path / 'openpyxl save.xlsx'))
+    saved_workbooks.append(openpyxl.load_workbook(str(tmp_path / 'openpyxl save.xlsx')))
+    for saved_wb in saved_workbooks:
+        assert len(saved_wb.active._images) == len(catalog_values)
+
+
+def test_peak_memory_is_reported(tmp_path, ean13_settings, write_value_workbook):
+    process_stats = do_process_workbook(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}),
+                                        str(tmp_path / 'output.xlsx'), ean13_settings)
+    pytest.importorskip('resource')
+    assert process_stats['timing']['peak_memory_bytes'] > 0
@@ -0,0 +1,85 @@
+import pathlib
+import openpyxl
+import pytest
+from barcode_settings import default_settings
+from barcode_processing import BarcodeRenderer, WorkbookProcessor, BarcodeRenderCache, do_process_workbook, \
+    generate_barcode, checkpoint_manifest_path
+
+catalog_values = [str(590123400000 + row_number * 1013) for row_number in range(20)] + ['abc', None]
+
+
+@pytest.fixture
+def ean13_renderer():
+    return BarcodeRenderer({'barcode_type': 'ean13', 'pad_ean_barcodes': True})
+
+
+def test_renderer_fills_in_the_default_settings(ean13_renderer, ean13_settings):
+    assert ean13_renderer.settings == ean13_settings
+    assert ean13_renderer.normalize(12345) == '000000123450'
+    assert ean13_renderer.render('12345') == generate_barcode('000000123450', ean13_settings)
+    assert len(ean13_renderer.render_cache) == 1
+    with pytest.raises(ValueError, match="Input contents are not an integer"):
+        ean13_renderer.render('abc')
+    with pytest.raises(ValueError):
+        BarcodeRenderer({'barcode_dpi': 10})
+
+
+def test_process_and_update_take_paths(tmp_path, ean13_renderer, ean13_settings, write_value_workbook,
+                                       read_barcode_images):
+    input_path = pathlib.Path(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}))
+    output_path = tmp_path / 'output.xlsx'
+    workbook_processor = WorkbookProcessor(ean13_renderer)
+    process_stats = workbook_processor.process(input_path, output_path)
+    assert (process_stats['rows'], process_stats['invalid'], process_stats['inserted']) == (22, 2, 20)
+    expected_path = str(tmp_path / 'expected.xlsx')
+    do_process_workbook(str(input_path), expected_path, ean13_settings)
+    assert read_barcode_images(str(output_path)) == read_barcode_images(expected_path)
+
+    # updating in place keeps every image, as none of the values have changed
+    update_stats = workbook_processor.update(output_path, output_path)
+    assert (update_stats['inserted'], update_stats['reused'], update_stats['removed']) == (20, 20, 0)
+    assert read_barcode_images(str(output_path)) == read_barcode_images(expected_path)
+
+
+def test_processing_with_checkpoints_takes_paths(tmp_path, write_value_workbook):
+    input_path = pathlib.Path(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}))
+    output_path = tmp_path / 'output.xlsx'
+    ean13_settings = {'barcode_type': 'ean13', 'pad_ean_barcodes': True}
+    WorkbookProcessor(BarcodeRenderer(ean13_settings), checkpoint=True).process(input_path, output_path)
+    assert pathlib.Path(checkpoint_manifest_path(output_path)).exists()
+    rerun_stats = WorkbookProcessor(BarcodeRenderer(ean13_settings), checkpoint=True).process(input_path,
+                                                                                             output_path)
+    assert rerun_stats['reused'] == 20
+    # a manifest from other settings is ignored, rather than failing on the path in its debug message
+    changed_renderer = BarcodeRenderer(dict(ean13_settings, barcode_dpi=200))
+    changed_stats = WorkbookProcessor(changed_renderer, checkpoint=True).process(input_path, output_path)
+    assert (changed_stats['inserted'], changed_stats['reused']) == (20, 0)
+
+
+def test_processor_uses_its_renderers_settings_and_cache(tmp_path, write_value_workbook, read_barcode_images):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': ['SKU-1', 'SKU-2', 'SKU-1']})
+    render_cache = BarcodeRenderCache()
+    custom_renderer = BarcodeRenderer({'barcode_dpi': 200, 'barcode_png_mode': 'bilevel', 'barcode_font_size': 0},
+                                      render_cache)
+    workbook_processor = WorkbookProcessor(custom_renderer)
+    output_path = str(tmp_path / 'output.xlsx')
+    first_stats = workbook_processor.process(input_path, output_path)
+    assert len(render_cache) == 2
+    second_stats = workbook_processor.process(input_path, str(tmp_path / 'again.xlsx'))
+    assert first_stats['timing']['counters']['render_cache_misses'] == 2
+    assert second_stats['timing']['counters']['render_cache_misses'] == 0
+    expected_path = str(tmp_path / 'expected.xlsx')
+    do_process_workbook(input_path, expected_path, custom_renderer.settings)
+    assert read_barcode_images(output_path) == read_barcode_images(expected_path)
+    assert custom_renderer.settings['barcode_type'] == default_settings['barcode_type']
+    assert workbook_processor.layout(input_path)['sheets']['Sheet']['barcodes'] == 3
+
+
+def test_process_leaves_an_openpyxl_workbook_unsaved(write_value_workbook):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': ['SKU-1', 'SKU-2']})
+    wb = openpyxl.load_workbook(input_path)
+    WorkbookProcessor().process(wb)
+    assert len(wb.active._images) == 2
+    assert not openpyxl.load_workbook(input_path).active._images
+    with pytest.raises(ValueError):
+        WorkbookProcessor().process(input_path)
@@ -0,0 +1,161 @@
+import asyncio
+import gc
+import logging
+import time
+import pytest
+import barcode_service
+from barcode_settings import default_settings
+from barcode_service import RenderService, ServiceRequestError
+
+
+def make_render_service(max_queued_renders, **service_options):
+    render_service = RenderService(dict(default_settings, barcode_type='code39'),
+                                   max_queued_renders=max_queued_renders, **service_options)
+    render_service.start()
+    return render_service
+
+
+def slow_render_service_batch(render_seconds):
+    render_service_batch = barcode_service.render_service_batch
+
+    def render_slowly(input_strings, settings, image_format):
+        time.sleep(render_seconds)
+        return render_service_batch(input_strings, settings, image_format)
+    return render_slowly
+
+
+def collect_futures():
+    # asyncio logs an exception nobody retrieved from a future when the future is collected
+    gc.collect()
+
+
+def test_requests_past_backlog_are_turned_away_without_logging(caplog, monkeypatch):
+    monkeypatch.setattr(barcode_service, 'render_service_batch', slow_render_service_batch(0.01))
+    render_service = make_render_service(max_queued_renders=2)
+
+    async def send_request(request_number):
+        # only the status is kept, an exception's traceback would keep the request's futures from being collected
+        try:
+            _, (status, _, _, _) = await render_service.handle_request('GET', '/render?value=' + str(request_number),
+                                                                       b'')
+        except ServiceRequestError as request_error:
+            status = request_error.status
+        return status
+
+    async def send_requests():
+        request_statuses = await asyncio.gather(*[send_request(request_number) for request_number in range(50)])
+        collect_futures()
+        return request_statuses
+
+    try:
+        with caplog.at_level(logging.ERROR):
+            request_statuses = asyncio.run(send_requests())
+            collect_futures()
+    finally:
+        render_service.close()
+    assert set(request_statuses) == {200, 503}
+    assert render_service.counters['rejected'] == request_statuses.count(503)
+    assert render_service.renders_in_flight == {}
+    assert render_service.queued_renders == 0
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_cancelled_render_fails_joined_requests_without_logging(caplog, monkeypatch):
+    monkeypatch.setattr(barcode_service, 'render_service_batch', slow_render_service_batch(0.2))
+    render_service = make_render_service(max_queued_renders=100)
+
+    async def cancel_waiting_render():
+        # the first request holds the only render slot, the second waits for it with two values, and the third
+        # joins the second's render of one of them
+        first_request = asyncio.create_task(render_service.render_values(['1'], render_service.settings, 'png'))
+        await asyncio.sleep(0.05)
+        cancelled_request = asyncio.create_task(render_service.render_values(['2', '3'], render_service.settings,
+                                                                             'png'))
+        await asyncio.sleep(0)
+        joined_request = asyncio.create_task(render_service.render_values(['2'], render_service.settings, 'png'))
+        await asyncio.sleep(0)
+        cancelled_request.cancel()
+        request_results = await asyncio.gather(first_request, cancelled_request, joined_request,
+                                               return_exceptions=True)
+        collect_futures()
+        return request_results
+
+    try:
+        with caplog.at_level(logging.ERROR):
+            first_result, cancelled_result, joined_result = asyncio.run(cancel_waiting_render())
+            collect_futures()
+    finally:
+        render_service.close()
+    assert isinstance(first_result[0][0], tuple)
+    assert isinstance(cancelled_result, asyncio.CancelledError)
+    assert joined_result == (["Render was cancelled"], 1)
+    assert render_service.renders_in_flight == {}
+    assert render_service.queued_renders == 0
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_repeated_values_are_rendered_once():
+    render_service = make_render_service(max_queued_renders=100)
+    try:
+        value_results, render_count = asyncio.run(render_service.render_values(['12', '12', ''],
+                                                                               render_service.settings, 'png'))
+    finally:
+        render_service.close()
+    assert render_count == 1
+    assert value_results[0] == value_results[1]
+    assert value_results[0][0].startswith(b'\x89PNG')
+    assert isinstance(value_results[2], str)
+    assert render_service.counters['renders'] == 1
+
+
+@pytest.mark.parametrize('image_format', ['png', 'svg'])
+def test_cached_values_are_not_rendered_again(image_format):
+    render_service = make_render_service(max_queued_renders=100)
+    try:
+        asyncio.run(render_service.render_values(['12'], render_service.settings, image_format))
+        _, render_count = asyncio.run(render_service.render_values(['12'], render_service.settings, image_format))
+    finally:
+        render_service.close()
+    assert render_count == 0
+
+
+def test_request_with_more_renders_than_the_backlog_holds_is_turned_away():
+    render_service = make_render_service(max_queued_renders=3)
+    try:
+        with pytest.raises(ServiceRequestError) as request_error:
+            asyncio.run(render_service.render_values(['1', '2', '3', '4'], render_service.settings, 'png'))
+        # repeats and values that are cached already don't count towards it
+        value_results, render_count = asyncio.run(render_service.render_values(['1', '2', '3', '3'],
+                                                                               render_service.settings, 'png'))
+        _, cached_render_count = asyncio.run(render_service.render_values(['1', '2', '3', '4'],
+                                                                          render_service.settings, 'png'))
+    finally:
+        render_service.close()
+    assert request_error.value.status == 413
+    assert render_service.counters['rejected'] == 1
+    assert render_count == 3
+    assert cached_render_count == 1
+    assert render_service.renders_in_flight == {}
+
+
+def test_request_body_over_the_limit_is_not_read():
+    render_service = make_render_service(max_queued_renders=100, max_request_bytes=1000)
+
+    async def send_large_request():
+        server = await asyncio.start_server(render_service.handle_connection, '127.0.0.1', 0)
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+            # the body is never sent, the answer has to come from the content length alone
+            writer.write(b'POST /render HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: 1001\r\n\r\n')
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+        return response
+
+    try:
+        response = asyncio.run(send_large_request())
+    finally:
+        render_service.close()
+    assert response.startswith(b'HTTP/1.1 413 ')
+    assert b'Connection: close' in response
+    assert b'Request is larger than 1000 bytes' in response
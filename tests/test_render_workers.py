@@ -0,0 +1,56 @@
+import multiprocessing
+import barcode_processing
+from barcode_processing import do_process_workbook, render_barcodes_in_row_order, generate_barcode, \
+    BarcodeRenderCache
+
+# repeats, and a value that isn't valid, spread through the sheet
+catalog_values = [str(590123400000 + (row_number % 30) * 1013) for row_number in range(90)] + ['12', None, 'abc']
+
+
+def test_render_workers_give_the_same_workbook(tmp_path, ean13_settings, write_value_workbook, read_barcode_images):
+    input_path = write_value_workbook('catalog.xlsx', {'First': catalog_values, 'Second': catalog_values[::-1]})
+    one_worker_path = str(tmp_path / 'one_worker.xlsx')
+    two_workers_path = str(tmp_path / 'two_workers.xlsx')
+    one_worker_stats = do_process_workbook(input_path, one_worker_path, ean13_settings, sheet_selection='all',
+                                           render_cache=BarcodeRenderCache())
+    two_workers_stats = do_process_workbook(input_path, two_workers_path, ean13_settings, sheet_selection='all',
+                                            render_cache=BarcodeRenderCache(), render_workers=2)
+    for stat_name in ('rows', 'invalid', 'inserted'):
+        assert two_workers_stats[stat_name] == one_worker_stats[stat_name]
+    assert read_barcode_images(two_workers_path) == read_barcode_images(one_worker_path)
+    assert not multiprocessing.active_children()
+
+
+def test_pipeline_renders_each_value_once_in_row_order(ean13_settings, monkeypatch):
+    # a small queue, so that batches are submitted as earlier ones are taken rather than all at once
+    monkeypatch.setattr(barcode_processing, 'render_queue_size', 8)
+    barcode_rows = [(row_number, value) for row_number, value in enumerate(catalog_values[:90], start=1)]
+    render_cache = BarcodeRenderCache()
+    rendered_rows = render_barcodes_in_row_order(barcode_rows, ean13_settings, render_cache, render_workers=2)
+    try:
+        assert len(rendered_rows.values_to_render) == 30
+        assert len(rendered_rows.queued_batches) < 30
+        rendered_barcodes = list(rendered_rows)
+    finally:
+        rendered_rows.close()
+    assert [row_number for row_number, _ in rendered_barcodes] == list(range(1, 91))
+    for (_, value), (_, rendered_barcode) in zip(barcode_rows, rendered_barcodes):
+        assert rendered_barcode == generate_barcode(value, ean13_settings)
+    assert len(render_cache) == 30
+
+
+def test_cancelling_stops_the_render_workers(tmp_path, ean13_settings, write_value_workbook):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': catalog_values})
+    inserted_rows = []
+
+    def record_progress(text, value=None, maximum=None):
+        if value is not None:
+            inserted_rows.append(value)
+
+    def keep_alive():
+        return not inserted_rows or inserted_rows[-1] < 20
+    cancelled_stats = do_process_workbook(input_path, str(tmp_path / 'output.xlsx'), ean13_settings,
+                                          render_cache=BarcodeRenderCache(), render_workers=2,
+                                          progress_callback=record_progress, keep_alive_callback=keep_alive)
+    assert cancelled_stats['inserted'] == 20
+    assert not multiprocessing.active_children()
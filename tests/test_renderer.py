@@ -0,0 +1,59 @@
+import io
+import barcode
+import pytest
+from barcode.writer import ImageWriter, mm2px
+from PIL import Image, ImageChops, ImageOps
+from barcode_settings import default_settings
+from barcode_processing import generate_barcode, get_barcode_geometry, get_barcode_layout, barcode_writer_options
+
+
+def render_with_image_writer(input_string, settings):
+    # what barcodes looked like before they were drawn from the module pattern
+    ean = barcode.get(settings['barcode_type'], input_string, writer=ImageWriter())
+    ean.default_writer_options = dict(ean.default_writer_options, **barcode_writer_options(settings))
+    return ImageOps.expand(ean.render(), border=settings['barcode_border'], fill='white').convert('RGB')
+
+
+@pytest.mark.parametrize('barcode_type, input_string, setting_changes', [
+    ('ean13', '590123412345', {}),
+    ('ean8', '1234567', {}),
+    ('UPC', '12345678901', {'barcode_dpi': 200}),
+    ('code39', 'SKU-123', {'barcode_dpi': 200}),
+    ('ean13', '590123412345', {'barcode_dpi': 300, 'barcode_module_height': 10, 'barcode_font_size': 10}),
+    ('ean8', '1234567', {'barcode_border': 5}),
+])
+def test_barcodes_have_the_image_writers_pixels(barcode_type, input_string, setting_changes):
+    settings = dict(default_settings, barcode_type=barcode_type, **setting_changes)
+    png_bytes, width, height = generate_barcode(input_string, settings)
+    barcode_image = Image.open(io.BytesIO(png_bytes))
+    writer_image = render_with_image_writer(input_string, settings)
+    assert barcode_image.size == writer_image.size == (width, height)
+    assert ImageChops.difference(barcode_image.convert('RGB'), writer_image).getbbox() is None
+
+
+def test_code39_renders_at_the_default_dpi():
+    # the image writer can't draw code39's narrow bars at 120 dpi, as they are under a pixel wide. every bar still
+    # has to cover a pixel where it starts
+    settings = dict(default_settings, barcode_type='code39')
+    png_bytes, width, height = generate_barcode('SKU-123', settings)
+    assert (width, height) == get_barcode_geometry('SKU-123', settings)
+    barcode_layout = get_barcode_layout('SKU-123', settings)
+    bar_row = Image.open(io.BytesIO(png_bytes)).convert('L').crop((0, 5, width, 6)).tobytes()
+    xpos = barcode_layout.quiet_zone
+    for module in barcode.get('code39', 'SKU-123').build()[0]:
+        if module == '1':
+            assert bar_row[int(mm2px(xpos, barcode_layout.dpi))] == 0
+        xpos += barcode_layout.module_width
+    assert bar_row[0] == bar_row[-1] == 255
+
+
+@pytest.mark.parametrize('png_mode, image_mode', [('rgb', 'RGB'), ('grayscale', 'L'), ('bilevel', '1')])
+def test_png_modes(png_mode, image_mode):
+    settings = dict(default_settings, barcode_type='ean13', barcode_png_mode=png_mode)
+    png_bytes, _, _ = generate_barcode('590123412345', settings)
+    barcode_image = Image.open(io.BytesIO(png_bytes))
+    assert barcode_image.mode == image_mode
+    rgb_bytes, _, _ = generate_barcode('590123412345', dict(settings, barcode_png_mode='rgb'))
+    rgb_image = Image.open(io.BytesIO(rgb_bytes))
+    if png_mode != 'bilevel':
+        assert ImageChops.difference(barcode_image.convert('RGB'), rgb_image).getbbox() is None
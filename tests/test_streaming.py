@@ -0,0 +1,54 @@
+import openpyxl
+import pytest
+from barcode_settings import default_settings
+from barcode_processing import do_process_workbook, get_barcode_font_text
+
+catalog_values = [str(590123400000 + row_number * 1013) for row_number in range(25)] + ['not a number', None, '12']
+
+
+def test_streaming_gives_the_same_barcodes_as_processing(tmp_path, ean13_settings, write_value_workbook,
+                                                          read_barcode_images):
+    input_path = write_value_workbook('catalog.xlsx', {'First': catalog_values, 'Second': catalog_values[:5]})
+    processed_path = str(tmp_path / 'processed.xlsx')
+    streamed_path = str(tmp_path / 'streamed.xlsx')
+    processed_stats = do_process_workbook(input_path, processed_path, ean13_settings, sheet_selection='all')
+    streamed_stats = do_process_workbook(input_path, streamed_path, ean13_settings, sheet_selection='all',
+                                         streaming=True)
+    for stat_name in ('rows', 'invalid', 'inserted'):
+        assert streamed_stats[stat_name] == processed_stats[stat_name]
+    assert read_barcode_images(streamed_path) == read_barcode_images(processed_path)
+    streamed_ws = openpyxl.load_workbook(streamed_path)['First']
+    assert [row[1] for row in streamed_ws.iter_rows(values_only=True)] == catalog_values
+
+
+def test_streaming_copies_sheets_that_are_not_selected(tmp_path, ean13_settings, write_value_workbook):
+    input_path = write_value_workbook('catalog.xlsx', {'First': catalog_values, 'Notes': ['a', 'b']})
+    streamed_path = str(tmp_path / 'streamed.xlsx')
+    do_process_workbook(input_path, streamed_path, ean13_settings, streaming=True)
+    streamed_wb = openpyxl.load_workbook(streamed_path)
+    assert streamed_wb.sheetnames == ['First', 'Notes']
+    assert not streamed_wb['Notes']._images
+    assert [row[1] for row in streamed_wb['Notes'].iter_rows(values_only=True)] == ['a', 'b']
+
+
+def test_streaming_font_mode(tmp_path, write_value_workbook):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': ['SKU-1', 'SKU-2']})
+    font_settings = dict(default_settings, barcode_output_mode='font')
+    processed_path = str(tmp_path / 'processed.xlsx')
+    streamed_path = str(tmp_path / 'streamed.xlsx')
+    do_process_workbook(input_path, processed_path, font_settings)
+    do_process_workbook(input_path, streamed_path, font_settings, streaming=True)
+    processed_ws = openpyxl.load_workbook(processed_path).active
+    streamed_ws = openpyxl.load_workbook(streamed_path).active
+    assert [cell.value for cell in streamed_ws['A']] == [cell.value for cell in processed_ws['A']] == \
+        [get_barcode_font_text('SKU-1', 'code39'), get_barcode_font_text('SKU-2', 'code39')]
+    assert streamed_ws['A1'].font.name == processed_ws['A1'].font.name
+
+
+def test_streaming_refuses_to_write_over_its_input(ean13_settings, write_value_workbook):
+    input_path = write_value_workbook('catalog.xlsx', {'Sheet': catalog_values})
+    with pytest.raises(ValueError):
+        do_process_workbook(input_path, input_path, ean13_settings, streaming=True)
+    with pytest.raises(ValueError):
+        do_process_workbook(input_path, str(input_path) + '.out.xlsx', ean13_settings, streaming=True,
+                            checkpoint=True)
@@ -0,0 +1,83 @@
+import openpyxl
+from barcode_processing import do_process_workbook, do_update_workbook, BarcodeRenderCache
+
+catalog_values = [str(590123400000 + row_number * 1013) for row_number in range(30)]
+
+
+def edit_values(workbook_path, edited_path, row_values):
+    # changes column B of a processed workbook in place of a user editing it, keeping its images
+    wb = openpyxl.load_workbook(workbook_path)
+    for row_number, value in row_values.items():
+        wb.active.cell(row=row_number, column=2).value = value
+    wb.save(edited_path)
+
+
+def test_update_renders_only_changed_rows(tmp_path, ean13_settings, write_value_workbook, read_barcode_images):
+    processed_path = str(tmp_path / 'processed.xlsx')
+    do_process_workbook(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}), processed_path,
+                        ean13_settings)
+    row_edits = {4: '111111111111', 9: None, 31: '222222222222', 32: '333333333333'}
+    edited_path = str(tmp_path / 'edited.xlsx')
+    edit_values(processed_path, edited_path, row_edits)
+    updated_path = str(tmp_path / 'updated.xlsx')
+    render_cache = BarcodeRenderCache()
+    update_stats = do_update_workbook(edited_path, updated_path, ean13_settings, render_cache=render_cache)
+    assert update_stats['inserted'] == len(catalog_values) + 1
+    assert update_stats['reused'] == len(catalog_values) - 2
+    assert update_stats['removed'] == 1
+    assert update_stats['timing']['counters']['render_cache_misses'] == 3
+
+    edited_values = list(catalog_values) + [None, None]
+    for row_number, value in row_edits.items():
+        edited_values[row_number - 1] = value
+    fresh_path = str(tmp_path / 'fresh.xlsx')
+    do_process_workbook(write_value_workbook('edited values.xlsx', {'Sheet': edited_values}), fresh_path,
+                        ean13_settings)
+    updated_images, _, updated_widths = read_barcode_images(updated_path)
+    fresh_images, _, fresh_widths = read_barcode_images(fresh_path)
+    assert updated_images == fresh_images
+    assert updated_widths == fresh_widths
+
+
+def test_update_can_write_over_its_input(tmp_path, ean13_settings, write_value_workbook, read_barcode_images):
+    processed_path = str(tmp_path / 'processed.xlsx')
+    do_process_workbook(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}), processed_path,
+                        ean13_settings)
+    processed_images = read_barcode_images(processed_path)
+    update_stats = do_update_workbook(processed_path, processed_path, ean13_settings)
+    assert update_stats['reused'] == len(catalog_values)
+    assert read_barcode_images(processed_path) == processed_images
+    # and a second time, from the images the update wrote
+    assert do_update_workbook(processed_path, processed_path, ean13_settings)['reused'] == len(catalog_values)
+
+
+def test_update_with_other_settings_renders_everything(tmp_path, ean13_settings, write_value_workbook,
+                                                        read_barcode_images):
+    processed_path = str(tmp_path / 'processed.xlsx')
+    do_process_workbook(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}), processed_path,
+                        ean13_settings)
+    grayscale_settings = dict(ean13_settings, barcode_png_mode='grayscale')
+    updated_path = str(tmp_path / 'updated.xlsx')
+    update_stats = do_update_workbook(processed_path, updated_path, grayscale_settings)
+    assert update_stats['reused'] == 0
+    assert update_stats['inserted'] == len(catalog_values)
+    fresh_path = str(tmp_path / 'fresh.xlsx')
+    do_process_workbook(write_value_workbook('catalog again.xlsx', {'Sheet': catalog_values}), fresh_path,
+                        grayscale_settings)
+    assert read_barcode_images(updated_path)[0] == read_barcode_images(fresh_path)[0]
+
+
+def test_update_keeps_images_outside_the_output_column(tmp_path, ean13_settings, write_value_workbook):
+    processed_path = str(tmp_path / 'processed.xlsx')
+    do_process_workbook(write_value_workbook('catalog.xlsx', {'Sheet': catalog_values}), processed_path,
+                        ean13_settings)
+    # a barcode dropped into column D by hand isn't one of the output column's
+    wb = openpyxl.load_workbook(processed_path)
+    do_process_workbook(wb, None, dict(ean13_settings, barcode_output_column='D'))
+    wb.save(processed_path)
+    updated_path = str(tmp_path / 'updated.xlsx')
+    update_stats = do_update_workbook(processed_path, updated_path, ean13_settings)
+    assert update_stats['reused'] == len(catalog_values)
+    updated_ws = openpyxl.load_workbook(updated_path).active
+    assert sorted(img.anchor._from.col for img in updated_ws._images) == [0] * len(catalog_values) + \
+        [3] * len(catalog_values)